@@ -7,9 +7,15 @@ else:
     clr.AddReference('RawQuant/RawFileReader/ThermoFisher.CommonCore.Data')
 
 from ThermoFisher.CommonCore.Data import Business
-from RawQuant.RawFileReader.converter import asNumpyArray
+from RawQuant.RawFileReader.converter import asNumpyArray, copyToNumpyArrays
+from RawQuant.RawFileReader.peakstore import PeakStore, PeakStoreWriter, LazyPeakStore, field_dtypes, allocate, \
+    merge_intervals, interval_mask
+from RawQuant.RawFileReader.trailer import TrailerTable
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
 from tqdm import tqdm
 from collections import OrderedDict as OD
+import threading
 import numpy as np
 
 r'''
@@ -33,70 +39,297 @@ raw = Business.RawFileReaderFactory.ReadFile(r'D:\raw file TMT quant\test.raw')
 '''
 
 
+MASS_ANALYZERS = {0: 'ITMS', 4: 'FTMS'}
+
+CENTROID_FIELDS = ['Masses', 'Intensities', 'Resolutions', 'Baselines', 'Noises', 'Charges']
+
+SEGMENTED_FIELDS = ['Positions', 'Intensities']
+
+
 def open_raw_file(raw):
 
     return Business.RawFileReaderFactory.ReadFile(raw)
 
 
-def extract_centroid_streams(raw, scans, disable_bar):
+def read_header(raw):
 
     """
+    Reads the file-level information RawQuant uses besides the scans themselves.
 
     :param raw:
-    :param scans:
+    :return: dict with the instrument name, the trailer extra labels and the run start and end times (min)
+    """
+
+    trailer_extra_information = raw.GetTrailerExtraHeaderInformation()
+
+    return {'InstName': raw.GetInstrumentData().Name,
+            'TrailerLabels': [trailer_extra_information[x].Label for x in range(trailer_extra_information.Length)],
+            'StartTime': raw.RunHeaderEx.StartTime,
+            'EndTime': raw.RunHeaderEx.EndTime}
+
+
+class Progress:
+
+    '''
+    A progress bar which can be updated from several worker threads.
+    '''
+
+    def __init__(self, total, disable):
+
+        self.bar = tqdm(total=total, ncols=70, disable=disable)
+        self.lock = threading.Lock()
+
+    def update(self, n=1):
+
+        with self.lock:
+            self.bar.update(n)
+
+    def close(self):
+
+        self.bar.close()
+
+
+def map_scan_chunks(raw, scans, fill, workers=1, disable_bar=False):
+
+    """
+    Splits a list of scans into contiguous chunks and calls fill(accessor, first, chunk, progress) for each of
+    them, where first is the position of the first scan of the chunk in the scan list. With more than one worker,
+    the chunks are processed by a pool of threads, each of which reads the file through its own thread accessor
+    created with RawFileReaderFactory.CreateThreadManager. fill can write into preallocated arrays shared by all
+    chunks, and/or return a result for its chunk.
+
+    :param raw: the raw file accessor. Used directly when workers is 1.
+    :param scans: the scan numbers to process
+    :param fill: function to be called on each chunk
+    :param workers: number of worker threads
+    :param disable_bar:
+    :return: the results of fill for each chunk, in scan order
+    """
+
+    scans = np.asarray(scans, dtype=int)
+
+    # several chunks per worker, so that a slow region of the file does not hold up the whole extraction
+    n_chunks = max(1, min(len(scans), 4 * workers)) if workers > 1 else 1
+    chunks = np.array_split(scans, n_chunks)
+    firsts = np.cumsum([0] + [len(x) for x in chunks[:-1]])
+
+    progress = Progress(total=len(scans), disable=disable_bar)
+
+    if n_chunks == 1:
+        results = [fill(raw, 0, chunks[0], progress)]
+        progress.close()
+        return results
+
+    manager = Business.RawFileReaderFactory.CreateThreadManager(raw.FileName)
+    accessors = Queue()
+
+    for i in range(min(workers, n_chunks)):
+        accessor = manager.CreateThreadAccessor()
+        accessor.SelectInstrument(0, 1)
+        accessors.put(accessor)
+
+    def run(first, chunk):
+
+        accessor = accessors.get()
+
+        try:
+            return fill(accessor, first, chunk, progress)
+        finally:
+            accessors.put(accessor)
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(workers, n_chunks)) as pool:
+            results = list(pool.map(run, firsts, chunks))
+
+    finally:
+        while not accessors.empty():
+            accessors.get().Dispose()
+        manager.Dispose()
+        progress.close()
+
+    return results
+
+
+def extract_scan_index(raw, disable_bar, workers=1):
+
+    """
+    Reads the scan event of every scan in the file in a single pass and fills one numpy array per scan header
+    field. Each distinct scan filter is given an integer id, and the filter string and mass ranges are stored
+    once per filter rather than once per scan.
+
+    :param raw:
+    :param disable_bar:
+    :param workers: number of threads used to read the file
+    :return: an OrderedDict of numpy arrays with one element per scan, and a list of the scan filters
+    """
+
+    scans = np.arange(raw.RunHeaderEx.FirstSpectrum, raw.RunHeaderEx.LastSpectrum + 1)
+
+    index = OD([('ScanNum', scans),
+                ('MSOrder', np.empty(len(scans), dtype=int)),
+                ('Analyzer', np.empty(len(scans), dtype=int)),
+                ('RetentionTime', np.empty(len(scans), dtype=float)),
+                ('PrecursorMass', np.zeros(len(scans), dtype=float)),
+                ('IsolationWidth', np.zeros(len(scans), dtype=float)),
+                ('Centroid', np.empty(len(scans), dtype=bool)),
+                ('FilterID', np.empty(len(scans), dtype=int))])
+
+    filter_strings = np.empty(len(scans), dtype=object)
+
+    def fill(accessor, first, chunk, progress):
+
+        mass_ranges = {}
+
+        for i, scan in enumerate(chunk, first):
+
+            event = accessor.GetScanEventForScanNumber(int(scan))
+
+            index['MSOrder'][i] = int(event.MsOrder)
+            index['Analyzer'][i] = int(event.MassAnalyzerType)
+            index['RetentionTime'][i] = accessor.RetentionTimeFromScanNumber(int(scan))
+            index['Centroid'][i] = int(event.ScanData) == 0  # ScanDataType.Centroid
+
+            if index['MSOrder'][i] > 1:
+                reaction = event.Reactions[0]
+                index['PrecursorMass'][i] = reaction.PrecursorMass
+                index['IsolationWidth'][i] = reaction.IsolationWidth
+
+            # scans acquired with the same scan filter share a filter id, so the filter details are only read once
+            filter_strings[i] = event.ToString()
+
+            if filter_strings[i] not in mass_ranges:
+                mass_ranges[filter_strings[i]] = [(x.LowMass, x.HighMass) for x in event.MassRanges]
+
+            progress.update()
+
+        return mass_ranges
+
+    mass_ranges = {}
+    for x in map_scan_chunks(raw, scans, fill, workers=workers, disable_bar=disable_bar):
+        mass_ranges.update(x)
+
+    # number the filters in the order they first appear in the file
+    filter_ids = {}
+    filters = []
+
+    for i in range(len(scans)):
+
+        if filter_strings[i] not in filter_ids:
+            filter_ids[filter_strings[i]] = len(filters)
+            filters.append({'Filter': filter_strings[i], 'MassRanges': mass_ranges[filter_strings[i]]})
+
+        index['FilterID'][i] = filter_ids[filter_strings[i]]
+
+    return index, filters
+
+
+def select_fields(fields, available):
+
+    """
+    Checks a list of requested fields and puts them in the order of the available fields, so the column positions
+    of a PeakStore are always the same for the same set of fields.
+
+    :param fields: list of field names, or None for all available fields
+    :param available: list of the fields which can be extracted
     :return:
     """
-    num = raw.RunHeaderEx.SpectraCount
 
-    def get_out(raw, scan):
+    if fields is None:
+        return list(available)
+
+    unknown = [x for x in fields if x not in available]
+
+    if len(unknown) > 0:
+        raise ValueError('Unknown field(s): {}. Possible fields are: {}'.format(unknown, available))
+
+    return [x for x in available if x in fields]
+
+
+def extract_centroid_streams(raw, scans, disable_bar, fields=None, dtype=float, workers=1):
+
+    """
+
+    :param raw:
+    :param scans:
+    :param disable_bar:
+    :param fields: the centroid stream fields to extract (see CENTROID_FIELDS). Defaults to all of them.
+    :param dtype: storage dtype, either one dtype for all fields or a dict of dtypes keyed by field
+    :param workers: number of threads used to read the file
+    :return: a PeakStore with the requested fields
+    """
+
+    fields = select_fields(fields, CENTROID_FIELDS)
+
+    def fill(accessor, first, chunk, progress):
+
+        store = PeakStoreWriter(fields, n_scans=len(chunk), dtype=dtype)
 
-        data = raw.GetCentroidStream(scan, None)
+        for scan in chunk:
 
-        out = np.empty((data.Length, 6))
+            data = accessor.GetCentroidStream(int(scan), None)
 
-        out[:, 0] = asNumpyArray(data.Masses)
-        out[:, 1] = asNumpyArray(data.Intensities)
-        out[:, 2] = asNumpyArray(data.Resolutions)
-        out[:, 3] = asNumpyArray(data.Baselines)
-        out[:, 4] = asNumpyArray(data.Noises)
-        out[:, 5] = asNumpyArray(data.Charges)
+            start, stop = store.append(scan, data.Length)
 
-        return out
+            # only the requested fields are copied out of the .NET object, straight into the store
+            copyToNumpyArrays([getattr(data, x) for x in fields], [x[start:stop] for x in store.buffer])
 
-    return OD((str(x),get_out(raw,x)) for x in tqdm(scans, ncols=70, disable=disable_bar))
+            progress.update()
 
+        return store.close()
 
-def extract_centroid_spectra(raw, scans, disable_bar):
+    return PeakStore.concatenate(map_scan_chunks(raw, scans, fill, workers=workers, disable_bar=disable_bar))
+
+
+def lazy_centroid_streams(raw, scans, fields=None, dtype=float, max_bytes=2 ** 28):
 
     """
+    Like extract_centroid_streams, but nothing is read up front. Each scan is read from the file when it is first
+    requested and kept in a cache of at most max_bytes.
 
     :param raw:
     :param scans:
-    :return:
+    :param fields: the centroid stream fields to extract (see CENTROID_FIELDS). Defaults to all of them.
+    :param dtype: storage dtype, either one dtype for all fields or a dict of dtypes keyed by field
+    :param max_bytes: size of the scan cache in bytes
+    :return: a LazyPeakStore with the requested fields
     """
-    num = raw.RunHeaderEx.SpectraCount
 
-    def get_out(raw, scan):
+    fields = select_fields(fields, CENTROID_FIELDS)
+    dtypes = field_dtypes(fields, dtype)
 
-        data = raw.GetCentroidStream(scan, None)
+    def read(scan):
 
-        out = np.empty((data.Length, 2))
+        data = raw.GetCentroidStream(int(scan), None)
 
-        out[:, 0] = asNumpyArray(data.Masses)
-        out[:, 1] = asNumpyArray(data.Intensities)
+        buffer = allocate(dtypes, data.Length)
 
-        return out
+        copyToNumpyArrays([getattr(data, x) for x in fields], list(buffer))
 
-    return OD((str(x),get_out(raw,x)) for x in tqdm(scans, ncols=70, disable=disable_bar))
+        return buffer
 
+    return LazyPeakStore(scans, fields, read, dtype=dtype, max_bytes=max_bytes)
 
-def extract_trailer_extras(raw, scans, boxcar, disable_bar):
+
+def extract_centroid_spectra(raw, scans, disable_bar, dtype=float, workers=1):
 
     """
 
     :param raw:
     :param scans:
-    :return:
+    :return: a PeakStore with the fields Masses and Intensities
+    """
+
+    return extract_centroid_streams(raw, scans, disable_bar, fields=['Masses', 'Intensities'], dtype=dtype,
+                                    workers=workers)
+
+
+def extract_trailer_extras(raw, scans, boxcar, disable_bar, workers=1):
+
+    """
+
+    :param raw:
+    :param scans:
+    :return: a TrailerTable of the trailer extra values
     """
 
     trailer_extra_information = raw.GetTrailerExtraHeaderInformation()
@@ -118,42 +351,200 @@ def extract_trailer_extras(raw, scans, boxcar, disable_bar):
 
     index = [x for x in range(len(labels)) if labels[x] in desired]
 
-    keys = [labels[x][:-1] for x in index]
+    def fill(accessor, first, chunk, progress):
+
+        values = np.empty((len(chunk), len(index)), dtype=object)
+
+        for i in range(len(chunk)):
 
-    def get_out(raw, scan):
+            # all trailer values of the scan are fetched as strings in one call
+            scan_values = list(accessor.GetTrailerExtraInformation(int(chunk[i])).Values)
 
-        return OD((keys[x], raw.GetTrailerExtraValue(scan, index[x])) for x in range(len(index)))
+            values[i] = [scan_values[x] for x in index]
 
-    return OD((str(x), get_out(raw, x)) for x in tqdm(scans, ncols=70, disable=disable_bar))
+            progress.update()
 
+        return values
 
-def extract_segmented_scans(raw, scans, disable_bar):
+    values = np.concatenate(map_scan_chunks(raw, scans, fill, workers=workers, disable_bar=disable_bar))
+
+    return TrailerTable.from_strings(scans, [labels[x] for x in index], values)
+
+
+def extract_segmented_scans(raw, scans, disable_bar, fields=None, dtype=float, workers=1):
 
     """
 
     :param raw:
     :param scans:
-    :return:
+    :param disable_bar:
+    :param fields: the segmented scan fields to extract (see SEGMENTED_FIELDS). Defaults to all of them.
+    :param dtype: storage dtype, either one dtype for all fields or a dict of dtypes keyed by field
+    :param workers: number of threads used to read the file
+    :return: a PeakStore with the requested fields
+    """
+
+    fields = select_fields(fields, SEGMENTED_FIELDS)
+
+    def fill(accessor, first, chunk, progress):
+
+        store = PeakStoreWriter(fields, n_scans=len(chunk), dtype=dtype)
+
+        for scan in chunk:
+
+            data = accessor.GetSegmentedScanFromScanNumber(int(scan), None)
+
+            start, stop = store.append(scan, data.PositionCount)
+
+            copyToNumpyArrays([getattr(data, x) for x in fields], [x[start:stop] for x in store.buffer])
+
+            progress.update()
+
+        return store.close()
+
+    return PeakStore.concatenate(map_scan_chunks(raw, scans, fill, workers=workers, disable_bar=disable_bar))
+
+
+def lazy_segmented_scans(raw, scans, fields=None, dtype=float, max_bytes=2 ** 28):
+
+    """
+    Like extract_segmented_scans, but each scan is read from the file when it is first requested and kept in a
+    cache of at most max_bytes.
+
+    :param raw:
+    :param scans:
+    :param fields: the segmented scan fields to extract (see SEGMENTED_FIELDS). Defaults to all of them.
+    :param dtype: storage dtype, either one dtype for all fields or a dict of dtypes keyed by field
+    :param max_bytes: size of the scan cache in bytes
+    :return: a LazyPeakStore with the requested fields
+    """
+
+    fields = select_fields(fields, SEGMENTED_FIELDS)
+    dtypes = field_dtypes(fields, dtype)
+
+    def read(scan):
+
+        data = raw.GetSegmentedScanFromScanNumber(int(scan), None)
+
+        buffer = allocate(dtypes, data.PositionCount)
+
+        copyToNumpyArrays([getattr(data, x) for x in fields], list(buffer))
+
+        return buffer
+
+    return LazyPeakStore(scans, fields, read, dtype=dtype, max_bytes=max_bytes)
+
+
+def extract_targeted_peaks(raw, scans, windows, disable_bar, source='LabelData', common=None, fields=None, dtype=float,
+                           workers=1):
+
     """
+    Extracts only the peaks which fall inside given m/z intervals. Every scan is read in full, but the peaks outside
+    the intervals are dropped before anything is stored.
+
+    :param raw:
+    :param scans: the scans to extract
+    :param windows: dict of (n, 2) arrays of (low, high) m/z intervals keyed by scan number. Peaks of a scan inside
+                    any of its intervals are kept.
+    :param disable_bar:
+    :param source: 'LabelData' for centroid streams or 'MassLists' for segmented scans
+    :param common: (n, 2) array of (low, high) m/z intervals applied to every scan
+    :param fields: the fields to extract (see CENTROID_FIELDS and SEGMENTED_FIELDS). Defaults to all of them.
+    :param dtype: storage dtype, either one dtype for all fields or a dict of dtypes keyed by field
+    :param workers: number of threads used to read the file
+    :return: a PeakStore with the requested fields
+    """
+
+    if source == 'LabelData':
+        fields = select_fields(fields, CENTROID_FIELDS)
+        mass_field = 'Masses'
+    elif source == 'MassLists':
+        fields = select_fields(fields, SEGMENTED_FIELDS)
+        mass_field = 'Positions'
+    else:
+        raise ValueError("source must be 'LabelData' or 'MassLists'")
+
+    # the masses are needed to select the peaks even if they are not stored
+    read_fields = fields if mass_field in fields else [mass_field] + fields
+    mass_index = read_fields.index(mass_field)
+    field_index = [read_fields.index(x) for x in fields]
+
+    common = merge_intervals(common if common is not None else [])
+    windows = dict((int(x), merge_intervals(y)) for x, y in windows.items())
+
+    def fill(accessor, first, chunk, progress):
+
+        store = PeakStoreWriter(fields, n_scans=len(chunk), dtype=dtype)
+
+        # each scan is read into this buffer first, and only the selected peaks are copied into the store
+        scratch = np.empty((len(read_fields), 4096))
+
+        for scan in chunk:
 
-    def get_out(raw, scan):
+            if source == 'LabelData':
+                data = accessor.GetCentroidStream(int(scan), None)
+                length = data.Length
+            else:
+                data = accessor.GetSegmentedScanFromScanNumber(int(scan), None)
+                length = data.PositionCount
 
-        '''
-        data = raw.GetSegmentedScanFromScanNumber(scan, None)
+            if length > scratch.shape[1]:
+                scratch = np.empty((len(read_fields), 2 * length))
 
-        out = np.empty((data.PositionCount, 2))
+            copyToNumpyArrays([getattr(data, x) for x in read_fields], list(scratch[:, :length]))
 
-        out[:, 0] = asNumpyArray(data.Positions)
-        out[:, 1] = asNumpyArray(data.Intensities)
-        '''
+            masses = scratch[mass_index, :length]
 
-        out = np.empty((raw.GetSegmentedScanFromScanNumber(scan, None).PositionCount, 2))
-        out[:, 0] = asNumpyArray(raw.GetSegmentedScanFromScanNumber(scan, None).Positions)
-        out[:, 1] = asNumpyArray(raw.GetSegmentedScanFromScanNumber(scan, None).Intensities)
+            keep = interval_mask(masses, *common)
 
-        return out
+            if int(scan) in windows:
+                keep |= interval_mask(masses, *windows[int(scan)])
 
-    return OD((str(x), get_out(raw, x)) for x in tqdm(scans, ncols=70, disable=disable_bar))
+            start, stop = store.append(scan, np.count_nonzero(keep))
+
+            for i in range(len(fields)):
+                store.buffer[i][start:stop] = scratch[field_index[i], :length][keep]
+
+            progress.update()
+
+        return store.close()
+
+    return PeakStore.concatenate(map_scan_chunks(raw, scans, fill, workers=workers, disable_bar=disable_bar))
+
+
+def extract_chromatograms(raw, ranges, disable_bar, chunk_size=250, scan_filter='ms'):
+
+    """
+    Reads the mass range chromatogram of each (low, high) m/z range from the raw file, asking for chunk_size of them
+    in each GetChromatogramData call. The chromatograms are yielded one at a time, so only one chunk is held in
+    memory.
+
+    :param raw: raw file accessor
+    :param ranges: (n, 2) array of the low and high mass of each chromatogram
+    :param chunk_size: the number of chromatograms read in one call
+    :param scan_filter: the scans to include, 'ms' for the MS1 scans
+    :return: generator of (scan numbers, retention times, intensities) arrays
+    """
+
+    if int(chunk_size) < 1:
+        raise ValueError('chunk_size must be an integer greater than zero.')
+
+    for start in tqdm(range(0, len(ranges), int(chunk_size)), ncols=70, disable=disable_bar):
+
+        settings = []
+
+        for low, high in ranges[start:start + int(chunk_size)]:
+            trace = Business.ChromatogramTraceSettings(Business.TraceType.MassRange)
+            trace.Filter = scan_filter
+            trace.MassRanges = [Business.Range(float(low), float(high))]
+            settings.append(trace)
+
+        # -1, -1: the whole run
+        data = raw.GetChromatogramData(settings, -1, -1)
+
+        for i in range(data.Length):
+            yield asNumpyArray(data.ScanNumbersArray[i]), asNumpyArray(data.PositionsArray[i]), \
+                asNumpyArray(data.IntensitiesArray[i])
 
 
 def extract_retention_times(raw, scans, disable_bar):
@@ -182,18 +573,15 @@ def extract_precursor_masses(raw, scans, disable_bar):
                                                                                                   disable=disable_bar))
 
 
-def get_mass_analyzer_type(raw, scan):
+def get_mass_analyzer_name(analyzer):
 
-    analyzer = raw.GetScanEventForScanNumber(scan).MassAnalyzerType
+    if analyzer not in MASS_ANALYZERS:
 
-    if analyzer == 0:
-        out = 'ITMS'
+        raise ValueError('Unknown mass analyzer type: {}'.format(analyzer))
 
-    elif analyzer == 4:
-        out = 'FTMS'
+    return MASS_ANALYZERS[analyzer]
 
-    else:
 
-        raise ValueError('Unknown mass analyzer type: {}'.format(analyzer))
+def get_mass_analyzer_type(raw, scan):
 
-    return out
+    return get_mass_analyzer_name(int(raw.GetScanEventForScanNumber(scan).MassAnalyzerType))
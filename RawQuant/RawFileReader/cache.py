@@ -0,0 +1,222 @@
+from collections import OrderedDict as OD
+from RawQuant.RawFileReader.peakstore import PeakStore, field_dtypes
+from RawQuant.RawFileReader.trailer import TrailerTable
+import numpy as np
+import hashlib
+import shutil
+import json
+import os
+
+'''
+On-disk cache of the data extracted from a raw file.
+
+Each raw file gets a directory, <raw file name>.<path hash>.rqcache, either next to the raw file or in a given cache
+directory. The hash of the absolute path of the raw file keeps files with the same name in different folders apart in
+a shared cache directory. It holds a manifest.json and one .npy file per array. Arrays are loaded as read-only memory
+maps, so a cached PeakStore or TrailerTable is available immediately and only the pages which are actually used are
+read from disk.
+
+The cache is tied to the raw file by its size, modification time and a hash of a few blocks of its content. If any
+of these change, the cache is cleared and rebuilt as data is extracted again.
+'''
+
+CACHE_VERSION = 1
+
+
+def file_key(path, block=2 ** 20):
+
+    """
+    Identifies a raw file by its size, modification time and a hash of its first, middle and last blocks.
+
+    :param path: the raw file
+    :param block: size of the hashed blocks in bytes
+    :return: dict
+    """
+
+    stat = os.stat(path)
+
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+
+        digest.update(f.read(block))
+
+        if stat.st_size > 3 * block:
+            f.seek(stat.st_size // 2)
+            digest.update(f.read(block))
+            f.seek(stat.st_size - block)
+            digest.update(f.read(block))
+
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': digest.hexdigest()}
+
+
+class ExtractionCache:
+
+    def __init__(self, raw_file, directory=None, refresh=False):
+
+        if directory is None:
+            directory = os.path.dirname(os.path.abspath(raw_file))
+
+        location = hashlib.sha1(os.path.abspath(raw_file).encode('utf-8')).hexdigest()[:8]
+
+        self.path = os.path.join(directory, os.path.basename(raw_file) + '.' + location + '.rqcache')
+        self.key = file_key(raw_file)
+
+        self.manifest = None
+
+        if (not refresh) and os.path.exists(os.path.join(self.path, 'manifest.json')):
+
+            with open(os.path.join(self.path, 'manifest.json')) as f:
+                manifest = json.load(f)
+
+            if (manifest.get('version') == CACHE_VERSION) and (manifest.get('key') == self.key):
+                self.manifest = manifest
+
+        # nothing usable in the cache, start it over
+        if self.manifest is None:
+            self.clear()
+
+    def clear(self):
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+        os.makedirs(self.path)
+
+        self.manifest = {'version': CACHE_VERSION, 'key': self.key, 'entries': {}}
+        self.write_manifest()
+
+    def write_manifest(self):
+
+        # written to a temporary file first, so an interrupted run can not leave a broken manifest
+        temp = os.path.join(self.path, 'manifest.json.tmp')
+
+        with open(temp, 'w') as f:
+            json.dump(self.manifest, f)
+
+        os.replace(temp, os.path.join(self.path, 'manifest.json'))
+
+    def __contains__(self, name):
+
+        return name in self.manifest['entries']
+
+    def save(self, name, arrays, meta=None):
+
+        """
+        Saves a set of named arrays and a dict of JSON-serializable metadata under an entry name.
+        """
+
+        files = {}
+
+        for key, array in arrays.items():
+            files[key] = '{}.{}.npy'.format(name, key)
+            np.save(os.path.join(self.path, files[key]), array, allow_pickle=False)
+
+        self.manifest['entries'][name] = {'files': files, 'meta': meta if meta is not None else {}}
+        self.write_manifest()
+
+    def load(self, name):
+
+        """
+        Returns the arrays of an entry, memory mapped read-only, and its metadata.
+        """
+
+        entry = self.manifest['entries'][name]
+
+        arrays = dict((key, np.load(os.path.join(self.path, file), mmap_mode='r', allow_pickle=False))
+                      for key, file in entry['files'].items())
+
+        return arrays, entry['meta']
+
+    def save_index(self, index, filters, header):
+
+        """
+        Saves the scan index made by extract_scan_index, the scan filters, and header information of the raw file
+        (e.g. instrument name and trailer extra labels).
+        """
+
+        self.save('index', OD((x, np.asarray(y)) for x, y in index.items()),
+                  meta={'columns': list(index.keys()), 'filters': filters, 'header': header})
+
+    def load_index(self):
+
+        arrays, meta = self.load('index')
+
+        index = OD((x, np.asarray(arrays[x])) for x in meta['columns'])
+
+        filters = [{'Filter': x['Filter'], 'MassRanges': [tuple(y) for y in x['MassRanges']]} for x in meta['filters']]
+
+        return index, filters, meta['header']
+
+    def save_peaks(self, name, store):
+
+        arrays = OD([('scans', store.scans), ('offsets', store.offsets)])
+
+        if store.uniform:
+            arrays['buffer'] = store.buffer
+        else:
+            for i in range(len(store.fields)):
+                arrays['buffer' + str(i)] = store.buffer[i]
+
+        self.save(name, arrays, meta={'fields': store.fields, 'uniform': store.uniform})
+
+    def load_peaks(self, name, fields, dtype=float):
+
+        """
+        Returns a cached PeakStore if it holds at least the given fields with the given storage dtypes, otherwise
+        returns None.
+        """
+
+        if name not in self:
+            return None
+
+        arrays, meta = self.load(name)
+
+        if meta['uniform']:
+            buffer = arrays['buffer']
+        else:
+            buffer = [arrays['buffer' + str(i)] for i in range(len(meta['fields']))]
+
+        store = PeakStore(scans=arrays['scans'], offsets=arrays['offsets'], buffer=buffer, fields=meta['fields'])
+
+        if not set(fields).issubset(store.fields):
+            return None
+
+        cached = store.dtypes
+
+        for field, wanted in field_dtypes(fields, dtype).items():
+            if cached[field] != wanted:
+                return None
+
+        return store
+
+    def save_trailer(self, name, table):
+
+        arrays = OD([('scans', table.scans), ('columns', table.columns), ('sps_offsets', table.sps_offsets),
+                     ('sps_masses', table.sps_masses)])
+
+        text = list(table.text.keys())
+
+        for i in range(len(text)):
+            arrays['text' + str(i)] = np.asarray(table.text[text[i]], dtype=str)
+
+        self.save(name, arrays, meta={'labels': table.labels, 'text': text})
+
+    def load_trailer(self, name, labels=()):
+
+        """
+        Returns a cached TrailerTable if it holds at least the given trailer labels, otherwise returns None.
+        """
+
+        if name not in self:
+            return None
+
+        arrays, meta = self.load(name)
+
+        if not set(labels).issubset(meta['labels']):
+            return None
+
+        text = OD((meta['text'][i], arrays['text' + str(i)]) for i in range(len(meta['text'])))
+
+        return TrailerTable(scans=arrays['scans'], labels=meta['labels'], columns=arrays['columns'],
+                            sps_offsets=arrays['sps_offsets'], sps_masses=arrays['sps_masses'], text=text)
@@ -35,11 +35,19 @@ _MAP_NET_NP = {
     'Boolean': np.dtype('bool'),
 }
 
-def asNumpyArray(netArray):
+def asNumpyArray(netArray, out=None):
     '''
     Given a CLR `System.Array` returns a `numpy.ndarray`.  See _MAP_NET_NP for
     the mapping of CLR types to Numpy dtypes.
+
+    If `out` is given, the values are copied into it instead of a newly
+    allocated array, so a buffer can be reused between calls. `out` must be
+    one-dimensional and have the same length as `netArray`.
     '''
+    if out is not None:
+        copyToNumpyArrays([netArray], [out])
+        return out
+
     dims = np.empty(netArray.Rank, dtype=int)
     for I in range(netArray.Rank):
         dims[I] = netArray.GetLength(I)
@@ -57,4 +65,48 @@ def asNumpyArray(netArray):
         ctypes.memmove(destPtr, sourcePtr, npArray.nbytes)
     finally:
         if sourceHandle.IsAllocated: sourceHandle.Free()
-    return npArray
\ No newline at end of file
+    return npArray
+
+def copyToNumpyArrays(netArrays, destinations):
+    '''
+    Copies several one-dimensional CLR `System.Array`s straight into
+    caller-supplied one-dimensional numpy arrays (e.g. slices of a
+    preallocated buffer). All source arrays are pinned once, copied, and
+    released together, and no intermediate arrays are allocated.
+
+    A destination with the same dtype as its source is filled with a memmove.
+    Otherwise the pinned memory is viewed as a numpy array of the source type
+    and converted while being copied into the destination.
+    '''
+    if len(netArrays) != len(destinations):
+        raise ValueError("copyToNumpyArrays needs one destination per source array")
+
+    handles = []
+    try:
+        for netArray in netArrays:
+            handles.append(GCHandle.Alloc(netArray, GCHandleType.Pinned))
+
+        for netArray, handle, dest in zip(netArrays, handles, destinations):
+            netType = netArray.GetType().GetElementType().Name
+
+            try:
+                netDtype = _MAP_NET_NP[netType]
+            except KeyError:
+                raise NotImplementedError("copyToNumpyArrays does not yet support System type {}".format(netType))
+
+            length = netArray.Length
+            if dest.shape != (length,):
+                raise ValueError("Destination shape {} does not match source length {}".format(dest.shape, length))
+            if length == 0:
+                continue
+
+            sourcePtr = handle.AddrOfPinnedObject().ToInt64()
+
+            if (dest.dtype == netDtype) and dest.flags['C_CONTIGUOUS']:
+                ctypes.memmove(dest.__array_interface__['data'][0], sourcePtr, length * netDtype.itemsize)
+            else:
+                source = (ctypes.c_char * (length * netDtype.itemsize)).from_address(sourcePtr)
+                dest[:] = np.frombuffer(source, dtype=netDtype, count=length)
+    finally:
+        for handle in handles:
+            if handle.IsAllocated: handle.Free()
@@ -0,0 +1,436 @@
+from collections.abc import Mapping
+from collections import OrderedDict as OD
+import numpy as np
+
+'''
+Flat storage for the peak lists of many scans.
+
+All peaks of one MS order are held in a single contiguous buffer with one row per field (e.g. Masses, Intensities,
+Resolutions...). The peaks of the i-th scan in `scans` occupy columns offsets[i] to offsets[i + 1] of that buffer,
+so a scan can be sliced out in constant time and whole-order numpy kernels can run on the buffer directly.
+
+When the fields are stored with different dtypes (e.g. float64 masses with float32 intensities) the buffer is a list
+of 1D arrays, one per field, instead of a 2D array. buffer[i] is the i-th field in both cases.
+
+PeakStore behaves like the OrderedDict of (n, fields) arrays keyed by str(scan) which RawQuant used previously,
+so code such as self.data['MS1LabelData'][str(scan)][:, 0] keeps working. Keys may be given as str or int.
+
+ScanArray holds one value per scan, e.g. the retention times or precursor masses, in the same way.
+
+LazyPeakStore has the same interface, but reads each scan from the raw file the first time it is requested and keeps
+it in a least recently used cache with a fixed byte budget.
+'''
+
+
+class ScanMapping(Mapping):
+
+    '''
+    Base class of the peak stores: maps scan numbers (str or int) to positions in self.scans.
+    '''
+
+    def __init__(self, scans):
+
+        self.scans = np.asarray(scans, dtype=np.int64)
+
+        # dense scan number -> position lookup, so finding a scan does not need a search
+        if len(self.scans) > 0:
+            self._first = int(self.scans.min())
+            self._lookup = np.full(int(self.scans.max()) - self._first + 1, -1, dtype=np.int64)
+            self._lookup[self.scans - self._first] = np.arange(len(self.scans))
+        else:
+            self._first = 0
+            self._lookup = np.empty(0, dtype=np.int64)
+
+    def position(self, scan):
+
+        i = int(scan) - self._first
+
+        if (i < 0) or (i >= len(self._lookup)) or (self._lookup[i] < 0):
+            raise KeyError(str(scan))
+
+        return self._lookup[i]
+
+    def positions(self, scans):
+
+        '''
+        Vectorized position(): returns the positions of an array of scan numbers.
+        '''
+
+        i = np.asarray(scans, dtype=np.int64) - self._first
+
+        valid = (i >= 0) & (i < len(self._lookup))
+        positions = np.full(len(i), -1, dtype=np.int64)
+        positions[valid] = self._lookup[i[valid]]
+
+        if np.any(positions < 0):
+            raise KeyError(str(np.asarray(scans)[positions < 0][0]))
+
+        return positions
+
+    def __contains__(self, scan):
+
+        try:
+            self.position(scan)
+        except (KeyError, ValueError, TypeError):
+            return False
+
+        return True
+
+    def __iter__(self):
+
+        return (str(x) for x in self.scans)
+
+    def __len__(self):
+
+        return len(self.scans)
+
+
+class ScanArray(ScanMapping):
+
+    '''
+    One value per scan, in an array aligned with self.scans. The values can have more than one dimension (e.g. an
+    (n, 2) array of start and end times) or a structured dtype (e.g. 'Picked' and 'Max' intensities), in which case
+    the row or record of a scan is returned.
+    '''
+
+    def __init__(self, scans, values):
+
+        super().__init__(scans)
+
+        self.array = np.asarray(values)
+
+        if len(self.array) != len(self.scans):
+            raise ValueError('values must have one element per scan')
+
+    @classmethod
+    def from_dict(cls, mapping, dtype=None):
+
+        return cls(np.fromiter((int(x) for x in mapping.keys()), dtype=np.int64, count=len(mapping)),
+                   np.array(list(mapping.values()), dtype=dtype))
+
+    def take(self, scans):
+
+        '''
+        Vectorized __getitem__: returns the values of an array of scan numbers.
+        '''
+
+        return self.array[self.positions(scans)]
+
+    def __getitem__(self, scan):
+
+        return self.array[self.position(scan)]
+
+
+class PeakStore(ScanMapping):
+
+    def __init__(self, scans, offsets, buffer, fields):
+
+        super().__init__(scans)
+
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.buffer = buffer
+        self.fields = list(fields)
+
+        if len(self.offsets) != len(self.scans) + 1:
+            raise ValueError('offsets must have one more element than scans')
+
+        if len(self.buffer) != len(self.fields):
+            raise ValueError('buffer must have one row per field')
+
+        # a 2D buffer lets a scan be returned as a view; separate columns of different dtypes have to be stacked
+        self.uniform = isinstance(self.buffer, np.ndarray)
+
+    def bounds(self, scan):
+
+        i = self.position(scan)
+
+        return self.offsets[i], self.offsets[i + 1]
+
+    def column(self, field, scan=None):
+
+        '''
+        Returns one field for all peaks in the store, or for the peaks of a single scan.
+        '''
+
+        values = self.buffer[self.fields.index(field)]
+
+        if scan is None:
+            return values
+
+        start, stop = self.bounds(scan)
+
+        return values[start:stop]
+
+    @property
+    def lengths(self):
+
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+
+        return sum(x.nbytes for x in self.buffer) + self.offsets.nbytes + self.scans.nbytes
+
+    @property
+    def dtypes(self):
+
+        return OD((x, y.dtype) for x, y in zip(self.fields, self.buffer))
+
+    def __getitem__(self, scan):
+
+        start, stop = self.bounds(scan)
+
+        if self.uniform:
+            return self.buffer[:, start:stop].T
+
+        return np.column_stack([x[start:stop] for x in self.buffer])
+
+    @classmethod
+    def concatenate(cls, stores):
+
+        '''
+        Joins stores holding consecutive scan ranges into one store. All stores must have the same fields.
+        '''
+
+        stores = list(stores)
+
+        if len(stores) == 1:
+            return stores[0]
+
+        fields = stores[0].fields
+        lengths = [x.offsets[-1] for x in stores]
+
+        buffer = allocate(stores[0].dtypes, sum(lengths))
+        offsets = [np.zeros(1, dtype=np.int64)]
+
+        position = 0
+        for store, length in zip(stores, lengths):
+            for i in range(len(fields)):
+                buffer[i][position:position + length] = store.buffer[i][:length]
+            offsets.append(store.offsets[1:] + position)
+            position += length
+
+        return cls(scans=np.concatenate([x.scans for x in stores]), offsets=np.concatenate(offsets), buffer=buffer,
+                   fields=fields)
+
+
+class LazyPeakStore(ScanMapping):
+
+    '''
+    Read-through store of the peak lists of many scans. read(scan) is called the first time a scan is requested and
+    must return its peaks in the layout made by allocate(self.dtypes, n). Scans are kept in a least recently used
+    cache, and the least recently used ones are dropped once the cached buffers take up more than max_bytes. Scans
+    which are never requested are never read.
+    '''
+
+    def __init__(self, scans, fields, read, dtype=float, max_bytes=2 ** 28):
+
+        super().__init__(scans)
+
+        self.fields = list(fields)
+        self.dtypes = field_dtypes(self.fields, dtype)
+        self.read = read
+        self.max_bytes = int(max_bytes)
+
+        self.cache = OD()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, scan):
+
+        '''
+        Returns the buffer of a scan, reading it if it is not in the cache.
+        '''
+
+        scan = int(self.scans[self.position(scan)])
+
+        if scan in self.cache:
+            self.cache.move_to_end(scan)
+            self.hits += 1
+            return self.cache[scan]
+
+        self.misses += 1
+
+        buffer = self.read(scan)
+        size = sum(x.nbytes for x in buffer)
+
+        self.cache[scan] = buffer
+        self.cached_bytes += size
+
+        # always keep the scan just read, even if it is larger than the budget on its own
+        while (self.cached_bytes > self.max_bytes) and (len(self.cache) > 1):
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_bytes -= sum(x.nbytes for x in evicted)
+
+        return buffer
+
+    def column(self, field, scan=None):
+
+        '''
+        Returns one field for the peaks of a single scan, or for all peaks if scan is None (this reads every scan).
+        '''
+
+        i = self.fields.index(field)
+
+        if scan is None:
+            return np.concatenate([self.load(x)[i] for x in self.scans])
+
+        return self.load(scan)[i]
+
+    def clear(self):
+
+        self.cache.clear()
+        self.cached_bytes = 0
+
+    @property
+    def nbytes(self):
+
+        return self.cached_bytes
+
+    def __getitem__(self, scan):
+
+        buffer = self.load(scan)
+
+        if isinstance(buffer, np.ndarray):
+            return buffer.T
+
+        return np.column_stack(buffer)
+
+
+class PeakStoreWriter:
+
+    '''
+    Builds a PeakStore one scan at a time. append() reserves space for the peaks of a scan and returns where
+    they go in self.buffer, which the caller then fills in place. The buffer grows geometrically, so the
+    number of reallocations is logarithmic in the number of peaks.
+    '''
+
+    def __init__(self, fields, n_scans, dtype=float, capacity=None):
+
+        self.fields = list(fields)
+        self.dtypes = field_dtypes(self.fields, dtype)
+        self.scans = np.empty(n_scans, dtype=np.int64)
+        self.offsets = np.zeros(n_scans + 1, dtype=np.int64)
+
+        if capacity is None:
+            capacity = max(n_scans * 128, 1024)
+
+        self.buffer = allocate(self.dtypes, capacity)
+        self.count = 0
+
+    def append(self, scan, length):
+
+        if self.count == len(self.scans):
+            self.scans = np.resize(self.scans, max(2 * len(self.scans), 16))
+            self.offsets = np.resize(self.offsets, len(self.scans) + 1)
+
+        start = self.offsets[self.count]
+        stop = start + length
+
+        if stop > len(self.buffer[0]):
+            buffer = allocate(self.dtypes, max(2 * len(self.buffer[0]), stop))
+            for i in range(len(self.fields)):
+                buffer[i][:start] = self.buffer[i][:start]
+            self.buffer = buffer
+
+        self.scans[self.count] = int(scan)
+        self.offsets[self.count + 1] = stop
+        self.count += 1
+
+        return start, stop
+
+    def close(self):
+
+        '''
+        Trims the buffers to size and returns the finished PeakStore.
+        '''
+
+        stop = self.offsets[self.count]
+
+        buffer = allocate(self.dtypes, stop)
+        for i in range(len(self.fields)):
+            buffer[i][:] = self.buffer[i][:stop]
+
+        return PeakStore(scans=self.scans[:self.count].copy(), offsets=self.offsets[:self.count + 1].copy(),
+                         buffer=buffer, fields=self.fields)
+
+
+def field_dtypes(fields, dtype=float):
+
+    """
+    Resolves the storage dtype of each field.
+
+    :param fields: list of field names
+    :param dtype: a single dtype for all fields, or a dict of dtypes keyed by field name. Fields missing from the
+                  dict are stored as float64.
+    :return: OrderedDict of numpy dtypes keyed by field name
+    """
+
+    if isinstance(dtype, dict):
+        return OD((x, np.dtype(dtype.get(x, float))) for x in fields)
+
+    return OD((x, np.dtype(dtype)) for x in fields)
+
+
+def allocate(dtypes, length):
+
+    """
+    Allocates a buffer for the given field dtypes: a 2D array if all fields share a dtype, otherwise a list of 1D
+    arrays.
+    """
+
+    dtypes = list(dtypes.values())
+
+    if len(set(dtypes)) == 1:
+        return np.empty((len(dtypes), length), dtype=dtypes[0])
+
+    return [np.empty(length, dtype=x) for x in dtypes]
+
+
+def merge_intervals(intervals):
+
+    """
+    Merges overlapping m/z intervals.
+
+    :param intervals: (n, 2) array-like of (low, high) intervals
+    :return: sorted arrays of the starts and stops of the disjoint merged intervals
+    """
+
+    intervals = np.asarray(intervals, dtype=float).reshape(-1, 2)
+
+    if len(intervals) == 0:
+        return np.empty(0), np.empty(0)
+
+    intervals = intervals[np.argsort(intervals[:, 0])]
+
+    lo = intervals[:, 0]
+    hi = np.maximum.accumulate(intervals[:, 1])
+
+    # an interval starts a new group if it begins after everything before it has ended
+    new = np.ones(len(lo), dtype=bool)
+    new[1:] = lo[1:] > hi[:-1]
+
+    first = np.flatnonzero(new)
+    last = np.append(first[1:] - 1, len(lo) - 1)
+
+    return lo[first], hi[last]
+
+
+def interval_mask(values, starts, stops):
+
+    """
+    Flags the values which fall inside any of a set of disjoint intervals (bounds included).
+
+    :param values: array of values, e.g. peak masses
+    :param starts: sorted interval starts, as returned by merge_intervals
+    :param stops: interval stops, as returned by merge_intervals
+    :return: boolean array
+    """
+
+    if len(starts) == 0:
+        return np.zeros(len(values), dtype=bool)
+
+    i = np.searchsorted(starts, values, side='right') - 1
+
+    return (i >= 0) & (values <= stops[np.maximum(i, 0)])
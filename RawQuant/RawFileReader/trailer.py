@@ -0,0 +1,202 @@
+from collections import OrderedDict as OD
+from RawQuant.RawFileReader.peakstore import ScanMapping
+import numpy as np
+
+'''
+Typed storage for the trailer extra data of many scans.
+
+The trailer extra values of a scan are read as strings in one call and parsed here into numpy columns: one structured
+array with a record per scan for the numeric values, a flat array of SPS masses with an offsets array (as in PeakStore),
+and object arrays for the values which are kept as text.
+
+TrailerTable behaves like the OrderedDict of OrderedDicts keyed by str(scan) which RawQuant used previously, so code
+such as self.data['MS2TrailerExtra'][str(scan)]['Charge State'] keeps working.
+'''
+
+# trailer labels parsed into numeric columns: label -> (column name, dtype, value if missing)
+NUMERIC_LABELS = OD([('Ion Injection Time (ms):', ('IonInjectionTime', np.float64, np.nan)),
+                     ('Master Scan Number:', ('MasterScanNumber', np.int64, -1)),
+                     ('Monoisotopic M/Z:', ('MonoisotopicMZ', np.float64, np.nan)),
+                     ('Charge State:', ('ChargeState', np.int64, 0))])
+
+# SPS masses are saved as two comma separated lists by newer firmware, and in individual fields by older firmware
+SPS_LIST_LABELS = ['SPS Masses:', 'SPS Masses Continued:']
+
+SPS_LABELS = ['SPS Mass {}:'.format(x) for x in range(1, 21)]
+
+
+class TrailerTable(ScanMapping):
+
+    def __init__(self, scans, labels, columns, sps_offsets, sps_masses, text):
+
+        super().__init__(scans)
+
+        # the trailer labels which were extracted, in the order of the raw file, without the trailing colon
+        self.labels = list(labels)
+        self.columns = columns
+        self.sps_offsets = np.asarray(sps_offsets, dtype=np.int64)
+        self.sps_masses = np.asarray(sps_masses, dtype=np.float64)
+        self.text = text
+
+        # the individual SPS mass fields present, in the order their masses are stored
+        self.sps_labels = [x for x in self.labels if x + ':' in SPS_LABELS]
+
+    @classmethod
+    def from_strings(cls, scans, labels, values):
+
+        """
+        Parses the trailer extra values of many scans.
+
+        :param scans: the scan numbers
+        :param labels: the trailer labels, including the trailing colon
+        :param values: (n scans, n labels) object array of the values as strings
+        :return: TrailerTable
+        """
+
+        scans = np.asarray(scans, dtype=np.int64)
+        labels = list(labels)
+        values = np.asarray(values, dtype=object).reshape(len(scans), len(labels))
+
+        dtype = [('ScanNum', np.int64)] + [(x[0], x[1]) for x in NUMERIC_LABELS.values()]
+        columns = np.zeros(len(scans), dtype=dtype)
+        columns['ScanNum'] = scans
+
+        for label, (name, kind, missing) in NUMERIC_LABELS.items():
+
+            if label in labels:
+                parsed = parse_numbers(values[:, labels.index(label)])
+            else:
+                parsed = np.full(len(scans), np.nan)
+
+            parsed[np.isnan(parsed)] = missing
+            columns[name] = parsed.astype(kind)
+
+        if SPS_LIST_LABELS[0] in labels:
+
+            first = values[:, labels.index(SPS_LIST_LABELS[0])]
+
+            if SPS_LIST_LABELS[1] in labels:
+                second = values[:, labels.index(SPS_LIST_LABELS[1])]
+            else:
+                second = [''] * len(scans)
+
+            # each list ends with a comma
+            sps = [[float(x) for x in str(a).split(',')[:-1] + str(b).split(',')[:-1]] for a, b in zip(first, second)]
+            lengths = [len(x) for x in sps]
+            sps_masses = np.array([x for y in sps for x in y], dtype=np.float64)
+
+        else:
+
+            index = [labels.index(x) for x in SPS_LABELS if x in labels]
+
+            # all of the individual fields are kept, including the empty (zero) ones
+            lengths = [len(index)] * len(scans)
+            sps_masses = np.column_stack([parse_numbers(values[:, x]) for x in index]).ravel() if len(index) > 0 \
+                else np.empty(0)
+
+        sps_offsets = np.append(0, np.cumsum(lengths)).astype(np.int64)
+
+        parsed = list(NUMERIC_LABELS.keys()) + SPS_LIST_LABELS + SPS_LABELS
+        text = OD((x[:-1], values[:, i]) for i, x in enumerate(labels) if x not in parsed)
+
+        return cls(scans=scans, labels=[x[:-1] for x in labels], columns=columns, sps_offsets=sps_offsets,
+                   sps_masses=sps_masses, text=text)
+
+    def column(self, name, scans=None):
+
+        '''
+        Returns a numeric column (e.g. 'IonInjectionTime') or text column (e.g. 'Multi Inject Info') for all scans,
+        or for the given scans.
+        '''
+
+        values = self.columns[name] if name in self.columns.dtype.names else self.text[name]
+
+        if scans is None:
+            return values
+
+        return values[self.positions(scans)]
+
+    def sps(self, scan):
+
+        '''
+        Returns the SPS masses of a scan.
+        '''
+
+        i = self.position(scan)
+
+        return self.sps_masses[self.sps_offsets[i]:self.sps_offsets[i + 1]]
+
+    def sps_matrix(self, scans=None):
+
+        '''
+        Returns the SPS masses of the given scans as a 2D array with one row per scan, padded with zeros to the
+        largest number of SPS masses.
+        '''
+
+        positions = np.arange(len(self.scans)) if scans is None else self.positions(scans)
+
+        starts = self.sps_offsets[positions]
+        lengths = self.sps_offsets[positions + 1] - starts
+
+        width = lengths.max() if len(lengths) > 0 else 0
+        matrix = np.zeros((len(positions), width))
+
+        rows = np.repeat(np.arange(len(positions)), lengths)
+        cols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        matrix[rows, cols] = self.sps_masses[np.repeat(starts, lengths) + cols]
+
+        return matrix
+
+    @property
+    def nbytes(self):
+
+        return self.columns.nbytes + self.sps_offsets.nbytes + self.sps_masses.nbytes
+
+    def __getitem__(self, scan):
+
+        i = self.position(scan)
+
+        out = OD()
+
+        for label in self.labels:
+
+            if label + ':' in NUMERIC_LABELS:
+                value = self.columns[NUMERIC_LABELS[label + ':'][0]][i]
+                out[label] = float(value) if NUMERIC_LABELS[label + ':'][1] == np.float64 else int(value)
+
+            elif label == 'SPS Masses':
+                out[label] = ''.join(repr(float(x)) + ',' for x in self.sps(scan))
+
+            elif label == 'SPS Masses Continued':
+                out[label] = ''
+
+            elif label in self.sps_labels:
+                out[label] = float(self.sps(scan)[self.sps_labels.index(label)])
+
+            else:
+                out[label] = self.text[label][i]
+
+        return out
+
+
+def parse_numbers(strings):
+
+    """
+    Parses an array of strings as floats. Empty or malformed values become NaN. The parsing is exact (values such
+    as the monoisotopic m/z are compared with peak masses later on).
+    """
+
+    strings = np.char.strip(np.asarray(strings, dtype=str))
+
+    try:
+        return strings.astype(np.float64)
+
+    except ValueError:
+
+        def parse(x):
+            try:
+                return float(x)
+            except ValueError:
+                return np.nan
+
+        return np.array([parse(x) for x in strings], dtype=np.float64)
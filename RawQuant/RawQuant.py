@@ -2,9 +2,19 @@ import pandas as pd
 import numpy as np
 from tqdm import tqdm
 from collections import OrderedDict as OD
+import copy
+import os
+import shutil
 from re import findall, IGNORECASE
 import sys
 import RawQuant.RawFileReader.RawFileReader as RawFileReader
+from RawQuant.RawFileReader.cache import ExtractionCache
+from RawQuant.RawFileReader.peakstore import ScanArray
+from RawQuant.interference import centroid_interference, profile_interference, correlate_interferences, ion_misses, \
+    window_intervals
+from RawQuant.parallel import compute, compute_precursor_peaks, process_pool, shard_ranges, merge_shards
+from RawQuant.precursors import link_precursors, chromatogram_peaks, trace_masses, XICIndex
+from RawQuant.quant import ReporterTable, quantify_reporters, reporter_band, correct_impurities, match_sps_ions
 
 '''
 RawQuant provides hassle-free extraction of quantification information
@@ -23,10 +33,52 @@ provided for this usage.
 
 class RawQuant:
 
-    def __init__(self, RawFile, order='auto', disable_bar=False, boxcar=False, isolationOffset=None):
+    def __init__(self, RawFile, order='auto', disable_bar=False, boxcar=False, isolationOffset=None, ms1_dtype=float,
+                 workers=1, ms1_mode='full', ms1_cache_bytes=2 ** 28, cache=None, refresh_cache=False,
+                 precursor_backend='xic', chromatogram_chunk_size=250, share_chromatograms=True, processes=1):
 
         self.disable_bar = disable_bar
 
+        # number of threads used to read data from the raw file
+        if int(workers) < 1:
+            raise ValueError('workers must be an integer greater than zero.')
+
+        self.workers = int(workers)
+
+        # number of processes used for the interference, precursor peak and reporter ion calculations, which run on
+        # the extracted data. see RawQuant.parallel
+        if int(processes) < 1:
+            raise ValueError('processes must be an integer greater than zero.')
+
+        self.processes = int(processes)
+
+        # storage dtype of the MS1 spectra extracted for interference and precursor peak calculations. Either one
+        # dtype or a dict of dtypes by field, e.g. {'Masses': np.float64, 'Intensities': np.float32}
+        self.ms1_dtype = ms1_dtype
+
+        # how the MS1 spectra for interference and precursor peak calculations are held. 'full' extracts all of them
+        # up front, 'lazy' reads each one when it is first needed and caches up to ms1_cache_bytes of them, and
+        # 'targeted' only keeps the peaks in the precursor isolation windows and around the trigger masses
+        if ms1_mode not in ['full', 'lazy', 'targeted']:
+            raise ValueError("ms1_mode must be 'full', 'lazy' or 'targeted'")
+
+        self.ms1_mode = ms1_mode
+        self.ms1_cache_bytes = int(ms1_cache_bytes)
+
+        # how MS2PrecursorPeaks finds the precursor chromatograms. 'xic' builds them from the MS1 spectra, 'chromatogram'
+        # reads them from the raw file chromatogram_chunk_size at a time, so the MS1 spectra are not needed
+        if precursor_backend not in ['xic', 'chromatogram']:
+            raise ValueError("precursor_backend must be 'xic' or 'chromatogram'")
+
+        if int(chromatogram_chunk_size) < 1:
+            raise ValueError('chromatogram_chunk_size must be an integer greater than zero.')
+
+        self.precursor_backend = precursor_backend
+        self.chromatogram_chunk_size = int(chromatogram_chunk_size)
+
+        # whether repeatedly sampled precursors share a chromatogram in MS2PrecursorPeaks
+        self.share_chromatograms = bool(share_chromatograms)
+
         # check that 'order' is the correct type
         if type(order) == str:
 
@@ -51,20 +103,40 @@ class RawQuant:
 
         print('Opening ' + RawFile + ' and initializing')
 
-        self.raw = RawFileReader.open_raw_file(RawFile)
-
-        self.raw.SelectInstrument(0, 1)
+        # the raw file itself is only opened once something has to be read from it (see RawQuant.raw), so a run
+        # which is served entirely from the cache never opens it
+        self._raw = None
 
         self.open = True
 
-        self.info = pd.DataFrame(columns=['ScanNum', 'MSOrder'],
-                                 index=range(self.raw.RunHeaderEx.FirstSpectrum,
-                                             self.raw.RunHeaderEx.LastSpectrum + 1))
+        # on-disk cache of extracted data. None: no cache, '': next to the raw file, otherwise a directory
+        if cache is not None:
+            self.cache = ExtractionCache(RawFile, directory=cache if cache != '' else None, refresh=refresh_cache)
+        else:
+            self.cache = None
+
+        if (self.cache is not None) and ('index' in self.cache):
+
+            print(self.RawFile + ': Loading scan index from cache')
+
+            index, self.ScanFilters, header = self.cache.load_index()
 
-        self.info['ScanNum'] = range(self.raw.RunHeaderEx.FirstSpectrum,
-                                     self.raw.RunHeaderEx.LastSpectrum + 1)
+        else:
+
+            # read the header of every scan in a single pass. Scan orders, analyzers, retention times, precursor
+            # masses, etc. are looked up in this index from here on rather than being requested from the raw file
+            # again
+            print(self.RawFile + ': Indexing scans')
+
+            index, self.ScanFilters = RawFileReader.extract_scan_index(self.raw, disable_bar=self.disable_bar,
+                                                                       workers=self.workers)
+
+            header = RawFileReader.read_header(self.raw)
 
-        self.info['MSOrder'] = self.info['ScanNum'].apply(lambda x: self.raw.GetScanEventForScanNumber(x).MsOrder)
+            if self.cache is not None:
+                self.cache.save_index(index, self.ScanFilters, header)
+
+        self.info = pd.DataFrame(index, index=index['ScanNum'])
 
         # create a dictionary to contain metadata
         self.MetaData = {}
@@ -76,7 +148,11 @@ class RawQuant:
             self.MetaData['AnalysisOrder'] = int(order)
 
         # get the instrument name and see if it is an Exactive
-        self.MetaData['InstName'] = self.raw.GetInstrumentData().Name
+        self.MetaData['InstName'] = header['InstName']
+
+        # start and end of the run (min)
+        self.MetaData['StartTime'] = header['StartTime']
+        self.MetaData['EndTime'] = header['EndTime']
 
         # set the data filename
         self.MetaData['DataFile'] = RawFile
@@ -92,18 +168,16 @@ class RawQuant:
         self.MetaData['AnalyzerTypes'] = {}
         for order in range(1, self.MetaData['AnalysisOrder'] + 1):
             self.MetaData['AnalyzerTypes'][str(order)] =\
-                RawFileReader.get_mass_analyzer_type(self.raw, self.info.loc[self.info['MSOrder'] == order,
-                                                                             'ScanNum'].iloc[0])
+                RawFileReader.get_mass_analyzer_name(self.info.loc[self.info['MSOrder'] == order, 'Analyzer'].iloc[0])
 
         # find out of the data is centroid by looking at the first scan of each MS order
         self.MetaData['Centroid'] = {}
         for order in range(1, self.MetaData['AnalysisOrder'] + 1):
-            self.MetaData['Centroid'][str(order)] = self.raw.GetScanStatsForScanNumber(
-                self.info.loc[self.info['MSOrder'] == order, 'ScanNum'].iloc[0]).IsCentroidScan
+            self.MetaData['Centroid'][str(order)] = bool(self.info.loc[self.info['MSOrder'] == order,
+                                                                       'Centroid'].iloc[0])
 
         # Get the isolation width for MS2
-        self.MetaData['IsolationWidth'] = self.raw.GetFilterForScanNumber(self.info.loc[self.info['MSOrder'] == 2,
-                                                                          'ScanNum'].iloc[0]).GetIsolationWidth(0)
+        self.MetaData['IsolationWidth'] = self.info.loc[self.info['MSOrder'] == 2, 'IsolationWidth'].iloc[0]
 
         # create an empty dictionary for data storage
         self.data = {}
@@ -119,6 +193,7 @@ class RawQuant:
             'MS1MassLists': False, 'MS1LabelData': False,
             'MS2MassLists': False, 'MS2LabelData': False,
             'MS3MassLists': False, 'MS3LabelData': False,
+            'MS1WindowMassLists': False, 'MS1WindowLabelData': False,
             'MS1TrailerExtra': False, 'MS2TrailerExtra': False, 'MS3TrailerExtra': False,
             'PrecursorMass': False,
             'MS1RetentionTime': False, 'MS2RetentionTime': False,
@@ -129,16 +204,14 @@ class RawQuant:
             'QuantMatrix': False, 'MS1Parse': False, 'MS2Parse': False, 'MS3Parse': False,
             'ImpurityMatrix': False, 'CorrectionMatrix': False, 'ImpuritiesCorrected': False,
             'PrecursorPeaks': False, 'BoxCar': False, 'MassRangeFillTimes': False, 'NoMonoisotopicMass': False,
-            'TriggerMass': False
+            'TriggerMass': False, 'Streamed': False, 'SPSIons': False
         }
 
         # Check if the trailer extra data contains master scan numbers
 
-        test = self.raw.GetTrailerExtraHeaderInformation()
+        self.MetaData['TrailerLabels'] = header['TrailerLabels']
 
-        labels = [test[x].Label for x in range(test.Length)]
-
-        if 'Master Scan Number:' in labels:
+        if 'Master Scan Number:' in header['TrailerLabels']:
             self.flags['MasterScanNumber'] = True
 
         if isolationOffset is not None:
@@ -150,6 +223,18 @@ class RawQuant:
 
         self.Initialized = True
 
+    @property
+    def raw(self):
+
+        if not self.open:
+            raise Exception(self.RawFile + ' is not accessible. Reopen the file')
+
+        if self._raw is None:
+            self._raw = RawFileReader.open_raw_file(self.RawFile)
+            self._raw.SelectInstrument(0, 1)
+
+        return self._raw
+
     def SetAsBoxcar(self):
 
         self.flags['BoxCar'] = True
@@ -158,11 +243,32 @@ class RawQuant:
 
         self.data['CustomReporters'] = pd.read_csv(reporters)
 
-    def ExtractMSData(self, order, dtype):
+    def MSDataAvailable(self, order, dtype, fields=None):
+
+        '''
+        Checks whether MS data of the given order and type has been extracted with at least the requested fields.
+        '''
+
+        if not self.flags['MS' + str(order) + dtype]:
+            return False
+
+        if fields is None:
+            fields = RawFileReader.CENTROID_FIELDS if dtype == 'LabelData' else RawFileReader.SEGMENTED_FIELDS
+
+        return set(fields).issubset(self.data['MS' + str(order) + dtype].fields)
+
+    def ExtractMSData(self, order, dtype, fields=None, storage_dtype=float, lazy=False, max_bytes=2 ** 28):
 
         '''
         Extracts mass lists using the GetMassListFromScanNum and GetLabelData
         functions.
+
+        fields, list: the fields to extract. Defaults to all fields (see RawFileReader.CENTROID_FIELDS and
+                    RawFileReader.SEGMENTED_FIELDS).
+        storage_dtype: the dtype the data is stored as. Either one dtype for all fields or a dict of dtypes keyed
+                    by field. Defaults to float64.
+        lazy, bool: if True nothing is extracted yet. Scans are read from the file when they are first accessed
+                    and the most recently used ones are cached, up to max_bytes.
         '''
 
         if self.open == False:
@@ -181,22 +287,145 @@ class RawQuant:
         if order < 1:
             raise ValueError('order must be a positive integer greater than 0')
 
-        print(self.RawFile + ': Extracting MS' + str(order) + dtype)
-
         scans = self.info.loc[self.info['MSOrder'] == order, 'ScanNum']
 
+        if lazy:
+
+            if dtype == 'MassLists':
+                self.data['MS' + str(order) + dtype] = RawFileReader.lazy_segmented_scans(raw=self.raw, scans=scans,
+                                                                                          fields=fields,
+                                                                                          dtype=storage_dtype,
+                                                                                          max_bytes=max_bytes)
+            else:
+                self.data['MS' + str(order) + dtype] = RawFileReader.lazy_centroid_streams(raw=self.raw, scans=scans,
+                                                                                           fields=fields,
+                                                                                           dtype=storage_dtype,
+                                                                                           max_bytes=max_bytes)
+
+            self.flags['MS' + str(order) + dtype] = True
+
+            return
+
+        if self.cache is not None:
+
+            available = RawFileReader.SEGMENTED_FIELDS if dtype == 'MassLists' else RawFileReader.CENTROID_FIELDS
+
+            store = self.cache.load_peaks('MS' + str(order) + dtype, RawFileReader.select_fields(fields, available),
+                                          storage_dtype)
+
+            if store is not None:
+                print(self.RawFile + ': Loading MS' + str(order) + dtype + ' from cache')
+                self.data['MS' + str(order) + dtype] = store
+                self.flags['MS' + str(order) + dtype] = True
+                return
+
+        print(self.RawFile + ': Extracting MS' + str(order) + dtype)
+
         if dtype == 'MassLists':
 
             self.data['MS' + str(order) + dtype] = RawFileReader.extract_segmented_scans(raw=self.raw, scans=scans,
-                                                                                         disable_bar=self.disable_bar)
+                                                                                         disable_bar=self.disable_bar,
+                                                                                         fields=fields,
+                                                                                         dtype=storage_dtype,
+                                                                                         workers=self.workers)
 
         elif dtype == 'LabelData':
 
             self.data['MS' + str(order) + dtype] = RawFileReader.extract_centroid_streams(raw=self.raw, scans=scans,
-                                                                                          disable_bar=self.disable_bar)
+                                                                                          disable_bar=self.disable_bar,
+                                                                                          fields=fields,
+                                                                                          dtype=storage_dtype,
+                                                                                          workers=self.workers)
+
+        if self.cache is not None:
+            self.cache.save_peaks('MS' + str(order) + dtype, self.data['MS' + str(order) + dtype])
 
         self.flags['MS' + str(order) + dtype] = True
 
+    def PrepareMS1Data(self, dtype, fields=None):
+
+        '''
+        Makes MS1 data with the given fields available in self.data for interference and precursor peak
+        calculations, according to self.ms1_mode.
+        '''
+
+        if self.MSDataAvailable(1, dtype, fields):
+            return
+
+        if self.ms1_mode == 'targeted':
+            self.ExtractTargetedMS1Data(dtype, fields)
+            return
+
+        self.ExtractMSData(1, dtype, fields=fields, storage_dtype=self.ms1_dtype, lazy=self.ms1_mode == 'lazy',
+                           max_bytes=self.ms1_cache_bytes)
+
+    def ExtractTargetedMS1Data(self, dtype, fields=None):
+
+        '''
+        Extracts only the MS1 peaks used by QuantifyInterference and MS2PrecursorPeaks: the peaks inside the
+        isolation window of each MS2 scan in its precursor MS1 scan, and the peaks within 4 ppm of any trigger mass
+        in every MS1 scan. Other peaks are dropped as the scans are read.
+        '''
+
+        if self.open == False:
+            raise Exception(self.RawFile + ' is not accessible. Reopen the file')
+
+        if self.flags['PrecursorMass'] == False:
+            self.ExtractPrecursorMass()
+
+        if self.flags['MS2PrecursorScan'] == False:
+            self.ExtractPrecursorScans()
+
+        if self.flags['TriggerMass'] == False:
+            self.ExtractTriggerMass()
+
+        MS2scans = self.info.loc[self.info['MSOrder'] == 2, 'ScanNum']
+
+        precScans = self.data['MS2PrecursorScan'].take(MS2scans)
+        precMasses = self.data['PrecursorMass'].take(MS2scans)
+        triggerMasses = self.data['TriggerMass'].take(MS2scans)
+
+        # isolation windows, in the MS1 scan each precursor was selected from
+        windows = window_intervals(precScans, precMasses, self.MetaData['IsolationWidth'])
+
+        # trigger mass traces, in every MS1 scan. slightly wider than the 4 ppm used in MS2PrecursorPeaks so
+        # rounding can not drop a peak at the edge
+        tolerance = triggerMasses * 4.01 * 10 ** -6
+        common = np.column_stack((triggerMasses - tolerance, triggerMasses + tolerance))
+
+        print(self.RawFile + ': Extracting targeted MS1' + dtype)
+
+        self.data['MS1' + dtype] = RawFileReader.extract_targeted_peaks(raw=self.raw,
+                                                                       scans=self.info.loc[self.info['MSOrder'] == 1,
+                                                                                           'ScanNum'],
+                                                                       windows=windows,
+                                                                       disable_bar=self.disable_bar,
+                                                                       source=dtype,
+                                                                       common=common,
+                                                                       fields=fields,
+                                                                       dtype=self.ms1_dtype,
+                                                                       workers=self.workers)
+
+        self.flags['MS1' + dtype] = True
+
+    def ExtractReporterRegion(self, order, dtype, band, fields=None):
+
+        '''
+        Extracts only the peaks in an m/z band (e.g. the reporter ions) of the MSn scans, into
+        self.data['MS<order>Reporter<dtype>']. Other peaks are dropped as the scans are read.
+
+        band, tuple: (low, high) m/z band to keep
+        '''
+
+        if self.open == False:
+            raise Exception(self.RawFile + ' is not accessible. Reopen the file')
+
+        print(self.RawFile + ': Extracting MS' + str(order) + dtype + ' reporter ion region')
+
+        self.data['MS' + str(order) + 'Reporter' + dtype] = RawFileReader.extract_targeted_peaks(
+            raw=self.raw, scans=self.info.loc[self.info['MSOrder'] == order, 'ScanNum'], windows={},
+            disable_bar=self.disable_bar, source=dtype, common=[band], fields=fields, workers=self.workers)
+
     def ExtractTrailerExtra(self, order):
 
         '''
@@ -214,11 +443,31 @@ class RawQuant:
 
         scans = self.info.loc[self.info['MSOrder'] == order, 'ScanNum']
 
+        if self.cache is not None:
+
+            # boxcar experiments also need the multi-inject data, if the file has it
+            if self.flags['BoxCar'] and ('Multi Inject Info:' in self.MetaData['TrailerLabels']):
+                labels = ['Multi Inject Info']
+            else:
+                labels = []
+
+            table = self.cache.load_trailer('MS' + str(order) + 'TrailerExtra', labels)
+
+            if table is not None:
+                print(self.RawFile + ': Loading MS' + str(order) + 'TrailerExtra from cache')
+                self.data['MS' + str(order) + 'TrailerExtra'] = table
+                self.flags['MS' + str(order) + 'TrailerExtra'] = True
+                return
+
         # Extract meta data using the GetTrailerExtraForScanNum function
         print(self.RawFile + ': Extracting MS' + str(order) + 'TrailerExtra')
         self.data['MS' + str(order) + 'TrailerExtra'] = RawFileReader.extract_trailer_extras(raw=self.raw, scans=scans,
                                                                                              boxcar=self.flags['BoxCar'],
-                                                                                             disable_bar=self.disable_bar)
+                                                                                             disable_bar=self.disable_bar,
+                                                                                             workers=self.workers)
+
+        if self.cache is not None:
+            self.cache.save_trailer('MS' + str(order) + 'TrailerExtra', self.data['MS' + str(order) + 'TrailerExtra'])
 
         self.flags['MS' + str(order) + 'TrailerExtra'] = True
 
@@ -237,16 +486,16 @@ class RawQuant:
 
         scans = self.info.loc[(self.info['MSOrder'] == 2), 'ScanNum']
 
-        masses = OD((str(x), self.data['MS2TrailerExtra'][str(x)]['Monoisotopic M/Z']) for x in scans)
+        masses = self.data['MS2TrailerExtra'].column('MonoisotopicMZ', scans)
 
-        if 0 in masses.values():
+        # the flag may already be set for the whole file, e.g. in the shards of ShardQuant
+        if self.flags['NoMonoisotopicMass'] | np.any(masses == 0):
 
             self.flags['NoMonoisotopicMass'] = True
 
-            masses = OD((str(x), self.raw.GetScanEventForScanNumber(x).Reactions[0].PrecursorMass -
-                         self.MetaData['Offset']) for x in scans)
+            masses = self.info.loc[(self.info['MSOrder'] == 2), 'PrecursorMass'].values - self.MetaData['Offset']
 
-        self.data['PrecursorMass'] = masses
+        self.data['PrecursorMass'] = ScanArray(scans, masses)
 
         self.flags['PrecursorMass'] = True
 
@@ -262,12 +511,11 @@ class RawQuant:
             self.data['TriggerMass'] = self.data['PrecursorMass']
             return
 
-        scans = self.info.loc[(self.info['MSOrder'] == 2), 'ScanNum']
+        scans = self.info.loc[(self.info['MSOrder'] == 2), ['ScanNum', 'PrecursorMass']]
 
         print(self.RawFile + ': Extracting parent peak masses')
 
-        self.data['TriggerMass'] = OD((str(x), self.raw.GetScanEventForScanNumber(x).Reactions[0].PrecursorMass -
-                                       self.MetaData['Offset']) for x in scans)
+        self.data['TriggerMass'] = ScanArray(scans['ScanNum'], scans['PrecursorMass'].values - self.MetaData['Offset'])
 
         self.flags['TriggerMass'] = True
 
@@ -285,15 +533,13 @@ class RawQuant:
 
         print(self.RawFile + ': Extracting MS' + str(order) + ' retention times')
 
-        scans = self.info.loc[self.info['MSOrder'] == order, 'ScanNum']
+        scans = self.info.loc[self.info['MSOrder'] == order, ['ScanNum', 'RetentionTime']]
 
-        self.data['MS' + str(order) + 'RetentionTime'] = RawFileReader.extract_retention_times(self.raw, scans=scans,
-                                                                                               disable_bar=
-                                                                                               self.disable_bar)
+        self.data['MS' + str(order) + 'RetentionTime'] = ScanArray(scans['ScanNum'], scans['RetentionTime'])
 
         self.flags['MS' + str(order) + 'RetentionTime'] = True
 
-    def ExtractPrecursorScans(self):
+    def ExtractPrecursorScans(self, validate=False):
 
         if self.open == False:
             raise Exception(self.RawFile + ' is not accessible. Reopen the file')
@@ -314,33 +560,15 @@ class RawQuant:
 
                     self.ExtractTrailerExtra(order=order)
 
-            if self.MetaData['AnalysisOrder'] == 2:
+            # the trailer extra of each MSn scan holds the scan number of its MS(n-1) scan
+            for order in range(2, self.MetaData['AnalysisOrder'] + 1):
 
-                MS1scans = OD((str(x), int(self.data['MS2TrailerExtra'] \
-                                               [str(x)]['Master Scan Number'])) for x in
-                              self.info.loc[self.info['MSOrder'] == 2, 'ScanNum'])
+                scans = self.info.loc[self.info['MSOrder'] == order, 'ScanNum']
 
-                self.data['MS2PrecursorScan'] = MS1scans
+                self.data['MS' + str(order) + 'PrecursorScan'] = ScanArray(scans, self.data[
+                    'MS' + str(order) + 'TrailerExtra'].column('MasterScanNumber', scans))
 
-                self.flags['MS2PrecursorScan'] = True
-
-            elif self.MetaData['AnalysisOrder'] == 3:
-
-                MS2scans = OD((str(x), int(self.data['MS3TrailerExtra'] \
-                                               [str(x)]['Master Scan Number'])) for x in
-                              self.info.loc[self.info['MSOrder'] == 3, 'ScanNum'])
-
-                MS1scans = OD((str(x), int(self.data['MS2TrailerExtra'] \
-                                               [str(x)]['Master Scan Number'])) for x in
-                              self.info.loc[self.info['MSOrder'] == 2, 'ScanNum'])
-
-                self.data['MS2PrecursorScan'] = MS1scans
-
-                self.flags['MS2PrecursorScan'] = True
-
-                self.data['MS3PrecursorScan'] = MS2scans
-
-                self.flags['MS3PrecursorScan'] = True
+                self.flags['MS' + str(order) + 'PrecursorScan'] = True
 
         # if the trailer extra data does not contain Master Scan Number, the
         # precursror scans must be inferred from the MS orders of the scan list
@@ -348,43 +576,22 @@ class RawQuant:
 
             print(self.RawFile + ': Correlating scan events')
 
-            if self.MetaData['AnalysisOrder'] == 2:
-
-                MS1scans = OD()
+            # each scan's precursor is the last scan of the order below before it. from MS3 on, the link can be
+            # checked against the trigger mass of the parent, which is also the first precursor mass of the scan
+            for order in range(2, self.MetaData['AnalysisOrder'] + 1):
 
-                PrecScans = self.info[(self.info['MSOrder'] == 1)].values
+                scans = self.info.loc[self.info['MSOrder'] == order, ['ScanNum', 'PrecursorMass']]
+                parents = self.info.loc[self.info['MSOrder'] == order - 1, ['ScanNum', 'PrecursorMass']]
 
-                for i in tqdm(self.info.loc[self.info['MSOrder'] == 2, 'ScanNum'], ncols=70, disable=self.disable_bar):
-                    MS1scans[str(i)] = PrecScans[PrecScans[:, 0] < i, 0].max()
-
-                self.data['MS2PrecursorScan'] = MS1scans
-
-                self.flags['MS2PrecursorScan'] = True
-
-            if self.MetaData['AnalysisOrder'] == 3:
-
-                MS1scans = OD()
-                MS2scans = OD()
-
-                PrecScans = self.info[(self.info['MSOrder'] == 2)].values
-
-                for i in tqdm(self.info.loc[self.info['MSOrder'] == 3, 'ScanNum'], ncols=70, desc='MS3 precursors',
-                              disable=self.disable_bar):
-                    MS2scans[str(i)] = PrecScans[PrecScans[:, 0] < i, 0].max()
-
-                PrecScans = self.info[(self.info['MSOrder'] == 1)].values
-
-                for i in tqdm(self.info.loc[self.info['MSOrder'] == 2, 'ScanNum'], ncols=70, desc='MS2 precursors',
-                              disable=self.disable_bar):
-                    MS1scans[str(i)] = PrecScans[PrecScans[:, 0] < i, 0].max()
-
-                self.data['MS2PrecursorScan'] = MS1scans
-
-                self.flags['MS2PrecursorScan'] = True
+                if validate and (order > 2):
+                    PrecScans = link_precursors(scans['ScanNum'].values, parents['ScanNum'].values,
+                                                scans['PrecursorMass'].values, parents['PrecursorMass'].values)
+                else:
+                    PrecScans = link_precursors(scans['ScanNum'].values, parents['ScanNum'].values)
 
-                self.data['MS3PrecursorScan'] = MS2scans
+                self.data['MS' + str(order) + 'PrecursorScan'] = ScanArray(scans['ScanNum'].values, PrecScans)
 
-                self.flags['MS3PrecursorScan'] = True
+                self.flags['MS' + str(order) + 'PrecursorScan'] = True
 
     def ExtractPrecursorCharge(self):
 
@@ -399,39 +606,65 @@ class RawQuant:
 
         print(self.RawFile + ':Extracting precursor charges')
 
-        self.data['PrecursorCharge'] = OD((str(x), int(self.data['MS2TrailerExtra'][str(x)]['Charge State']))
-                                          for x in self.info.loc[self.info['MSOrder'] == 2, 'ScanNum'])
+        scans = self.info.loc[self.info['MSOrder'] == 2, 'ScanNum']
+
+        self.data['PrecursorCharge'] = ScanArray(scans, self.data['MS2TrailerExtra'].column('ChargeState', scans))
 
         self.flags['PrecursorCharge'] = True
 
+    def MassRangeKeys(self):
+
+        '''
+        Returns the boxcar fill time column names of the mass ranges of each scan filter of the MS1 scans, keyed by
+        filter ID in the order the filters first appear, and the names of all columns in the order they first appear.
+        Only the scan filters are read, not the trailer extra data.
+        '''
+
+        filters = self.info.loc[self.info['MSOrder'] == 1, 'FilterID'].values
+
+        _, first = np.unique(filters, return_index=True)
+        keys = OD()
+
+        for ID in filters[np.sort(first)]:
+            ranges = self.ScanFilters[ID]['MassRanges']
+            keys[ID] = ['MassRange[' + str(x[0]) + '-' + str(x[1]) + ']FillTime' for x in ranges]
+
+        return keys, list(OD.fromkeys(y for x in keys.values() for y in x))
+
     def ExtractMassRangeFillTimes(self):
 
         if not self.flags['MS1TrailerExtra']:
 
             self.ExtractTrailerExtra(1)
 
-        def get_out(scan):
-            ranges = self.raw.GetScanEventForScanNumber(scan).MassRanges
+        print(self.RawFile + ': Extracting boxcar mass ranges and fill times')
+
+        scans = self.info.loc[self.info['MSOrder'] == 1, 'ScanNum'].values
+        filters = self.info.loc[scans, 'FilterID'].values
+        texts = self.data['MS1TrailerExtra'].column('Multi Inject Info', scans)
 
-            keys = ['MassRange[' + str(x.LowMass) + '-' + str(x.HighMass) + ']FillTime' for x in ranges]
+        # one column per distinct mass range, in the order the ranges first appear. the scans sharing a scan filter
+        # share their mass ranges, so the fill times are parsed one filter at a time
+        keys, names = self.MassRangeKeys()
 
-            print(keys)
+        # scans without a mass range are left as NaN
+        table = np.full(len(scans), np.nan, dtype=[(x, np.float64) for x in names])
 
-            fill_times = self.data['MS1TrailerExtra'][str(scan)]['Multi Inject Info'][3:].split(',')
+        for ID, ranges in keys.items():
 
-            print(fill_times)
+            rows = np.flatnonzero(filters == ID)
 
-            return OD((keys[x], fill_times[x]) for x in range(len(keys)))
+            # the Multi Inject Info text starts with a three character prefix, followed by the fill time of each range
+            fill_times = np.array([x[3:].split(',')[:len(ranges)] for x in texts[rows]], dtype=np.float64)
 
-        print(self.RawFile + ': Extracting boxcar mass ranges and fill times')
+            for i, key in enumerate(ranges):
+                table[key][rows] = fill_times[:, i]
 
-        self.data['MassRangeFillTimes'] = OD((str(x), get_out(x)) for x in tqdm(self.info.loc[self.info['MSOrder'] == 1,
-                                                                                              'ScanNum'], ncols=70,
-                                                                                disable=self.disable_bar))
+        self.data['MassRangeFillTimes'] = ScanArray(scans, table)
 
         self.flags['MassRangeFillTimes'] = True
 
-    def QuantifyInterference(self, calculation_type='auto'):
+    def QuantifyInterference(self, calculation_type='auto', ppm=4, isotopes=1, lower_isotopes=1):
 
         '''
         Quantifies MS1 interference.
@@ -440,6 +673,10 @@ class RawQuant:
 
         calculation_type, str: whether the calculation should be based on
                     profile or centroid data
+        ppm, float: mass tolerance of the precursor and isotope peaks (centroid data)
+        isotopes, int: number of isotope peaks above the monoisotopic peak counted as precursor (centroid data)
+        lower_isotopes, int: number of isotope peaks below the monoisotopic peak counted as precursor, for precursors
+                    over 1000 Da (centroid data)
 
         Returns:
         dictionary: data['MS1Interference'] added to the RawQuant class object.
@@ -476,574 +713,206 @@ class RawQuant:
 
                 calculation_type = 'profile'
 
+        # only the masses and intensities are needed, plus the resolutions for profile data. the profile data is
+        # only read for the isolation windows
         if calculation_type == 'profile':
 
-            if self.flags['MS1MassLists'] == False:
-                self.ExtractMSData(1, 'MassLists')
-
-            if self.flags['MS1LabelData'] == False:
-                self.ExtractMSData(1, 'LabelData')
+            self.ExtractIsolationWindows('MassLists')
+            self.ExtractIsolationWindows('LabelData', ['Masses', 'Intensities', 'Resolutions'])
 
         if calculation_type == 'centroid':
 
-            if self.flags['MS1LabelData'] == False:
-                self.ExtractMSData(1, 'LabelData')
+            self.PrepareMS1Data('LabelData', ['Masses', 'Intensities'])
 
         ### Begin quantification part of the function ###
 
         print(self.RawFile + ': Quantifying MS1 interference: ' + calculation_type + ' data')
-        interference = OD()
-        ScanData = OD()
-        IonInfo = OD()
-        IntIons = OD()
-
-        for scan in tqdm(self.info.loc[self.info['MSOrder'] == 2, 'ScanNum'].astype(str), ncols=70,
-                         disable=self.disable_bar):
-
-            # try:
-            precScan = self.data['MS2PrecursorScan'][scan]
-
-            precMass = self.data['PrecursorMass'][scan]
-
-            precCharge = self.data['PrecursorCharge'][scan]
-
-            if calculation_type == 'centroid':
-
-                MS1_data = self.data['MS1LabelData'][str(precScan)]
-
-            elif calculation_type == 'profile':
-
-                MS1_data = self.data['MS1MassLists'][str(precScan)]
-
-            MS1_data = MS1_data[(MS1_data[:, 0] > precMass - 0.5 * self.MetaData \
-                ['IsolationWidth']) & (MS1_data[:, 0] < precMass + 0.5 * \
-                                       self.MetaData['IsolationWidth']), :]
-
-            if len(MS1_data) == 0:
-                interference[scan] = np.nan
-                continue
-
-            LabelData = self.data['MS1LabelData'][str(precScan)]
-
-            if calculation_type == 'centroid':
-
-                pepIntensity = MS1_data[MS1_data[:, 0] == precMass, 1]
-
-                precIons = [precMass]
-                precIntensities = [pepIntensity[0]]
-
-                ScanInterferences = MS1_data.copy()[:, 0]
-                idx = np.argmin(np.abs(ScanInterferences - precMass))
-                ScanInterferences = np.delete(ScanInterferences, idx)
-
-                if precCharge == 2:
-                    idx = np.argmin(np.abs(MS1_data[:, 0] - 0.501678 - precMass))
-                    isotopeMass = MS1_data[idx, 0]
-                    if abs((isotopeMass - 0.501678 - precMass) / isotopeMass * 10 ** 6) < 4:
-                        pepIntensity += MS1_data[idx, 1]
-                        precIons += [isotopeMass]
-                        precIntensities += [MS1_data[idx, 1]]
-                        ScanInterferences = np.delete(ScanInterferences,
-                                                      np.argmin(np.abs(ScanInterferences - isotopeMass)))
-
-                    if precMass * precCharge > 1000:
-                        idx = np.argmin(np.abs(MS1_data[:, 0] + 0.501678 - precMass))
-                        isotopeMass = MS1_data[idx, 0]
-                        if abs((isotopeMass + 0.501678 - precMass) / isotopeMass * 10 ** 6) < 4:
-                            pepIntensity += MS1_data[idx, 1]
-                            precIons += [isotopeMass]
-                            precIntensities += [MS1_data[idx, 1]]
-                            ScanInterferences = np.delete(ScanInterferences,
-                                                          np.argmin(np.abs(ScanInterferences - isotopeMass)))
-
-                if precCharge == 3:
-                    idx = np.argmin(np.abs(MS1_data[:, 0] - 0.334452 - precMass))
-                    isotopeMass = MS1_data[idx, 0]
-                    if abs((isotopeMass - 0.334452 - precMass) / isotopeMass * 10 ** 6) < 4:
-                        pepIntensity += MS1_data[idx, 1]
-                        precIons += [isotopeMass]
-                        precIntensities += [MS1_data[idx, 1]]
-                        ScanInterferences = np.delete(ScanInterferences,
-                                                      np.argmin(np.abs(ScanInterferences - isotopeMass)))
-
-                    if precMass * precCharge > 1000:
-                        idx = np.argmin(np.abs(MS1_data[:, 0] + 0.334452 - precMass))
-                        isotopeMass = MS1_data[idx, 0]
-                        if abs((isotopeMass + 0.334452 - precMass) / isotopeMass * 10 ** 6) < 4:
-                            pepIntensity += MS1_data[idx, 1]
-                            precIons += [isotopeMass]
-                            precIntensities += [MS1_data[idx, 1]]
-                            ScanInterferences = np.delete(ScanInterferences,
-                                                          np.argmin(np.abs(ScanInterferences - isotopeMass)))
-
-                if precCharge == 4:
-                    idx = np.argmin(np.abs(MS1_data[:, 0] - 0.250839 - precMass))
-                    isotopeMass = MS1_data[idx, 0]
-                    if abs((isotopeMass - 0.250839 - precMass) / isotopeMass * 10 ** 6) < 4:
-                        pepIntensity += MS1_data[idx, 1]
-                        precIons += [isotopeMass]
-                        precIntensities += [MS1_data[idx, 1]]
-                        ScanInterferences = np.delete(ScanInterferences,
-                                                      np.argmin(np.abs(ScanInterferences - isotopeMass)))
-
-                    if precMass * precCharge > 1000:
-                        idx = np.argmin(np.abs(MS1_data[:, 0] + 0.250839 - precMass))
-                        isotopeMass = MS1_data[idx, 0]
-                        if abs((isotopeMass + 0.250839 - precMass) / isotopeMass * 10 ** 6) < 4:
-                            pepIntensity += MS1_data[idx, 1]
-                            precIons += [isotopeMass]
-                            precIntensities += [MS1_data[idx, 1]]
-                            ScanInterferences = np.delete(ScanInterferences,
-                                                          np.argmin(np.abs(ScanInterferences - isotopeMass)))
-
-                totalIntensity = np.sum(MS1_data[:, 1])
-
-                out = float((totalIntensity - pepIntensity) / totalIntensity * 100)
-
-            elif calculation_type == 'profile':
-
-                resolution = LabelData[np.argmin(np.abs(LabelData[:, 0] - precMass)), 2]
-
-                hiMass, loMass = precMass + precMass / resolution, precMass - precMass / resolution
-                try:
-                    mx = np.max(MS1_data[(MS1_data[:, 0] > loMass) & (MS1_data[:, 0] < hiMass), 1])
-                except:
-                    interference[scan] = np.nan
-                    continue
-
-                idx = np.where(MS1_data[:, 1] == mx)[0][0]
-                grad = np.gradient(MS1_data[:, 1], MS1_data[:, 0])
-                lo, hi = idx - 1, idx + 1
-                while grad[hi] < 0:
-                    hi = hi + 1
-                while grad[lo] > 0:
-                    lo = lo - 1
-                pepArea = np.trapz(MS1_data[lo:hi, 1], MS1_data[lo:hi, 0])
-                totArea = np.trapz(MS1_data[:, 1], MS1_data[:, 0])
-
-                if precCharge == 2:
-                    try:
-                        isoMass = precMass + 0.501678
-                        hiMass, loMass = isoMass + isoMass / resolution, isoMass - isoMass / resolution
-
-                        mx = np.max(MS1_data[(MS1_data[:, 0] > loMass) & (MS1_data[:, 0] < hiMass), 1])
-                        idx = np.where(MS1_data[:, 1] == mx)[0][0]
-
-                        if idx + 1 == len(MS1_data[:, 0]):
-                            # in this case the peak is cutoff by the window
-                            idx = len(MS1_data[:, 0])
-                            lo = idx - 1
-                            while grad[lo] > 0:
-                                lo = lo - 1
-                            pepArea = pepArea + np.trapz(MS1_data[lo:, 1], MS1_data[lo:, 0])
 
-                        else:
-                            # in this case the peak is not cut off
-                            idx = np.where(MS1_data[:, 1] == mx)[0][0]
-
-                            lo, hi = idx - 1, idx + 1
-                            while (grad[hi] < 0) | (hi <= len(MS1_data[:, 0]) - 1):
-                                hi = hi + 1
-                            while grad[lo] > 0:
-                                lo = lo - 1
-                            pepArea = pepArea + np.trapz(MS1_data[lo:hi, 1], MS1_data[lo:hi, 0])
-                    except:
-                        None
+        # the precursor and isotope peaks of all MS2 scans are matched together
+        scans = self.info.loc[self.info['MSOrder'] == 2, 'ScanNum'].values
 
-                    if precMass * precCharge > 1000:
-                        try:
-                            isoMass = precMass - 0.501678
-                            hiMass, loMass = isoMass + isoMass / resolution, isoMass - isoMass / resolution
-
-                            mx = np.max(MS1_data[(MS1_data[:, 0] > loMass) & (MS1_data[:, 0] < hiMass), 1])
-                            idx = np.where(MS1_data[:, 1] == mx)[0][0]
-
-                            if idx == 0:
-                                # in this case the peak is cutoff by the window
-                                hi = idx + 1
-                                while (grad[hi] < 0) | (MS1_data[hi, 1]):
-                                    hi = hi + 1
-                                pepArea = pepArea + np.trapz(MS1_data[lo:, 1], MS1_data[lo:, 0])
-
-                            else:
-                                # in this case the peak is not cut off
-                                idx = np.where(MS1_data[:, 1] == mx)[0][0]
-
-                                lo, hi = idx - 1, idx + 1
-                                while grad[hi] < 0:
-                                    hi = hi + 1
-                                while (grad[lo] > 0) | (lo >= 0):
-                                    lo = lo - 1
-                                pepArea = pepArea + np.trapz(MS1_data[lo:hi, 1], MS1_data[lo:hi, 0])
-                        except:
-                            None
-
-                if precCharge == 3:
-
-                    try:
-                        isoMass = precMass + 0.334452
-                        hiMass, loMass = isoMass + isoMass / resolution, isoMass - isoMass / resolution
-
-                        mx = np.max(MS1_data[(MS1_data[:, 0] > loMass) & (MS1_data[:, 0] < hiMass), 1])
-                        idx = np.where(MS1_data[:, 1] == mx)[0][0]
-
-                        if idx + 1 == len(MS1_data[:, 0]):
-                            # in this case the peak is cutoff by the window
-                            idx = len(MS1_data[:, 0])
-                            lo = idx - 1
-                            while grad[lo] > 0:
-                                lo = lo - 1
-                            pepArea = pepArea + np.trapz(MS1_data[lo:, 1], MS1_data[lo:, 0])
+        sliced = OD([('scans', scans), ('parents', self.data['MS2PrecursorScan'].take(scans)),
+                     ('monoisotopic', self.data['PrecursorMass'].take(scans)),
+                     ('charges', self.data['PrecursorCharge'].take(scans))])
 
-                        else:
-                            # in this case the peak is not cut off
-                            idx = np.where(MS1_data[:, 1] == mx)[0][0]
-
-                            lo, hi = idx - 1, idx + 1
-                            while (grad[hi] < 0) | (hi <= len(MS1_data[:, 0]) - 1):
-                                hi = hi + 1
-                            while grad[lo] > 0:
-                                lo = lo - 1
-                            pepArea = pepArea + np.trapz(MS1_data[lo:hi, 1], MS1_data[lo:hi, 0])
-                    except:
-                        None
+        fixed = OD([('width', self.MetaData['IsolationWidth']), ('isotopes', isotopes),
+                    ('lower_isotopes', lower_isotopes)])
 
-                    if precMass * precCharge > 1000:
-                        try:
-                            isoMass = precMass - 0.334452
-                            hiMass, loMass = isoMass + isoMass / resolution, isoMass - isoMass / resolution
-
-                            mx = np.max(MS1_data[(MS1_data[:, 0] > loMass) & (MS1_data[:, 0] < hiMass), 1])
-                            idx = np.where(MS1_data[:, 1] == mx)[0][0]
-
-                            if idx == 0:
-                                # in this case the peak is cutoff by the window
-                                hi = idx + 1
-                                while (grad[hi] < 0) | (MS1_data[hi, 1]):
-                                    hi = hi + 1
-                                pepArea = pepArea + np.trapz(MS1_data[lo:, 1], MS1_data[lo:, 0])
-
-                            else:
-                                # in this case the peak is not cut off
-                                idx = np.where(MS1_data[:, 1] == mx)[0][0]
-
-                                lo, hi = idx - 1, idx + 1
-                                while grad[hi] < 0:
-                                    hi = hi + 1
-                                while (grad[lo] > 0) | (lo >= 0):
-                                    lo = lo - 1
-                                pepArea = pepArea + np.trapz(MS1_data[lo:hi, 1], MS1_data[lo:hi, 0])
-                        except:
-                            None
-
-                if precCharge == 4:
-
-                    try:
-                        isoMass = precMass + 0.250839
-                        hiMass, loMass = isoMass + isoMass / resolution, isoMass - isoMass / resolution
-
-                        mx = np.max(MS1_data[(MS1_data[:, 0] > loMass) & (MS1_data[:, 0] < hiMass), 1])
-                        idx = np.where(MS1_data[:, 1] == mx)[0][0]
-
-                        if idx + 1 == len(MS1_data[:, 0]):
-                            # in this case the peak is cutoff by the window
-                            idx = len(MS1_data[:, 0])
-                            lo = idx - 1
-                            while grad[lo] > 0:
-                                lo = lo - 1
-                            pepArea = pepArea + np.trapz(MS1_data[lo:, 1], MS1_data[lo:, 0])
+        if calculation_type == 'centroid':
 
-                        else:
-                            # in this case the peak is not cut off
-                            idx = np.where(MS1_data[:, 1] == mx)[0][0]
-
-                            lo, hi = idx - 1, idx + 1
-                            while (grad[hi] < 0) | (hi <= len(MS1_data[:, 0]) - 1):
-                                hi = hi + 1
-                            while grad[lo] > 0:
-                                lo = lo - 1
-                            pepArea = pepArea + np.trapz(MS1_data[lo:hi, 1], MS1_data[lo:hi, 0])
-                    except:
-                        None
+            fixed['ppm'] = ppm
+
+            interference, windows, precursors, interfering = compute(
+                centroid_interference, OD([('spectra', self.data['MS1LabelData'])]), sliced, fixed,
+                processes=self.processes)
+
+            self.data['MS1IsolationIons'] = precursors
+            self.data['InterferenceIons'] = interfering
+
+        elif calculation_type == 'profile':
+
+            interference, windows, truncated = compute(
+                profile_interference, OD([('profiles', self.data['MS1WindowMassLists']),
+                                          ('centroids', self.data['MS1WindowLabelData'])]), sliced, fixed,
+                processes=self.processes)
+
+            # whether a precursor peak was cut off by the low or high end of the isolation window
+            self.data['MS1InterferenceTruncated'] = ScanArray(scans, truncated)
+
+            if np.any(truncated):
+                print(self.RawFile + ': ' + str(np.count_nonzero(truncated.any(axis=1))) +
+                      ' precursor peaks are cut off by the isolation window')
 
-                    if precMass * precCharge > 1000:
-                        try:
-                            isoMass = precMass - 0.250839
-                            hiMass, loMass = isoMass + isoMass / resolution, isoMass - isoMass / resolution
-
-                            mx = np.max(MS1_data[(MS1_data[:, 0] > loMass) & (MS1_data[:, 0] < hiMass), 1])
-                            idx = np.where(MS1_data[:, 1] == mx)[0][0]
-
-                            if idx == 0:
-                                # in this case the peak is cutoff by the window
-                                hi = idx + 1
-                                while (grad[hi] < 0) | (MS1_data[hi, 1]):
-                                    hi = hi + 1
-                                pepArea = pepArea + np.trapz(MS1_data[lo:, 1], MS1_data[lo:, 0])
-
-                            else:
-                                # in this case the peak is not cut off
-                                idx = np.where(MS1_data[:, 1] == mx)[0][0]
-
-                                lo, hi = idx - 1, idx + 1
-                                while grad[hi] < 0:
-                                    hi = hi + 1
-                                while (grad[lo] > 0) | (lo >= 0):
-                                    lo = lo - 1
-                                pepArea = pepArea + np.trapz(MS1_data[lo:hi, 1], MS1_data[lo:hi, 0])
-                        except:
-                            None
-
-                        try:
-                            # look for the second isotope peak at the edge of the window
-                            isoMass = precMass + 0.501678
-                            hiMass, loMass = isoMass + isoMass / resolution, isoMass - isoMass / resolution
-
-                            mx = np.max(MS1_data[(MS1_data[:, 0] > loMass) & (MS1_data[:, 0] < hiMass), 1])
-                            idx = np.where(MS1_data[:, 1] == mx)[0][0]
-
-                            if idx + 1 == len(MS1_data[:, 0]):
-                                # in this case the peak is cutoff by the window
-                                idx = len(MS1_data[:, 0])
-                                lo = idx - 1
-                                while grad[lo] > 0:
-                                    lo = lo - 1
-                                pepArea = pepArea + np.trapz(MS1_data[lo:, 1], MS1_data[lo:, 0])
-
-                            else:
-                                # in this case the peak is not cut off
-                                idx = np.where(MS1_data[:, 1] == mx)[0][0]
-
-                                lo, hi = idx - 1, idx + 1
-                                while (grad[hi] < 0) | (hi <= len(MS1_data[:, 0]) - 1):
-                                    hi = hi + 1
-                                while grad[lo] > 0:
-                                    lo = lo - 1
-                                pepArea = pepArea + np.trapz(MS1_data[lo:hi, 1], MS1_data[lo:hi, 0])
-                        except:
-                            None
-                        # it is unlikely that there is more than one isotope peak below the precursor mass,
-                        # so we won't look for a second one
-
-                out = float((totArea - pepArea) / totArea * 100)
-
-            # becuase of the limitations in machine precision, the outputs of
-            # the numerical integrations can lead to the interference having
-            # a very small negative value (10^-14 order). Since this has no
-            # physical meaning, it will be set to zero. Larger magnitude negative
-            # numbers will be left to help identify errors in the calculation
-            # Very small positive numbers of similarly small magnitude also
-            # come up for the same reason. They are set to zero to clean things
-            # up.
-
-            if abs(out) < 10 ** -6:
-                out = 0
-            interference[scan] = out
-            ScanData[scan] = MS1_data
-            if calculation_type == 'centroid':
-                IonInfo[scan] = {'PrecIons': precIons, 'PrecIntensities': precIntensities}
-                IntIons[scan] = ScanInterferences
-            # except:
-            #    interference[scan] = np.nan
-
-        self.data['MS1Interference'] = interference
-        self.data['MS1IsolationScan'] = ScanData
-        self.data['MS1IsolationIons'] = IonInfo
-        self.data['InterferenceIons'] = IntIons
+        self.data['MS1Interference'] = ScanArray(scans, interference)
+        self.data['MS1IsolationScan'] = windows
         self.flags['MS1Interference'] = True
 
-    '''
-    def InterferenceIndex(self,ppm=4,RT_window=5):
+    def ExtractIsolationWindows(self, dtype, fields=None):
 
-        if self.flags['MS1Interference'] == False:
+        '''
+        Makes the MS1 data in the isolation window of each MS2 scan available as self.data['MS1Window<dtype>']. If
+        the MS1 data has already been extracted it is used, otherwise only the precursor MS1 scans are read, and
+        only the peaks inside the isolation windows are kept.
+        '''
 
-            self.QuantifyInterference(calculation_type = 'centroid')
+        if self.flags['MS1Window' + dtype]:
+            return
 
-        if self.flags['MS2RetentionTime'] == False:
+        if self.MSDataAvailable(1, dtype, fields):
+            self.data['MS1Window' + dtype] = self.data['MS1' + dtype]
+            self.flags['MS1Window' + dtype] = True
+            return
 
-            self.ExtractRetentionTimes(2)
+        MS2scans = self.info.loc[self.info['MSOrder'] == 2, 'ScanNum']
 
-        IntDf = pd.DataFrame(index = list(self.data['MS1Interference'].keys()))
-
-        IntDf['PrecursorMass'] = [self.data['MS2PrecursorMass'][scan] for scan in IntDf.index.tolist()]
-        IntDf['InterferingIons'] = [self.data['InterferenceIons'][scan] for scan in IntDf.index.tolist()]
-        IntDf['RT'] = [self.data['MS2RetentionTime'][scan] for scan in IntDf.index.tolist()]
-        IntDf['MS1Interference'] = [self.data['MS1Interference'][scan] for scan in IntDf.index.tolist()]
-        #IntDf['PrecursorIsotopes'] = []
-
-        PrecursorIsotopes = np.zeros((len(IntDf),4))
-        i = 0
-
-        for scan in tqdm(IntDf.index.tolist()):
-
-            mass = IntDf.loc[scan,'PrecursorMass']
-
-            if self.data['PrecursorCharge'][scan] == 2:
-                IntDf.loc[[scan],'PrecursorIsotopes'] = pd.Series([[mass - 0.501678, mass,
-                    mass + 0.501678, mass + 0.501678*2]],index = [scan])
-            elif self.data['PrecursorCharge'][scan] == 3:
-                IntDf.loc[[scan],'PrecursorIsotopes'] = pd.Series([[mass - 0.334452, mass,
-                    mass + 0.334452, mass + 0.334452*2]],index = [scan])
-            elif self.data['PrecursorCharge'][scan] == 4:
-                IntDf.loc[[scan],'PrecursorIsotopes'] = pd.Series([[mass - 0.250839, mass,
-                    mass + 0.250839, mass + 0.250839*2]],index = [scan])
-
-            PrecursorIsotopes[i,:] = IntDf.loc[scan,'PrecursorIsotopes']
-
-            i += 1
-        
-        def RemoveDuplicates(seq, idfun=None):
-           # order preserving
-           if idfun is None:
-               def idfun(x): return x
-           seen = {}
-           result = []
-           for item in seq:
-               marker = idfun(item)
-               # in old Python versions:
-               # if seen.has_key(marker)
-               # but in new ones:
-               if marker in seen: continue
-               seen[marker] = 1
-               result.append(item)
-           return result
-        correlations = pd.DataFrame(columns = ['Scan','Mass','RT','MS1Interference','InterferingIon','CorrelatedScan','CorrelatedMass','CorrelatedRT'])
-        for scan in tqdm(IntDf.index.tolist()):
-
-            interference = IntDf.loc[scan,'InterferingIons']
-            #correlatedScans = []
-            #correlatedMass = []
-            #correlatedRT = []
-            RT =  IntDf.loc[scan,'RT']
-
-            for ion in interference:
-
-                idx = np.abs(PrecursorIsotopes-ion)/ion*10**6<ppm
-                RTidx = np.abs(IntDf['RT']-RT)/RT*100 < RT_window
-                rows = idx.max(axis=1)&RTidx
-
-                correlatedDf = IntDf[rows]
-                
-                for idx in correlatedDf.index.tolist():
-                    correlations.loc[scan+'_'+idx,'Scan'] = int(scan)
-                    correlations.loc[scan+'_'+idx,'Mass'] = IntDf.loc[scan,'PrecursorMass']
-                    correlations.loc[scan+'_'+idx,'RT'] = RT
-                    correlations.loc[scan+'_'+idx,'MS1Interference'] = IntDf.loc[scan,'MS1Interference']
-                    correlations.loc[scan+'_'+idx,'InterferingIon'] = ion
-                    correlations.loc[scan+'_'+idx,'CorrelatedScan'] = int(idx)
-                    #correlatedScans += correlatedDf.index.tolist()
-                    correlations.loc[scan+'_'+idx,'CorrelatedMass'] = correlatedDf.loc[idx,'PrecursorMass']
-                    #correlatedMass += correlatedDf['PrecursorMass'].tolist()
-                    correlations.loc[scan+'_'+idx,'CorrelatedRT'] = correlatedDf.loc[idx,'RT']
-                    #correlatedRT += correlatedDf['RT'].tolist()
-                #correlatedMass += correlatedDf['Precursors']
-
-            #THERE IS A PROBLEM HERE
-            #correlatedScans = RemoveDuplicates(correlatedScans)
-            #correlatedMass = RemoveDuplicates(correlatedMass)
-            #correlatedRT = RemoveDuplicates(correlatedRT)
-
-            #IntDf.loc[scan,'NumberOfInterferences'] = len(correlatedScans)
-
-            #IntDf.loc[[scan],'CorrelatedScans'] = pd.Series([correlatedScans],index=[scan])
-            #IntDf.loc[[scan],'CorrelatedMass'] = pd.Series([correlatedMass],index=[scan])
-            #IntDf.loc[[scan],'CorrelatedRT'] = pd.Series([correlatedRT],index=[scan])
-
-        #df = IntDf[IntDf['MS1Interference'] != 0.0]
-        df = correlations
-
-        print('First round')
-
-        print('Total scans = '+str(len(IntDf)))
-
-        print('Scans with interference = ' + str(len(df)))
-
-        df = df[df['NumberOfInterferences'] != 0]
-
-        print('Scans with interferences matched to nearby scans = ' + str(len(df)) + '\n')
+        windows = window_intervals(self.data['MS2PrecursorScan'].take(MS2scans),
+                                   self.data['PrecursorMass'].take(MS2scans), self.MetaData['IsolationWidth'])
 
-        print('Stats on number of interferences per scan (excluding scans with zero matched interferences):')
+        print(self.RawFile + ': Extracting MS1' + dtype + ' isolation windows')
+
+        self.data['MS1Window' + dtype] = RawFileReader.extract_targeted_peaks(raw=self.raw,
+                                                                             scans=np.asarray(list(windows)),
+                                                                             windows=windows,
+                                                                             disable_bar=self.disable_bar,
+                                                                             source=dtype,
+                                                                             fields=fields,
+                                                                             dtype=self.ms1_dtype,
+                                                                             workers=self.workers)
 
-        print(df['NumberOfInterferences'].describe())
+        self.flags['MS1Window' + dtype] = True
 
-        MS1scans = np.array(list(self.data['MS1LabelData'].keys()),dtype=int)
+    def InterferenceIndex(self, ppm=4, RT_window=5, max_misses=1):
+
+        '''
+        Matches the interfering ions of each MS2 scan to the precursors of other MS2 scans eluting nearby, which
+        are likely the source of the interference.
 
-        for scan in tqdm(df.index.tolist()):
+        Parameters:
 
-            precMass = float(df.loc[scan,'PrecursorMass'])
+        ppm, float: mass tolerance between an interfering ion and the isotopes of a precursor
+        RT_window, float: retention time tolerance, in percent of the retention time of the MS2 scan
+        max_misses, int: the largest number of MS1 scans between the two MS2 scans in which the interfering
+                    ion may be missing. Correlations with more misses are dropped
 
-            for IntScan,IntMass,IntRT in zip(df.loc[scan,'CorrelatedScans'],df.loc[scan,'CorrelatedMass'],df.loc[scan,'CorrelatedRT']):
+        Returns:
+        pandas DataFrame: self.IntIndex, with one row per (Scan, InterferingIon, CorrelatedScan)
+        '''
 
-                int_scan = IntScan
+        if self.flags['MS1Interference'] == False:
 
-                if int(int_scan)<int(scan):
+            self.QuantifyInterference(calculation_type='centroid', ppm=ppm)
 
-                    scans = MS1scans[(MS1scans>=int(int_scan))&(MS1scans<=int(scan))]
+        if 'InterferenceIons' not in self.data:
 
-                elif int(int_scan)>int(scan):
+            # the profile calculation does not find the interfering ions, so they are found in the centroid data. the
+            # profile interference is kept
+            print(self.RawFile + ': Finding interfering ions in the centroid MS1 data')
 
-                    scans = MS1scans[(MS1scans<=int(int_scan))&(MS1scans>=int(scan))]
+            interference, windows = self.data['MS1Interference'], self.data['MS1IsolationScan']
 
-                misses = 0
+            self.QuantifyInterference(calculation_type='centroid', ppm=ppm)
 
-                for int_scan in scans:
+            self.data['MS1Interference'], self.data['MS1IsolationScan'] = interference, windows
 
-                    MS1_data = self.data['MS1LabelData'][str(int_scan)]
+        if self.flags['MS2RetentionTime'] == False:
 
-                    MS1_data = MS1_data[(MS1_data[:,0]>precMass-0.5*self.MetaData\
-                        ['IsolationWidth'])&(MS1_data[:,0]<precMass+0.5*\
-                        self.MetaData['IsolationWidth']),0]
+            self.ExtractRetentionTimes(2)
 
-                    StillThere = np.abs(MS1_data-IntMass)/IntMass*10**6<ppm
+        self.PrepareMS1Data('LabelData', ['Masses', 'Intensities'])
 
-                    if np.sum(StillThere) > 0:
+        print(self.RawFile + ': Correlating interfering ions with precursors')
 
-                        None
+        scans = self.info.loc[self.info['MSOrder'] == 2, 'ScanNum'].values
+        masses = self.data['PrecursorMass'].take(scans)
+        RT = self.data['MS2RetentionTime'].take(scans)
 
-                    else:
+        rows, ions, correlated = correlate_interferences(self.data['InterferenceIons'], scans, masses,
+                                                         self.data['PrecursorCharge'].take(scans), RT, ppm=ppm,
+                                                         rt_window=RT_window)
 
-                        misses += 1
+        # an interfering ion should be seen in the MS1 scans between the two MS2 scans if it really is the
+        # correlated precursor
+        misses = ion_misses(self.data['MS1LabelData'], np.sort(self.info.loc[self.info['MSOrder'] == 1, 'ScanNum']),
+                            scans[rows], scans[correlated], ions, ppm=ppm)
 
-                if misses >= 2:
+        df = pd.DataFrame(OD([('Scan', scans[rows]),
+                              ('Mass', masses[rows]),
+                              ('RT', RT[rows]),
+                              ('MS1Interference', self.data['MS1Interference'].take(scans)[rows]),
+                              ('InterferingIon', ions),
+                              ('CorrelatedScan', scans[correlated]),
+                              ('CorrelatedMass', masses[correlated]),
+                              ('CorrelatedRT', RT[correlated]),
+                              ('Misses', misses)]))
 
-                    df.loc[scan,'CorrelatedScans'].remove(IntScan)
-                    df.loc[scan,'CorrelatedMass'].remove(IntMass)
-                    df.loc[scan,'CorrelatedRT'].remove(IntRT)
+        self.IntIndex = df[df['Misses'] <= max_misses].reset_index(drop=True)
 
-        self.IntIndex = df
-    '''
+        print(self.RawFile + ': ' + str(len(self.IntIndex)) + ' interfering ions correlated with nearby precursors (' +
+              str(len(df) - len(self.IntIndex)) + ' dropped as not seen in the MS1 scans between them)')
 
     def PlotInterferences(self):
 
-        # if 'matplotlib.pyplot' not in sys.modules:
+        '''
+        Plots the retention time of each MS2 scan with correlated interferences (red) and of the precursors
+        correlated with them (black) against the MS2 scan number. See InterferenceIndex.
+        '''
 
         import matplotlib.pyplot as plt
 
-        df = self.IntIndex[self.IntIndex['MS1Interference'] != 0.0]
+        if not hasattr(self, 'IntIndex'):
+            self.InterferenceIndex()
 
-        print('Total scans = ' + str(len(self.IntIndex)))
-        print('Scans with interference = ' + str(len(df)))
+        interference = self.data['MS1Interference'].array
+        correlated = self.IntIndex.groupby('Scan')['CorrelatedScan'].nunique()
 
-        df = df[df['NumberOfInterferences'] != 0]
-
-        print('Scans with interferences matched to nearby scans = ' + str(len(df)) + '\n')
+        print('Total scans = ' + str(len(interference)))
+        print('Scans with interference = ' + str(np.count_nonzero(interference > 0)))
+        print('Scans with interferences matched to nearby scans = ' + str(len(correlated)) + '\n')
 
         print('Stats on number of interferences per scan (excluding scans with zero matched interferences):')
-        print(df['NumberOfInterferences'].describe())
+        print(correlated.describe())
+
+        scans = self.IntIndex.drop_duplicates('Scan')
 
-        for scan in tqdm(df.index.tolist()):
-            plt.scatter(df.loc[scan, 'RT'], int(scan), marker='.', color='r')
-            plt.scatter(df.loc[scan, 'CorrelatedRT'], [int(scan)] * len(df.loc[scan, 'CorrelatedRT']), marker='.',
-                        color='k', alpha=0.5)
+        plt.scatter(self.IntIndex['CorrelatedRT'], self.IntIndex['Scan'], marker='.', color='k', alpha=0.5)
+        plt.scatter(scans['RT'], scans['Scan'], marker='.', color='r')
+        plt.xlabel('Retention time')
+        plt.ylabel('MS2 scan')
 
-    def MS2PrecursorPeaks(self):
+    def MS2PrecursorPeaks(self, share=None):
 
         '''
         Determines ion intensity of picked MS1 peaks. Intensity is returned for the
         time the peak was picked as well as the maximum intensity. It is indexed by MS2
         scan number.
+
+        share: whether precursors fragmented several times share one chromatogram (see precursors.precursor_peaks).
+        By default, the share_chromatograms argument of RawQuant.
         '''
 
+        if share is None:
+            share = self.share_chromatograms
+
         if self.MetaData['AnalysisOrder'] < 2:
             raise Exception('MS analysis order must be greater than 1')
 
@@ -1053,163 +922,75 @@ class RawQuant:
         if self.flags['TriggerMass'] == False:
             self.ExtractTriggerMass()
 
-        if self.flags['MS1LabelData'] == False:
-            self.ExtractMSData(1, 'LabelData')
+        if self.precursor_backend == 'xic':
+            self.PrepareMS1Data('LabelData', ['Masses', 'Intensities'])
 
         if self.flags['MS1RetentionTime'] == False:
             self.ExtractRetentionTimes(1)
 
-        MS1scans = list(self.data['MS2PrecursorScan'].values())
-
-        def RemoveDuplicates(seq, idfun=None):
-            # order preserving
-            if idfun is None:
-                def idfun(x): return x
-            seen = {}
-            result = []
-            for item in seq:
-                marker = idfun(item)
-                # in old Python versions:
-                # if seen.has_key(marker)
-                # but in new ones:
-                if marker in seen: continue
-                seen[marker] = 1
-                result.append(item)
-            return result
-
-        MS1scans = np.array(RemoveDuplicates(MS1scans), dtype=int)
-
-        PrecursorIntensities = OD()
-        PrecursorElution = OD()
-        PrecursorArea = OD()
-        PrecursorProfile = OD()
-        PrecursorMaxScan = OD()
-        PrecursorEdgeScans = OD()
-
-        print(self.RawFile + ': Extracting precursor peak data')
-
-        for scan in tqdm(self.data['MS2PrecursorScan'].keys(), ncols=70, disable=self.disable_bar):
-
-            MS1scan = self.data['MS2PrecursorScan'][scan]
-
-            precMass = self.data['TriggerMass'][scan]
-
-            # find the leading edge of peak
-
-            found = True
-
-            LeadingScanIndex = np.argmin(np.abs(MS1scans - MS1scan))
-
-            LeadingScan = MS1scans[LeadingScanIndex]
-
-            while found:
-
-                MS1_data = self.data['MS1LabelData'][str(LeadingScan)]
-
-                if np.sum(np.abs(MS1_data[:, 0] - precMass) / precMass * 10 ** 6 < 4) > 0:
-
-                    LeadingRT = self.data['MS1RetentionTime'][str(LeadingScan)]
+        MS2scans = self.data['MS2PrecursorScan'].scans
+        PrecScans = self.data['MS2PrecursorScan'].array
 
-                    if LeadingScanIndex > 0:
+        # the MS1 scans which triggered an MS2 scan, in the order they were first used
+        _, first = np.unique(PrecScans, return_index=True)
+        MS1scans = PrecScans[np.sort(first)]
 
-                        LeadingScanIndex -= 1
-
-                        LeadingScan = MS1scans[LeadingScanIndex]
-
-                    else:
-
-                        found = False  # artificially end the search because we've reached the first scan
-
-                else:
-
-                    found = False
-
-            # find the tailing edge of peak
-
-            found = True
-
-            TailingScanIndex = np.argmin(np.abs(MS1scans - MS1scan))
-
-            TailingScan = MS1scans[TailingScanIndex]
-
-            while found:
-
-                MS1_data = self.data['MS1LabelData'][str(TailingScan)]
-
-                if np.sum(np.abs(MS1_data[:, 0] - precMass) / precMass * 10 ** 6 < 4) > 0:
-
-                    TailingRT = self.data['MS1RetentionTime'][str(TailingScan)]
-
-                    if TailingScanIndex < len(MS1scans) - 1:
-
-                        TailingScanIndex += 1
-
-                        TailingScan = MS1scans[TailingScanIndex]
-
-                    else:
-
-                        found = False  # artificially end the search because we've reached the last scan
-
-                else:
-
-                    found = False
-
-            # now get the picked ion intensity
-
-            MS1_data = self.data['MS1LabelData'][str(MS1scan)]
-
-            PickedIntensity = MS1_data[np.argmin(np.abs(MS1_data[:, 0] - precMass)), 1]
-
-            # print(PickedIntensity)
+        print(self.RawFile + ': Extracting precursor peak data')
 
-            # and the max intensity
+        starts = ScanArray(MS1scans, np.arange(len(MS1scans))).take(PrecScans)
+        masses = self.data['TriggerMass'].take(MS2scans)
 
-            PeakScans = MS1scans[LeadingScanIndex:TailingScanIndex + 1]
+        if self.precursor_backend == 'xic':
 
-            PeakIntensities = []
+            # the chromatograms of all trigger masses are extracted together from an m/z sorted index of the MS1 peaks
+            index = XICIndex(self.data['MS1LabelData'], MS1scans)
 
-            for x in PeakScans:
-                data = self.data['MS1LabelData'][str(x)]
+            peaks = compute_precursor_peaks(index, starts, masses, self.data['MS1RetentionTime'].take(MS1scans),
+                                            share=share, processes=self.processes)
 
-                data = data[np.argmin(np.abs(data[:, 0] - precMass)), 1]
+        else:
 
-                PeakIntensities += [data]
+            # one 4 ppm mass range chromatogram is read from the raw file for each group of trigger masses, and one
+            # for the own mass of each member of a group of several masses
+            traced, groups, own = trace_masses(masses, 4, share)
+            ranges = np.column_stack([traced * (1 - 4 / 10 ** 6), traced * (1 + 4 / 10 ** 6)])
 
-            # PeakIntensities = np.array([self.data['MS1LabelData'][str(x)][np.argmin(self.data['MS1LabelData'][str(x)][:,0]-precMass),1]\
-            #                    for x in PeakScans],dtype=float)
+            traces = RawFileReader.extract_chromatograms(self.raw, ranges, disable_bar=self.disable_bar,
+                                                         chunk_size=self.chromatogram_chunk_size)
 
-            PeakIntensities = np.array(PeakIntensities)
-            indx = np.argmax(PeakIntensities)
-            MaxIntensity = PeakIntensities[indx]
-            MaxScan = PeakScans[indx]
+            peaks = chromatogram_peaks(traces, MS1scans, starts, groups, self.data['MS1RetentionTime'].take(MS1scans),
+                                       own)
 
-            # and the area
+        PrecursorIntensities = np.zeros(len(MS2scans), dtype=[('Picked', np.float64), ('Max', np.float64)])
+        PrecursorIntensities['Picked'] = peaks['Picked']
+        PrecursorIntensities['Max'] = peaks['Max']
 
-            RTs = np.array([self.data['MS1RetentionTime'][str(x)] for x in PeakScans], dtype=float)
+        PrecursorElution = peaks['Elution']
+        PrecursorArea = peaks['Area']
+        PrecursorMaxScan = peaks['MaxScan']
+        PrecursorEdgeScans = peaks['EdgeScans']
 
-            PeakArea = np.trapz(PeakIntensities, RTs)
+        # repeatedly sampled precursors share a chromatogram, and so a profile
+        offsets = peaks['Offsets']
+        PrecursorProfile = OD((str(x), peaks['Profiles'][offsets[i]:offsets[i + 1]])
+                              for x, i in zip(MS2scans, peaks['Chromatogram']))
 
-            PrecursorIntensities[scan] = {'Picked': PickedIntensity, 'Max': MaxIntensity}
-            PrecursorElution[scan] = (LeadingRT, TailingRT)
-            PrecursorArea[scan] = PeakArea
-            PrecursorProfile[scan] = PeakIntensities
-            PrecursorMaxScan[scan] = MaxScan
-            PrecursorEdgeScans[scan] = (PeakScans[0], PeakScans[-1])
+        print(self.RawFile + ': ' + str(len(offsets) - 1) + ' precursor chromatograms for ' + str(len(MS2scans)) +
+              ' MS2 scans (' + str(len(MS2scans) - len(offsets) + 1) + ' shared)')
 
-        self.data['PrecursorIntensities'] = PrecursorIntensities
-        self.data['PrecursorElution'] = PrecursorElution
-        self.data['PrecursorArea'] = PrecursorArea
+        self.data['PrecursorIntensities'] = ScanArray(MS2scans, PrecursorIntensities)
+        self.data['PrecursorElution'] = ScanArray(MS2scans, PrecursorElution)
+        self.data['PrecursorArea'] = ScanArray(MS2scans, PrecursorArea)
         self.data['PrecursorProfile'] = PrecursorProfile
-        self.data['PrecursorMaxScan'] = PrecursorMaxScan
-        self.data['PrecursorEdgeScans'] = PrecursorEdgeScans
+        self.data['PrecursorMaxScan'] = ScanArray(MS2scans, PrecursorMaxScan)
+        self.data['PrecursorEdgeScans'] = ScanArray(MS2scans, PrecursorEdgeScans)
 
         self.flags['PrecursorPeaks'] = True
 
-    def QuantifyReporters(self, reagents='None'):
+    def ReporterLabels(self, reagents):
 
         '''
-        Quantifies reporter ion abundances.
-
+        Returns the reporter ions of a built-in or user-defined reagent set, and a message describing them.
         '''
 
         ### Error checking ###
@@ -1240,30 +1021,6 @@ class RawQuant:
                     Quantification. To use user-defined reporter ion data, please
                     supply a csv containing reporter ion parameters.''')
 
-        if self.MetaData['AnalysisOrder'] == 2:
-
-            if self.MetaData['AnalyzerTypes']['2'] == 'FTMS':
-
-                if self.flags['MS2LabelData'] == False:
-                    # print('MS2LabelData required. Extracting now.')
-                    self.ExtractMSData(2, 'LabelData')
-
-            if self.MetaData['AnalyzerTypes']['2'] == 'ITMS':
-
-                if self.flags['MS2MassLists'] == False:
-                    # print('MS2MassLists required. Extracting now.')
-                    self.ExtractMSData(2, 'MassLists')
-
-        elif self.MetaData['AnalysisOrder'] == 3:
-
-            if self.flags['MS2LabelData'] == False:
-                # print('MS3LabelData required. Extracting now.')
-                self.ExtractMSData(3, 'LabelData')
-
-        ### Begin quantification section of function ###
-
-        Quant = OD()
-
         if reagents in ['TMT0', 'TMT2', 'TMT6', 'TMT10', 'TMT11']:
 
             tmt126, tmt127N, tmt127C, tmt128N, tmt128C, tmt129N, tmt129C, tmt130N, tmt130C, tmt131, tmt131N, tmt131C = {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}
@@ -1314,68 +1071,389 @@ class RawQuant:
             if reagents == 'iTRAQ8':
                 labels = [iTRAQ113, iTRAQ114, iTRAQ115, iTRAQ116, iTRAQ117, iTRAQ118, iTRAQ119, iTRAQ121]
 
-        if self.MetaData['AnalysisOrder'] == 3:
-            keys = self.data['MS3LabelData'].keys()
+        return labels, message
+
+    def QuantifyReporters(self, reagents='None', reporter_region=False, band=None):
+
+        '''
+        Quantifies reporter ion abundances.
+
+        reporter_region, bool: only extract the peaks in the reporter ion m/z band of the quant scans instead of the
+                    full spectra. Use this if the full spectra are not needed afterwards, e.g. for an MGF file.
+        band, tuple: (low, high) m/z band kept with reporter_region. Defaults to the reporter ion masses +/- 0.003.
+        '''
+
+        labels, message = self.ReporterLabels(reagents)
+
+        # the charges are not used for quantification, so they are not extracted
+        QuantFields = RawFileReader.CENTROID_FIELDS[:5]
+
+        order = int(self.MetaData['AnalysisOrder'])
+
+        if (order == 2) & (self.MetaData['AnalyzerTypes']['2'] == 'ITMS'):
+            QuantSource, QuantFields = 'MassLists', None
+        else:
+            QuantSource = 'LabelData'
+
+        # full spectra which were already extracted are used as they are
+        reporter_region = reporter_region & (not self.MSDataAvailable(order, QuantSource, QuantFields))
+
+        if reporter_region:
+
+            self.ExtractReporterRegion(order, QuantSource, band if band is not None else reporter_band(labels),
+                                       fields=QuantFields)
 
         elif self.MetaData['AnalysisOrder'] == 2:
+
             if self.MetaData['AnalyzerTypes']['2'] == 'FTMS':
-                keys = self.data['MS2LabelData'].keys()
+
+                if not self.MSDataAvailable(2, 'LabelData', QuantFields):
+                    # print('MS2LabelData required. Extracting now.')
+                    self.ExtractMSData(2, 'LabelData', fields=QuantFields)
+
+            if self.MetaData['AnalyzerTypes']['2'] == 'ITMS':
+
+                if self.flags['MS2MassLists'] == False:
+                    # print('MS2MassLists required. Extracting now.')
+                    self.ExtractMSData(2, 'MassLists')
+
+        elif self.MetaData['AnalysisOrder'] == 3:
+
+            if not self.MSDataAvailable(3, 'LabelData', QuantFields):
+                # print('MS3LabelData required. Extracting now.')
+                self.ExtractMSData(3, 'LabelData', fields=QuantFields)
+
+        ### Begin quantification section of function ###
+
+        if reporter_region:
+            spectra = self.data['MS' + str(order) + 'Reporter' + QuantSource]
+
+        elif self.MetaData['AnalysisOrder'] == 3:
+            spectra = self.data['MS3LabelData']
+
+        elif self.MetaData['AnalysisOrder'] == 2:
+            if self.MetaData['AnalyzerTypes']['2'] == 'FTMS':
+                spectra = self.data['MS2LabelData']
             elif self.MetaData['AnalyzerTypes']['2'] == 'ITMS':
-                keys = self.data['MS2MassLists'].keys()
+                spectra = self.data['MS2MassLists']
 
         print(message)
-        for scan in tqdm(keys, ncols=70, disable=self.disable_bar):
 
-            if self.MetaData['AnalysisOrder'] == 3:
-                spectrum = self.data['MS3LabelData'][scan]
+        # all scans are matched at once (see RawQuant.quant), or a chunk of them in each process
+        analyzer = self.MetaData['AnalyzerTypes'][str(self.MetaData['AnalysisOrder'])]
 
-            elif self.MetaData['AnalysisOrder'] == 2:
-                if self.MetaData['AnalyzerTypes']['2'] == 'FTMS':
-                    spectrum = self.data['MS2LabelData'][scan]
+        values = compute(quantify_reporters, OD([('spectra', spectra)]), OD([('scans', spectra.scans)]),
+                         OD([('labels', labels), ('analyzer', analyzer)]), processes=self.processes)
 
-                elif self.MetaData['AnalyzerTypes']['2'] == 'ITMS':
-                    spectrum = self.data['MS2MassLists'][scan]
-
-            Quant[scan] = OD()
-            for x in labels:
-                label = x.copy()
-                matched = spectrum[(spectrum[:, 0] > label['ReporterMass'] - 0.003) & (
-                            spectrum[:, 0] < label['ReporterMass'] + 0.003), :5]
-
-                if len(matched) == 0:
-                    label['mass'], label['intensity'], label['res'], label['bl'], label[
-                        'noise'] = np.nan, np.nan, np.nan, np.nan, np.nan  # 0.0,0.0,0.0,0.0,0.0
-
-                elif np.ndim(matched) == 1:
-                    if self.MetaData['AnalyzerTypes'][str(self.MetaData['AnalysisOrder'])] == 'FTMS':
-                        label['mass'], label['intensity'], label['res'], label['bl'], label['noise'] = matched
-                    elif self.MetaData['AnalyzerTypes'][str(self.MetaData['AnalysisOrder'])] == 'ITMS':
-                        label['mass'], label['intensity'], label['res'], label['bl'], label['noise'] = matched[0], \
-                                                                                                       matched[
-                                                                                                           1], np.nan, np.nan, np.nan
-
-                elif np.ndim(matched) > 1:
-                    # print('Interference found for ' + tmt['Label'] + ' label in scan '+str(scan)+
-                    #                '. Ion closest to label mass selected.')
-                    masses = matched[:, 0]
-                    idx = np.argmin(np.abs(masses - label['ReporterMass']))
-                    if self.MetaData['AnalyzerTypes'][str(self.MetaData['AnalysisOrder'])] == 'FTMS':
-                        label['mass'], label['intensity'], label['res'], label['bl'], label['noise'] = matched[idx, :]
-                    elif self.MetaData['AnalyzerTypes'][str(self.MetaData['AnalysisOrder'])] == 'ITMS':
-                        label['mass'], label['intensity'], label['res'], label['bl'], label['noise'] = matched[idx, 0], \
-                                                                                                       matched[
-                                                                                                           idx, 1], np.nan, np.nan, np.nan
-
-                if label['intensity'] == 0:
-                    label['ppm'] = np.nan
-                else:
-                    label['ppm'] = (label['mass'] - label['ReporterMass']) / label['ReporterMass'] * 10 ** 6
+        self.data['Quant'] = ReporterTable(spectra.scans, labels, values)
+        self.data['Labels'] = {str(x['Label']): x for x in labels}
+        self.flags['Quantified'] = True
+        self.flags['Streamed'] = False
+
+    def StreamQuant(self, reagents, mgf=None, cutoff=None, metrics=False, chunk_size=1000, sps_tolerance=0.01,
+                    sps_units='Da'):
+
+        '''
+        Quantifies reporter ions and builds the QuantMatrix in one pass over the MSn scans. The scans are read
+        chunk_size at a time, quantified, written to the MGF file and then dropped, so the spectra of the whole run
+        are never held in memory at once. The results are the same as those of QuantifyReporters, ToDataFrame and
+        SaveMGF.
+
+        mgf, str: name of the MGF file to write. None to skip it.
+        metrics, bool: keep the median intensity of each MS2 scan, so GenMetrics does not need to read them again.
+        sps_tolerance, sps_units: mass tolerance of the SPS ions of MS3 scans, see MatchSPSIons.
+        '''
+
+        labels, message = self.ReporterLabels(reagents)
+
+        order = int(self.MetaData['AnalysisOrder'])
+        analyzer = self.MetaData['AnalyzerTypes'][str(order)]
+
+        if order < 2:
+            raise Exception('MS analysis order must be 2 or 3 to quantify reporter ions')
+
+        if (self.flags['MS2PrecursorScan'] == False) | ((order == 3) & (self.flags['MS3PrecursorScan'] == False)):
+            self.ExtractPrecursorScans()
+
+        if (order == 3) & (self.flags['MS3TrailerExtra'] == False):
+            self.ExtractTrailerExtra(3)
+
+        # the charges are not used for quantification, so they are not extracted
+        QuantFields = RawFileReader.CENTROID_FIELDS[:5]
+
+        if (order == 2) & (analyzer == 'ITMS'):
+            QuantSource, QuantFields = 'MassLists', None
+        else:
+            QuantSource = 'LabelData'
+
+        LookFor = self.MGFSource() if mgf is not None else None
+
+        if LookFor is not None:
+            cutoff = self.PrepareMGF(cutoff)
+
+        # the MS2 spectra used for the MGF file and metrics
+        MS2Source = {'FTMS': 'LabelData', 'ITMS': 'MassLists'}.get(self.MetaData['AnalyzerTypes']['2']) if \
+            (LookFor is not None) | metrics else None
+
+        # only the reporter ion region of the quant scans is read, unless they also go to the MGF file or metrics
+        band = reporter_band(labels) if (order == 3) | (MS2Source is None) else None
+
+        def read(o, dtype, scans, fields=None, band=None):
+
+            if self.MSDataAvailable(o, dtype, fields):
+                return self.data['MS' + str(o) + dtype]
+
+            if band is not None:
+                return RawFileReader.extract_targeted_peaks(raw=self.raw, scans=scans, windows={}, disable_bar=True,
+                                                            source=dtype, common=[band], fields=fields,
+                                                            workers=self.workers)
+
+            if dtype == 'MassLists':
+                return RawFileReader.extract_segmented_scans(raw=self.raw, scans=scans, disable_bar=True,
+                                                             fields=fields, workers=self.workers)
+
+            return RawFileReader.extract_centroid_streams(raw=self.raw, scans=scans, disable_bar=True, fields=fields,
+                                                          workers=self.workers)
+
+        QuantScans = self.info.loc[self.info['MSOrder'] == order, 'ScanNum'].values
+
+        Quant = ReporterTable.empty(QuantScans, labels)
+
+        if order == 3:
+            SPSMasses = self.data['MS3TrailerExtra'].sps_matrix(QuantScans)
+            SPSIntensities = np.zeros(SPSMasses.shape)
+
+        MS2MedianIntensity = OD()
+
+        scans = self.info.loc[self.info['MSOrder'] >= 2, ['ScanNum', 'MSOrder']].values
+        chunks = np.array_split(scans, max(int(np.ceil(len(scans) / chunk_size)), 1))
+
+        f = open(mgf, 'wb') if LookFor is not None else None
+
+        try:
+
+            if f is not None:
+                self.WriteMGFHeader(f)
+
+            print(message)
+            with tqdm(total=len(scans), ncols=70, disable=self.disable_bar) as pbar:
+
+                for chunk in chunks:
+
+                    quant = chunk[chunk[:, 1] == order, 0]
+                    ms2 = chunk[chunk[:, 1] == 2, 0]
+
+                    spectra = read(order, QuantSource, quant, QuantFields, band)
+                    Quant.fill(quant, quantify_reporters(spectra, quant, labels, analyzer))
+
+                    if order == 3:
 
-                Quant[scan][label['Label']] = label
+                        # the SPS ion intensities come from the MS2 scans the MS3 scans were triggered from
+                        parents = self.data['MS3PrecursorScan'].take(quant)
+                        MassLists = read(2, 'MassLists', np.unique(parents))
+
+                        positions = Quant.positions(quant)
+
+                        SPSIntensities[positions] = match_sps_ions(MassLists, parents, SPSMasses[positions],
+                                                                   sps_tolerance, sps_units)
+
+                    if MS2Source is not None:
+
+                        if (order == 2) & (MS2Source == QuantSource):
+                            MS2Data = spectra
+                        else:
+                            MS2Data = read(2, MS2Source, ms2,
+                                           ['Masses', 'Intensities'] if MS2Source == 'LabelData' else None)
+
+                        for scan in ms2.astype(str):
+
+                            if f is not None:
+                                self.WriteMGFScan(f, scan, MS2Data[scan], LookFor, cutoff)
+
+                            if metrics:
+                                MS2MedianIntensity[scan] = np.median(MS2Data[scan][:, 1]) if \
+                                    len(MS2Data[scan]) > 0 else 0
+
+                    pbar.update(len(chunk))
+
+        finally:
+
+            if f is not None:
+                f.close()
+
+        if order == 3:
+            self.data['SPSMasses'] = ScanArray(QuantScans, SPSMasses)
+            self.data['SPSIntensities'] = ScanArray(QuantScans, SPSIntensities)
+            self.flags['SPSIons'] = (sps_tolerance, sps_units)
+
+        if metrics & (MS2Source is not None):
+            self.data['MS2MedianIntensity'] = MS2MedianIntensity
 
         self.data['Quant'] = Quant
         self.data['Labels'] = {str(x['Label']): x for x in labels}
         self.flags['Quantified'] = True
+        self.flags['Streamed'] = True
+
+        self.ToDataFrame()
+
+        if (f is not None) & self.flags['NoMonoisotopicMass']:
+
+            print('WARNING!!!!\n'
+                  'PRECURSOR MONOISOTOPIC M/Z VALUES WERE NOT AVAILABLE!')
+
+    def Shard(self, first, last, NoMonoisotopicMass=False):
+
+        '''
+        Returns a copy of this object which only holds the scans from first to last, with nothing extracted yet and
+        no raw file accessor, so it opens its own when it is first read. Scans of order n before the first scan of
+        order n - 1 are left out, so that every scan has a precursor. Used by ShardQuant.
+
+        NoMonoisotopicMass, bool: whether any MS2 scan of the whole file has no monoisotopic mass, in which case the
+        shard uses the trigger masses as precursor masses (see ExtractPrecursorMass)
+        '''
+
+        shard = copy.copy(self)
+
+        info = self.info.loc[first:last]
+        keep = np.ones(len(info), dtype=bool)
+
+        for order in range(2, self.MetaData['AnalysisOrder'] + 1):
+
+            parents = info['ScanNum'].values[keep & (info['MSOrder'].values == order - 1)]
+            keep &= ~((info['MSOrder'].values == order) & (info['ScanNum'].values < (parents[0] if len(parents) else
+                                                                                    np.inf)))
+
+        shard.info = info[keep]
+        shard.MetaData = copy.deepcopy(self.MetaData)
+        shard.data = {}
+        shard.ParseMatrix = {}
+        shard.Impurities = {}
+        shard._raw = None
+        shard.open = True
+
+        # the cache holds data of the whole file
+        shard.cache = None
+
+        shard.flags = dict((x, False) for x in self.flags)
+        shard.flags['MasterScanNumber'] = self.flags['MasterScanNumber']
+        shard.flags['BoxCar'] = self.flags['BoxCar']
+        shard.flags['NoMonoisotopicMass'] = NoMonoisotopicMass
+
+        for x in ['QuantMatrix', 'IntIndex']:
+            shard.__dict__.pop(x, None)
+
+        return shard
+
+    def ShardQuant(self, reagents, shards, halo=2.0, interference=False, mgf=None, cutoff=None):
+
+        '''
+        Quantifies reporter ions, and optionally MS1 interference, in shards of contiguous scans. Each shard is
+        extracted and quantified by its own spawned process, which loads the .NET runtime and reads the file through
+        its own accessor. The QuantMatrix rows and MGF files of the shards are then merged in scan order. Use this to
+        spread a single large file over several cores.
+
+        Parameters:
+
+        reagents: the labeling reagents, see QuantifyReporters
+        shards, int: the number of shards, and of processes
+        halo, float: the retention time in minutes read either side of each shard, for the precursor scans and
+                    precursor elution peaks of its scans. Elution peaks wider than this may be cut short at the
+                    edges of the shards
+        interference, bool: quantify MS1 interference
+        mgf, str: name of the MGF file to write. None to skip it.
+        cutoff: the MGF mass cutoff, see SaveMGF
+        '''
+
+        if int(shards) < 1:
+            raise ValueError('shards must be an integer greater than zero.')
+
+        labels, message = self.ReporterLabels(reagents)
+
+        if mgf is not None:
+            mgf = mgf if self.MGFSource() is not None else None
+
+        ranges = shard_ranges(self.info['ScanNum'].values, self.info['MSOrder'].values,
+                              self.info['RetentionTime'].values, int(shards), halo)
+
+        print(self.RawFile + ': Quantifying in ' + str(len(ranges)) + ' shards')
+
+        files = [mgf + '.' + str(i) if mgf is not None else None for i in range(len(ranges))]
+
+        def submit(pool, i, NoMonoisotopicMass):
+
+            low, first, last, high = ranges[i]
+
+            shard = self.Shard(low, high, NoMonoisotopicMass)
+            shard.disable_bar = True
+            shard.processes = 1
+
+            return pool.submit(quant_shard, shard, first, last, reagents, interference, files[i], cutoff)
+
+        with process_pool(len(ranges)) as pool:
+
+            results = [x.result() for x in [submit(pool, i, False) for i in range(len(ranges))]]
+
+            # an MS2 scan without a monoisotopic mass anywhere in the file makes every scan use its trigger mass (see
+            # ExtractPrecursorMass), so the shards which did not see one are quantified again with the trigger masses
+            if any(x[1] for x in results):
+
+                redo = [i for i in range(len(ranges)) if not results[i][1]]
+
+                for i, future in [(i, submit(pool, i, True)) for i in redo]:
+                    results[i] = future.result()
+
+        # the boxcar fill time columns depend on the scan filters each shard saw, so they follow the whole file
+        fill_times = self.MassRangeKeys()[1] if self.flags['BoxCar'] else None
+
+        self.QuantMatrix = merge_shards([x[0] for x in results], fill_times)
+        self.flags['NoMonoisotopicMass'] = any(x[1] for x in results)
+
+        if mgf is not None:
+
+            with open(mgf, 'wb') as f:
+
+                self.WriteMGFHeader(f)
+
+                for name in files:
+
+                    with open(name, 'rb') as part:
+                        shutil.copyfileobj(part, f)
+
+                    os.remove(name)
+
+        self.data['Labels'] = {str(x['Label']): x for x in labels}
+        self.flags['Quantified'] = True
+        self.flags['QuantMatrix'] = True
+
+    def MatchSPSIons(self, tolerance=0.01, units='Da'):
+
+        '''
+        Finds the intensity of each SPS ion of the MS3 scans in their parent MS2 scans: the peak closest to the SPS
+        mass, within tolerance (in ppm or Da). The SPS masses and intensities are kept in self.data['SPSMasses'] and
+        self.data['SPSIntensities'], one row per MS3 scan, zero padded.
+        '''
+
+        if (self.flags['MS2PrecursorScan'] == False) | (self.flags['MS3PrecursorScan'] == False):
+            self.ExtractPrecursorScans()
+
+        if self.flags['MS3TrailerExtra'] == False:
+            self.ExtractTrailerExtra(3)
+
+        if self.flags['MS2MassLists'] == False:
+            self.ExtractMSData(2, 'MassLists')
+
+        scans = self.info.loc[self.info['MSOrder'] == 3, 'ScanNum'].values
+
+        SPSMasses = self.data['MS3TrailerExtra'].sps_matrix(scans)
+
+        SPSIntensities = match_sps_ions(self.data['MS2MassLists'], self.data['MS3PrecursorScan'].take(scans),
+                                        SPSMasses, tolerance, units)
+
+        self.data['SPSMasses'] = ScanArray(scans, SPSMasses)
+        self.data['SPSIntensities'] = ScanArray(scans, SPSIntensities)
+
+        # the tolerance the SPS ions were matched with, so they are only matched again if it changes
+        self.flags['SPSIons'] = (tolerance, units)
 
     def LoadImpurities(self, impurities):
 
@@ -1470,7 +1548,6 @@ class RawQuant:
         self.flags['CorrectionMatrix'] = True
 
     def CorrectImpurities(self):
-        from scipy.linalg import solve
 
         if self.flags['QuantMatrix'] == False:
             try:
@@ -1486,58 +1563,28 @@ class RawQuant:
 
         matrix = self.Impurities['CorrectionMatrix'].values.copy().transpose()
 
-        def func(x, pbar, CorrectionMatrix=matrix):
-
-            x = x.copy()
-            good = x.notnull().values
-            x2 = x[good].values
-            CM = CorrectionMatrix[good][:, good]
-
-            if np.sum(good) > 1:
-
-                CMdet = np.linalg.det(CM)
-                new_x = np.zeros(len(x2))
-
-                for y in range(len(x2)):
-                    top = CM.copy()
-                    top[:, y] = x2
-                    new_x[y] = np.linalg.det(top) / CMdet
-
-                corrected = new_x
-
-            elif np.sum(good) == 1:
-                corrected = x2 / CM
-
-            else:
-                corrected = None
-
-            x[good] = corrected
-
-            pbar.update(1)
-
-            return x
-
         df = self.QuantMatrix.copy()
 
-        for x in list(self.data['Labels'].keys()):
-            df[x + '_CorrectedIntensity'] = np.nan
+        labels = list(self.data['Labels'].keys())
 
-        with tqdm(total=len(df.index), ncols=70, disable=self.disable_bar) as bar:
-            print(self.RawFile + ': Performing impurity corrections')
-            CorrectedIntensities = df[[x + '_intensity' for x in list(self.data['Labels'].keys())]].apply(func, axis=1,
-                                                                                                          args=[bar],
-                                                                                                          CorrectionMatrix=matrix)
+        # all scans are solved at once, grouped by which reporters are missing (see RawQuant.quant)
+        print(self.RawFile + ': Performing impurity corrections')
+        corrected = correct_impurities(df[[x + '_intensity' for x in labels]].values, matrix)
 
-        df[[x + '_CorrectedIntensity' for x in list(self.data['Labels'].keys())]] = CorrectedIntensities
+        for i in range(len(labels)):
+            df[labels[i] + '_CorrectedIntensity'] = corrected[:, i]
 
         self.QuantMatrix = df.copy()
         self.flags['ImpuritiesCorrected'] = True
 
-    def ToDataFrame(self, method='quant', parse_order=None):
+    def ToDataFrame(self, method='quant', parse_order=None, sps_tolerance=0.01, sps_units='Da'):
 
         '''
         Casts available data to a Pandas DataFrame. All fields present from the other data
         processing functions will be in the resulting data frame.
+
+        sps_tolerance, sps_units: mass tolerance used to find the SPS ions of MS3 scans in their parent MS2 scans,
+                    in 'ppm' or 'Da'. Not used after StreamQuant, which finds them itself.
         '''
 
         ### initializing ###
@@ -1586,10 +1633,6 @@ class RawQuant:
             if self.flags['MS2PrecursorScan'] == False:
                 self.ExtractPrecursorScans()
 
-            if method == 'quant':
-                if self.flags['MS2MassLists'] == False:
-                    self.ExtractMSData(2, 'MassLists')
-
             if self.flags['MS1TrailerExtra'] == False:
                 self.ExtractTrailerExtra(1)
 
@@ -1610,7 +1653,7 @@ class RawQuant:
             if self.flags['MS3TrailerExtra'] == False:
                 self.ExtractTrailerExtra(3)
 
-            if method == 'quant':
+            if (method == 'quant') & (not self.flags['Streamed']):
                 if self.flags['MS2MassLists'] == False:
                     self.ExtractMSData(2, 'MassLists')
 
@@ -1618,141 +1661,102 @@ class RawQuant:
 
         print(self.RawFile + ': Converting data to DataFrame...')
 
-        df = pd.DataFrame(index=self.info.loc[self.info['MSOrder'] == order, 'ScanNum'])
+        # every column is looked up for all scans at once, in the order of the scan index
+        scans = self.info.loc[self.info['MSOrder'] == order, 'ScanNum'].values
+
+        columns = OD()
+
+        columns['MS' + str(order) + 'ScanNumber'] = scans
+
+        if order == 1:
+
+            MS1scans = scans
 
-        df['MS' + str(order) + 'ScanNumber'] = self.info.loc[self.info['MSOrder'] == order, 'ScanNum']
+        elif order == 2:
 
-        if order == 2:
+            MS2scans = scans
+            MS1scans = self.data['MS2PrecursorScan'].take(MS2scans)
 
-            df['MS1ScanNumber'] = [self.data['MS2PrecursorScan'][str(x)] for x in df['MS2ScanNumber']]
+            columns['MS1ScanNumber'] = MS1scans
 
         elif order == 3:
 
-            df['MS2ScanNumber'] = [self.data['MS3PrecursorScan'][str(x)] for x \
-                                   in df['MS3ScanNumber']]
+            MS2scans = self.data['MS3PrecursorScan'].take(scans)
+            MS1scans = self.data['MS2PrecursorScan'].take(MS2scans)
 
-            df['MS1ScanNumber'] = [self.data['MS2PrecursorScan'][str(x)] for x \
-                                   in df['MS2ScanNumber']]
+            columns['MS2ScanNumber'] = MS2scans
+            columns['MS1ScanNumber'] = MS1scans
 
-        df['QuantScanRetentionTime'] = [self.data['MS' + str(order) + 'RetentionTime'][str(x)] for x in
-                                        df['MS' + str(order) + 'ScanNumber']]
+        columns['QuantScanRetentionTime'] = self.data['MS' + str(order) + 'RetentionTime'].take(scans)
 
         if order > 1:
-            df['PickedRetentionTime'] = [self.data['MS1RetentionTime'][str(x)] for x in df['MS1ScanNumber']]
 
-            df['PeakMaxRetentionTime'] = [self.data['MS1RetentionTime'][str(self.data['PrecursorMaxScan'][str(x)])] for
-                                          x in df['MS2ScanNumber']]
+            elution = self.data['PrecursorElution'].take(MS2scans)
+            intensities = self.data['PrecursorIntensities'].take(MS2scans)
+            edges = self.data['PrecursorEdgeScans'].take(MS2scans)
+
+            columns['PickedRetentionTime'] = self.data['MS1RetentionTime'].take(MS1scans)
 
-            df['PrecursorRetentionWidth'] = [
-                self.data['PrecursorElution'][str(x)][1] - self.data['PrecursorElution'][str(x)][0] for x in
-                df['MS2ScanNumber']]
+            columns['PeakMaxRetentionTime'] = self.data['MS1RetentionTime'].take(
+                self.data['PrecursorMaxScan'].take(MS2scans))
 
-            df['PrecursorMass'] = [self.data['PrecursorMass'][str(x)] for x in
-                                   df['MS2ScanNumber']]
+            columns['PrecursorRetentionWidth'] = elution[:, 1] - elution[:, 0]
 
-            df['PrecursorCharge'] = [self.data['PrecursorCharge'][str(x)] for x in df['MS2ScanNumber']]
+            columns['PrecursorMass'] = self.data['PrecursorMass'].take(MS2scans)
 
-            df['PrecursorPickedIntensity'] = [self.data['PrecursorIntensities'][str(x)]['Picked'] for x in
-                                              df['MS2ScanNumber']]
+            columns['PrecursorCharge'] = self.data['PrecursorCharge'].take(MS2scans)
 
-            df['PrecursorMaxIntensity'] = [self.data['PrecursorIntensities'][str(x)]['Max'] for x in
-                                           df['MS2ScanNumber']]
+            columns['PrecursorPickedIntensity'] = intensities['Picked']
 
-            df['PrecursorArea'] = [self.data['PrecursorArea'][str(x)] for x in df['MS2ScanNumber']]
+            columns['PrecursorMaxIntensity'] = intensities['Max']
 
-            df['MS1FirstQuantScan'] = [self.data['PrecursorEdgeScans'][str(x)][0] for x in df['MS2ScanNumber']]
+            columns['PrecursorArea'] = self.data['PrecursorArea'].take(MS2scans)
 
-            df['MS1LastQuantScan'] = [self.data['PrecursorEdgeScans'][str(x)][1] for x in df['MS2ScanNumber']]
+            columns['MS1FirstQuantScan'] = edges[:, 0]
+
+            columns['MS1LastQuantScan'] = edges[:, 1]
 
         if order >= 1:
             if not self.flags['BoxCar']:
-                df['MS1IonInjectionTime'] = [self.data['MS1TrailerExtra'][str(x)]['Ion Injection Time (ms)'] for x in
-                                             df['MS1ScanNumber']]
+                columns['MS1IonInjectionTime'] = self.data['MS1TrailerExtra'].column('IonInjectionTime', MS1scans)
 
         if order >= 2:
 
-            df['MS2IonInjectionTime'] = [self.data['MS2TrailerExtra'][str(x)]['Ion Injection Time (ms)'] for x in
-                                         df['MS2ScanNumber']]
+            columns['MS2IonInjectionTime'] = self.data['MS2TrailerExtra'].column('IonInjectionTime', MS2scans)
 
         if order >= 3:
 
-            df['MS3IonInjectionTime'] = [self.data['MS3TrailerExtra'][str(x)]['Ion Injection Time (ms)'] for x in
-                                         df['MS3ScanNumber']]
+            columns['MS3IonInjectionTime'] = self.data['MS3TrailerExtra'].column('IonInjectionTime', scans)
 
         if self.flags['MS1Interference']:
-            df['MS1Interference'] = [self.data['MS1Interference'][str(x)] for x in df['MS2ScanNumber']]
+            columns['MS1Interference'] = self.data['MS1Interference'].take(MS2scans)
 
         if method == 'quant':
 
             for datum in ['mass', 'ppm', 'intensity', 'res', 'bl', 'noise']:
 
                 for label in self.data['Labels'].keys():
-                    df[label + '_' + datum] = [self.data['Quant'][str(x)][label][datum]
-                                               for x in df['MS' + str(order) + 'ScanNumber']]
+                    columns[label + '_' + datum] = self.data['Quant'].column(label, datum, scans)
 
             if order == 3:
 
-                try:
-                    # this will work if the SPSs are saved individually in the trailer extra data
-                    for SPS in ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12', '13', '14', '15', '16',
-                                '17', '18', '19', '20']:
-
-                        df['SPSMass' + SPS] = [self.data['MS3TrailerExtra'][str(x)]['SPS Mass ' + SPS]
-                                               for x in df['MS3ScanNumber']]
-
-                    # cast the masses to a numpy array to speed up the next step
-                    SPSMasses = np.asarray(df.loc[:, 'SPSMass1':'SPSMass20'].values, dtype=float)
+                # the SPS masses of each MS3 scan, padded with zeros. Older firmware saves the SPS masses in 20
+                # individual trailer fields, newer firmware saves them as a list; both are parsed the same way.
+                # StreamQuant finds the SPS ion intensities as it goes
+                if (not self.flags['Streamed']) & (self.flags['SPSIons'] != (sps_tolerance, sps_units)):
+                    self.MatchSPSIons(sps_tolerance, sps_units)
 
-                    for SPS in ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12', '13', '14', '15', '16',
-                                '17', '18', '19', '20']:
-                        df['SPSIntensity' + SPS] = [
-                            self.data['MS2MassLists'][str(x)][np.round(self.data['MS2MassLists'][str(x)][:, 0], 2)
-                                                              == np.round(SPSMasses[y, int(SPS) - 1], 2), 1] for x, y in
-                            zip(df['MS2ScanNumber'], range(len(df['MS3ScanNumber'])))]
-
-                except:
-                    # this will work for the new version of Thermo firmware, which saves all to a list as a string
-                    # get a list of lists of the SPS data
-                    SPSs = [[float(x) for x in self.data['MS3TrailerExtra'][str(y)]['SPS Masses'].split(',')[:-1] +
-                             self.data['MS3TrailerExtra'][str(y)]['SPS Masses Continued'].split(',')[:-1]] for y in
-                            df['MS3ScanNumber']]
-
-                    # make the lists all the same length
-                    length = len(sorted(SPSs, key=len, reverse=True)[0])
-                    SPSs = np.array([xi + [0.0] * (length - len(xi)) for xi in SPSs])
-
-                    for SPS in range(length):
-                        df['SPSMass' + str(SPS + 1)] = SPSs[:, SPS]
-
-                    # cast the masses to a numpy array to speed up the next step
-                    SPSMasses = df.loc[:, 'SPSMass1':'SPSMass' + str(length)].values
-
-                    for SPS in range(length):
-                        df['SPSIntensity' + str(SPS + 1)] = [
-                            self.data['MS2MassLists'][str(x)][np.round(self.data['MS2MassLists'][str(x)][:, 0], 2)
-                                                              == np.round(SPSMasses[y, SPS], 2), 1] for x, y in
-                            zip(df['MS2ScanNumber'], range(len(df['MS3ScanNumber'])))]
-
-                for SPS in ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12', '13', '14', '15', '16', '17',
-                            '18', '19', '20']:
-
-                    if 'SPSIntensity' + SPS in df.columns:
-                        df['SPSIntensity' + SPS] = df['SPSIntensity' + SPS].apply(
-                            lambda x: 0.0 if len(x) == 0 else x[0])
-                    else:
-                        None
+                SPSMasses = self.data['SPSMasses'].take(scans)
+                SPSIntensities = self.data['SPSIntensities'].take(scans)
 
                 # clean it up a little by getting rid of columns with all zeros.
+                used = [x for x in range(SPSMasses.shape[1]) if not (SPSMasses[:, x] == 0).all()]
 
-                for SPS in ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12', '13', '14', '15', '16', '17',
-                            '18', '19', '20']:
+                for SPS in used:
+                    columns['SPSMass' + str(SPS + 1)] = SPSMasses[:, SPS]
 
-                    if 'SPSMass' + SPS in df.columns:
-
-                        if (df['SPSMass' + SPS] == 0).all():
-                            del df['SPSMass' + SPS], df['SPSIntensity' + SPS]
-                    else:
-                        None
+                for SPS in used:
+                    columns['SPSIntensity' + str(SPS + 1)] = SPSIntensities[:, SPS]
 
         if self.flags['BoxCar']:
 
@@ -1760,11 +1764,13 @@ class RawQuant:
 
                 self.ExtractMassRangeFillTimes()
 
-            for x in self.data['MassRangeFillTimes'].keys():
+            # the fill time of each mass range, joined on the MS1 scan of each row
+            fill_times = self.data['MassRangeFillTimes'].take(MS1scans)
 
-                for y in self.data['MassRangeFillTimes'][x].keys():
+            for name in fill_times.dtype.names:
+                columns[name] = fill_times[name]
 
-                    df.loc[df['MS1ScanNumber'] == int(x), y] = self.data['MassRangeFillTimes'][x][y]
+        df = pd.DataFrame(columns, index=pd.Index(scans, name='ScanNum'))
 
         if method == 'quant':
             self.QuantMatrix = df
@@ -1774,9 +1780,12 @@ class RawQuant:
             self.ParseMatrix[str(order)] = df
             self.flags['MS' + str(order) + 'Parse'] = True
 
-    def SaveMGF(self, filename='TMTQuantMGF.mgf', cutoff=None):
+    def MGFSource(self):
 
-        ### Error checking ###
+        '''
+        Returns the type of MS2 data which is written to MGF files ('LabelData' or 'MassLists'), or None if an MGF
+        file can not be made.
+        '''
 
         if '2' not in self.MetaData['AnalyzerTypes'].keys():
 
@@ -1785,11 +1794,7 @@ class RawQuant:
 
         if self.MetaData['AnalyzerTypes']['2'] == 'FTMS':
 
-            if not self.flags['MS2LabelData']:
-
-                self.ExtractMSData(2,'LabelData')
-
-            LookFor = 'LabelData'
+            return 'LabelData'
 
         elif self.MetaData['AnalyzerTypes']['2'] == 'ITMS':
 
@@ -1799,11 +1804,50 @@ class RawQuant:
 
                 return None
 
-            if not self.flags['MS2MassLists']:
+            return 'MassLists'
 
-                self.ExtractMSData(2,'MassLists')
+    def WriteMGFHeader(self, f):
+
+        f.write(b'\nMASS=Monoisotopic')
+
+        if self.flags['NoMonoisotopicMass']:
+            f.write(b'\nWARNING!!!! PRECURSOR MASSES ARE NOT MONOISOTOPIC!!!!')
+        f.write(b'\n')
+
+    def WriteMGFScan(self, f, scan, spectrum, LookFor, cutoff=None):
+
+        '''
+        Writes one MS2 scan to an open MGF file.
+        '''
+
+        f.write(b'\nBEGIN IONS' +
+                b'\nTITLE=Spectrum_' + bytes(scan, 'utf-8') +
+                b'\nRAWFILE=' + bytes(self.MetaData['DataFile'], 'utf-8') +
+                b'\nSCANS=' + bytes(scan, 'utf-8') +
+                b'\nRTINSECONDS=' + bytes(str(self.data['MS2RetentionTime'][scan]), 'utf-8') +
+                b'\nPEPMASS=' + bytes(str(self.data['PrecursorMass'][scan]), 'utf-8') +
+                b'\nCHARGE=' + bytes(str(self.data['PrecursorCharge'][scan]), 'utf-8')+b'+' +
+                b'\n')
+
+        if cutoff is not None:
+            scanData = spectrum[spectrum[:, 0] >= cutoff]
+
+        else:
+            scanData = spectrum
+
+        if LookFor == 'MassLists':
+            np.savetxt(f, scanData, delimiter=' ', fmt="%.6f")
 
-            LookFor = 'MassLists'
+        elif LookFor == 'LabelData':
+            np.savetxt(f, scanData[:, :2], delimiter=' ', fmt="%.6f")
+
+        f.write(b'END IONS\n')
+
+    def PrepareMGF(self, cutoff=None):
+
+        '''
+        Extracts the precursor data written to MGF files and checks the mass cutoff.
+        '''
 
         if not self.flags['PrecursorMass']:
 
@@ -1825,43 +1869,57 @@ class RawQuant:
             except ValueError:
                 raise TypeError('Mass cutoff value must be a number.')
 
-        ### Begin mgf creation ###
+        return cutoff
 
-        with open(filename, 'wb') as f:
+    def SaveMGF(self, filename='TMTQuantMGF.mgf', cutoff=None, scans=None, header=True):
 
-            print(self.RawFile+': Writing MGF file')
-            f.write(b'\nMASS=Monoisotopic')
+        '''
+        Writes the MS2 scans to an MGF file.
 
-            if self.flags['NoMonoisotopicMass']:
-                f.write(b'\nWARNING!!!! PRECURSOR MASSES ARE NOT MONOISOTOPIC!!!!')
-            f.write(b'\n')
+        scans: the MS2 scans to write. Defaults to all of them.
+        header, bool: write the MGF header. ShardQuant writes the scans of each shard without it.
+        '''
 
-            MassLists = self.data['MS2'+LookFor]
+        ### Error checking ###
 
-            for scan in tqdm(MassLists.keys(), ncols=70, disable=self.disable_bar):
+        LookFor = self.MGFSource()
 
-                f.write(b'\nBEGIN IONS' +
-                        b'\nTITLE=Spectrum_' + bytes(scan, 'utf-8') +
-                        b'\nRAWFILE=' + bytes(self.MetaData['DataFile'], 'utf-8') +
-                        b'\nSCANS=' + bytes(scan, 'utf-8') +
-                        b'\nRTINSECONDS=' + bytes(str(self.data['MS2RetentionTime'][scan]), 'utf-8') +
-                        b'\nPEPMASS=' + bytes(str(self.data['PrecursorMass'][scan]), 'utf-8') +
-                        b'\nCHARGE=' + bytes(str(self.data['PrecursorCharge'][scan]), 'utf-8')+b'+' +
-                        b'\n')
+        if LookFor is None:
+            return None
 
-                if cutoff is not None:
-                    scanData = MassLists[scan][MassLists[scan][:, 0] >= cutoff]
+        if LookFor == 'LabelData':
 
-                else:
-                    scanData = MassLists[scan]
+            if not self.MSDataAvailable(2, 'LabelData', ['Masses', 'Intensities']):
+
+                self.ExtractMSData(2, 'LabelData', fields=['Masses', 'Intensities'])
+
+        elif LookFor == 'MassLists':
+
+            if not self.flags['MS2MassLists']:
+
+                self.ExtractMSData(2,'MassLists')
+
+        cutoff = self.PrepareMGF(cutoff)
+
+        ### Begin mgf creation ###
 
-                if LookFor == 'MassLists':
-                    np.savetxt(f, scanData, delimiter=' ', fmt="%.6f")
+        with open(filename, 'wb') as f:
+
+            print(self.RawFile+': Writing MGF file')
+
+            if header:
+                self.WriteMGFHeader(f)
+
+            MassLists = self.data['MS2'+LookFor]
+
+            if scans is None:
+                scans = MassLists.keys()
+            else:
+                scans = [str(x) for x in scans]
 
-                elif LookFor == 'LabelData':
-                    np.savetxt(f, scanData[:, :2], delimiter=' ', fmt="%.6f")
+            for scan in tqdm(scans, ncols=70, disable=self.disable_bar):
 
-                f.write(b'END IONS\n')
+                self.WriteMGFScan(f, scan, MassLists[scan], LookFor, cutoff)
 
         if self.flags['NoMonoisotopicMass']:
 
@@ -1914,11 +1972,15 @@ class RawQuant:
             if self.flags['PrecursorPeaks'] == False:
                 self.MS2PrecursorPeaks()
 
-            if (self.MetaData['AnalyzerTypes']['2'] == 'ITMS') & (not self.flags['MS2MassLists']):
+            if 'MS2MedianIntensity' in self.data.keys():
+                None
+
+            elif (self.MetaData['AnalyzerTypes']['2'] == 'ITMS') & (not self.flags['MS2MassLists']):
                 self.ExtractMSData(order=2, dtype='MassLists')
 
-            if (self.MetaData['AnalyzerTypes']['2'] == 'FTMS') & (not self.flags['MS2LabelData']):
-                self.ExtractMSData(order=2, dtype='LabelData')
+            elif (self.MetaData['AnalyzerTypes']['2'] == 'FTMS') & \
+                    (not self.MSDataAvailable(2, 'LabelData', ['Masses', 'Intensities'])):
+                self.ExtractMSData(order=2, dtype='LabelData', fields=['Masses', 'Intensities'])
 
         if order == '0':
             return None
@@ -1932,7 +1994,7 @@ class RawQuant:
         with open(filename, 'w') as f:
 
             order = str(self.MetaData['AnalysisOrder'])
-            time = self.raw.RunHeaderEx.EndTime * 60 - self.raw.RunHeaderEx.StartTime * 60
+            time = self.MetaData['EndTime'] * 60 - self.MetaData['StartTime'] * 60
 
             mins = np.round(time/60, 4)
 
@@ -1967,9 +2029,8 @@ class RawQuant:
                                                str(np.round(time / sum(self.info['MSOrder'] == 1), 4)))
 
             for o in range(1, int(order) + 1):
-                MedianFillTime = np.median(
-                    [self.data['MS' + str(o) + 'TrailerExtra'][str(x)]['Ion Injection Time (ms)'] for
-                     x in self.info.loc[self.info['MSOrder'] == o, 'ScanNum']])
+                MedianFillTime = np.median(self.data['MS' + str(o) + 'TrailerExtra'].column(
+                    'IonInjectionTime', self.info.loc[self.info['MSOrder'] == o, 'ScanNum']))
 
                 f.write('\nMS' + str(o) + ' median ion injection time (ms):\t' + str(np.round(MedianFillTime, 4)))
 
@@ -1980,7 +2041,11 @@ class RawQuant:
 
                 f.write('\nMedian precursor intensity:\t' + str(np.round(MedianIntensity, 4)))
 
-                if self.MetaData['AnalyzerTypes']['2'] == 'ITMS':
+                if 'MS2MedianIntensity' in self.data.keys():
+                    MedianMS2Intensity = np.median([self.data['MS2MedianIntensity'][str(x)]
+                                                    for x in self.info.loc[self.info['MSOrder'] == 2, 'ScanNum']])
+
+                elif self.MetaData['AnalyzerTypes']['2'] == 'ITMS':
                     # there is a possibility a MS2 scan is empty, so we need an if else statement in here
                     MedianMS2Intensity = np.median([np.median(self.data['MS2MassLists'][str(x)][:, 1]) if
                                                     len(self.data['MS2MassLists'][str(x)]) > 0 else 0
@@ -2004,38 +2069,93 @@ class RawQuant:
 
     def Close(self):
 
-        self.raw.Dispose()
+        if self._raw is not None:
+            self._raw.Dispose()
+            self._raw = None
+
         self.open = False
 
+        # lazily read data can not be read any more once the file is closed
+        for key in list(self.data.keys()):
+            if isinstance(self.data[key], RawFileReader.LazyPeakStore):
+                del self.data[key]
+                self.flags[key] = False
+
     def Reopen(self):
 
-        self.raw = RawFileReader.open_raw_file(self.RawFile)
+        # the file is opened again when it is next read from
         self.open = True
 
     def __del__(self):
 
-        if self.raw is not None:
+        if getattr(self, '_raw', None) is not None:
             if self.open:
                 print('Closing ' + self.RawFile)
-                self.raw.Dispose()
+                self._raw.Dispose()
+
+
+# quantifies one shard of RawQuant.ShardQuant in a worker process, and returns the QuantMatrix rows of the scans it
+# owns (first to last), and whether it used the trigger masses because an MS2 scan has no monoisotopic mass
+def quant_shard(shard, first, last, reagents, interference, mgf, cutoff):
+
+    if interference:
+        shard.QuantifyInterference()
+
+    # the full quant spectra are only needed for the MGF file
+    shard.QuantifyReporters(reagents=reagents, reporter_region=mgf is None)
+    shard.ToDataFrame()
+
+    if mgf is not None:
+        MS2scans = shard.info.loc[shard.info['MSOrder'] == 2, 'ScanNum'].values
+        shard.SaveMGF(filename=mgf, cutoff=cutoff, scans=MS2scans[(MS2scans >= first) & (MS2scans <= last)],
+                      header=False)
+
+    quant = shard.QuantMatrix.loc[first:last]
+    NoMonoisotopicMass = shard.flags['NoMonoisotopicMass']
+
+    shard.Close()
+
+    return quant, NoMonoisotopicMass
 
 
 # define a function to be used in parallelism
-def func(msFile, reagents, mgf, interference, impurities, metrics, boxcar, isolationOffset=None):
+def func(msFile, reagents, mgf, interference, impurities, metrics, boxcar, isolationOffset=None, workers=1, cache=None,
+         refresh_cache=False, stream=False, processes=1, shards=1):
     filename = msFile[:-4] + '_QuantData.txt'
-    data = RawQuant(msFile, disable_bar=True, isolationOffset=isolationOffset)
+    MGFfilename = msFile[:-4] + '_MGF.mgf'
+    stream = stream & (reagents is not None)
+
+    data = RawQuant(msFile, disable_bar=True, isolationOffset=isolationOffset, workers=workers,
+                    ms1_mode='lazy' if stream else 'full', cache=cache, refresh_cache=refresh_cache,
+                    processes=processes)
 
     if boxcar:
         data.SetAsBoxcar()
 
-    if reagents is not None:
+    sharded = (shards > 1) & (reagents is not None) & (not stream) & (not metrics)
+
+    if sharded:
+
+        data.ShardQuant(reagents=reagents, shards=shards, interference=interference,
+                        mgf=MGFfilename if mgf else None)
+
+    elif stream:
 
         if interference:
             data.QuantifyInterference()
 
-        data.QuantifyReporters(reagents=reagents)
+        data.StreamQuant(reagents=reagents, mgf=MGFfilename if mgf else None, metrics=metrics)
+
+    else:
+
+        if reagents is not None:
+
+            if interference:
+                data.QuantifyInterference()
+
+            data.QuantifyReporters(reagents=reagents, reporter_region=not (mgf | metrics))
 
-    data.ToDataFrame()
+        data.ToDataFrame()
 
     if impurities is not None:
         data.LoadImpurities(impurities)
@@ -2044,8 +2164,7 @@ def func(msFile, reagents, mgf, interference, impurities, metrics, boxcar, isola
 
     data.SaveData(filename=filename)
 
-    if mgf:
-        MGFfilename = msFile[:-4] + '_MGF.mgf'
+    if mgf & (not stream) & (not sharded):
         data.SaveMGF(filename=MGFfilename)
 
     if metrics:
@@ -115,14 +115,14 @@ if __name__ == "__main__":
         quant = subparsers.add_parser('quant', help=
                 'Parse and quantify data. Possible command line\narguments are:\n'+
                 'REQUIRED: -f or -m or -d, -r or -cr\n'+
-                'OPTIONAL: -o, -mgf, -mtx, -i, -spb, -c, -b\n'+
+                'OPTIONAL: -o, -mgf, -mtx, -i, -spb, -c, -b, -w, -cache, -rc, -stream\n'+
                 'For further help use the command:\n/python -m RawQuant quant -h\n ',
             formatter_class = argparse.RawTextHelpFormatter)
 
         parse = subparsers.add_parser('parse', help=
                 'Parse MS data. Possible command line arguments\nare:\n'+
                 'REQUIRED: -f or -m or -d, -o\n'
-                'OPTIONAL: -mgf, -mtx, -spb, -b\n' +
+                'OPTIONAL: -mgf, -mtx, -spb, -b, -w, -cache, -rc\n' +
                 'For further help use the command:\n/python -m RawQuant parse -h\n ',
             formatter_class = argparse.RawTextHelpFormatter)
 
@@ -160,6 +160,33 @@ if __name__ == "__main__":
                 'Number of CPU cores to be used when processing multiple files.\n'+
                 'If left blank a single core will be used.\n ')
 
+        quant.add_argument('-w', '--workers', default=1, type=int, help=
+                'Number of threads used to extract data from each raw file.\n'+
+                'If left blank a single thread will be used.\n ')
+
+        quant.add_argument('-pc', '--processes', default=1, type=int, help=
+                'Number of processes used for the interference, precursor peak\n'+
+                'and reporter ion calculations of each raw file. If left blank\n'+
+                'they run in a single process.\n ')
+
+        quant.add_argument('-s', '--shards', default=1, type=int, help=
+                'Number of processes each raw file is split across. Each process\n'+
+                'extracts and quantifies a contiguous range of scans, and the\n'+
+                'results are merged. Use this to spread a single large file over\n'+
+                'several cores. Not available with -stream or -metrics.\n ')
+
+        quant.add_argument('-cache', '--cache', nargs='?', const='', default=None, help=
+                'Cache the data extracted from each raw file, so later runs on the same\n'+
+                'file do not have to read it again. Optionally followed by a directory\n'+
+                'for the cache; otherwise it is saved next to the raw file.\n ')
+
+        quant.add_argument('-rc', '--refresh_cache', action='store_true', help=
+                'Discard any cached data and extract everything from the raw file again.\n ')
+
+        quant.add_argument('-stream', '--stream', action='store_true', help=
+                'Read and quantify the MSn scans in chunks instead of extracting them all\n'+
+                'at once, keeping memory use low for very large raw files.\n ')
+
         quant.add_argument('-b', '--boxcar', action='store_true', help=
                 'Indicates that the rawfile is from a boxcar experiment and the program'
                 'should look for multi-injection data.')
@@ -273,6 +300,18 @@ if __name__ == "__main__":
         parse.add_argument('-offset', '--isolation_window_offset', help=
         'Specify the offset of the isolation window, if there was one.')
 
+        parse.add_argument('-w', '--workers', default=1, type=int, help=
+        'Number of threads used to extract data from each raw file.\n'+
+        'If left blank a single thread will be used.\n ')
+
+        parse.add_argument('-cache', '--cache', nargs='?', const='', default=None, help=
+        'Cache the data extracted from each raw file, so later runs on the same\n'+
+        'file do not have to read it again. Optionally followed by a directory\n'+
+        'for the cache; otherwise it is saved next to the raw file.\n ')
+
+        parse.add_argument('-rc', '--refresh_cache', action='store_true', help=
+        'Discard any cached data and extract everything from the raw file again.\n ')
+
         args = parser.parse_args()
 
     else:
@@ -295,6 +334,12 @@ if __name__ == "__main__":
                 self.custom_reagents = None
                 self.subparser_name = None
                 self.metrics = False
+                self.workers = 1
+                self.processes = 1
+                self.shards = 1
+                self.cache = None
+                self.refresh_cache = False
+                self.stream = False
 
         args = cls()
 
@@ -719,7 +764,8 @@ if __name__ == "__main__":
 
             filename = msFile[:-4]+'_ParseData.txt'
             data = RawQuant(msFile, disable_bar=suppress_bar, isolationOffset=args.isolation_window_offset,
-                            boxcar=args.boxcar)
+                            boxcar=args.boxcar, workers=args.workers, cache=args.cache,
+                            refresh_cache=args.refresh_cache)
 
             if args.boxcar:
 
@@ -829,20 +875,44 @@ if __name__ == "__main__":
             for msFile in files:
 
                 filename = msFile[:-4]+'_QuantData.txt'
+                MGFfilename = msFile[:-4]+'_MGF.mgf'
+                stream = args.stream & (reagents is not None)
+
                 data = RawQuant(msFile, order=order, disable_bar=suppress_bar, boxcar=args.boxcar,
-                                isolationOffset=args.isolation_window_offset)
+                                isolationOffset=args.isolation_window_offset, workers=args.workers,
+                                ms1_mode='lazy' if stream else 'full', cache=args.cache,
+                                refresh_cache=args.refresh_cache, processes=args.processes)
 
                 if args.boxcar:
                     data.SetAsBoxcar()
 
-                if reagents is not None:
+                sharded = (args.shards > 1) & (reagents is not None) & (not args.stream) & (not args.metrics)
+
+                if sharded:
+
+                    data.ShardQuant(reagents=reagents, shards=args.shards, interference=args.quantify_interference,
+                                    mgf=MGFfilename if args.generate_mgf else None, cutoff=args.mass_cut_off)
+
+                elif stream:
 
                     if args.quantify_interference:
                         data.QuantifyInterference()
 
-                    data.QuantifyReporters(reagents=reagents)
+                    data.StreamQuant(reagents=reagents, mgf=MGFfilename if args.generate_mgf else None,
+                                     cutoff=args.mass_cut_off, metrics=args.metrics)
+
+                else:
+
+                    if reagents is not None:
+
+                        if args.quantify_interference:
+                            data.QuantifyInterference()
+
+                        # the full quant spectra are only needed for the MGF and metrics files
+                        data.QuantifyReporters(reagents=reagents,
+                                               reporter_region=not (args.generate_mgf | args.metrics))
 
-                data.ToDataFrame()
+                    data.ToDataFrame()
 
                 if impurities is not None:
                     data.LoadImpurities(impurities)
@@ -851,9 +921,8 @@ if __name__ == "__main__":
 
                 data.SaveData(filename=filename)
 
-                if args.generate_mgf:
+                if args.generate_mgf & (not stream) & (not sharded):
 
-                    MGFfilename = msFile[:-4]+'_MGF.mgf'
                     data.SaveMGF(filename=MGFfilename, cutoff=args.mass_cut_off)
 
                 if args.metrics:
@@ -878,4 +947,8 @@ if __name__ == "__main__":
             Parallel(n_jobs=num_cores)(delayed(func)(msFile=msFile, reagents=reagents, mgf=args.generate_mgf,
                                                      interference=args.quantify_interference, impurities=impurities,
                                                      metrics=args.metrics, boxcar=args.boxcar,
-                                                     isolationOffset=args.isolation_window_offset) for msFile in files)
+                                                     isolationOffset=args.isolation_window_offset,
+                                                     workers=args.workers, cache=args.cache,
+                                                     refresh_cache=args.refresh_cache, stream=args.stream,
+                                                     processes=args.processes, shards=args.shards)
+                                       for msFile in files)
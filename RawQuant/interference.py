@@ -0,0 +1,552 @@
+from collections import OrderedDict as OD
+from RawQuant.RawFileReader.peakstore import PeakStore
+from RawQuant.quant import bisect_left, closest_peaks, spectra_segments, unsorted_segments
+import numpy as np
+
+'''
+MS1 interference of many MS2 scans at once.
+
+The isolation window of every MS2 scan is located in the sorted peaks of its precursor MS1 scan with a binary search,
+and the monoisotopic peak and isotope peaks of each precursor are matched in all windows together. The precursor ions
+and the interfering ions of the windows are returned as PeakStores keyed by MS2 scan.
+
+The interfering ions can then be matched to the precursors of other MS2 scans through an index of all precursor
+isotope masses sorted by m/z (correlate_interferences).
+'''
+
+# mass difference between the 13C and 12C isotopes, in Da
+ISOTOPE_SPACING = 1.003355
+
+# the charges for which isotope peaks are looked for
+MAX_CHARGE = 8
+
+
+def sorted_spectra(spectra, scans):
+
+    """
+    Like quant.spectra_segments, but the masses of each scan are sorted (with their intensities) if they were not.
+
+    :return: (masses, intensities, starts, stops)
+    """
+
+    columns, starts, stops = spectra_segments(spectra, scans)
+    masses, intensities = columns[0], columns[1]
+
+    if np.any(unsorted_segments(masses, starts, stops)):
+
+        # sort the peaks of every scan by mass, leaving each scan (and any peaks between the scans) where it is
+        segment = np.zeros(len(masses) + 1, dtype=np.int64)
+        np.add.at(segment, starts, 1)
+        np.add.at(segment, stops, 1)
+        segment = np.cumsum(segment)[:-1]
+
+        order = np.lexsort((masses, segment))
+        masses, intensities = masses[order], intensities[order]
+
+    return masses, intensities, starts, stops
+
+
+def isolation_windows(masses, starts, stops, centers, width):
+
+    """
+    Returns the (start, stop) of the peaks strictly inside the window of the given width around each center, in the
+    sorted masses[starts[i]:stops[i]] of each window.
+    """
+
+    lower = bisect_left(masses, np.nextafter(centers - 0.5 * width, np.inf), starts, stops)
+    upper = bisect_left(masses, centers + 0.5 * width, starts, stops)
+
+    return lower, np.maximum(upper, lower)
+
+
+def window_intervals(parents, centers, width):
+
+    """
+    Groups the isolation windows of many MS2 scans by the MS1 scan they were isolated from, e.g. for
+    RawFileReader.extract_targeted_peaks.
+
+    :param parents: (n) precursor MS1 scan of each MS2 scan
+    :param centers: (n) center of each isolation window
+    :param width: the isolation width
+    :return: OrderedDict of the (m, 2) (low, high) windows of each MS1 scan, keyed by scan number in order
+    """
+
+    parents = np.asarray(parents, dtype=np.int64)
+    centers = np.asarray(centers, dtype=np.float64)
+
+    order = np.argsort(parents, kind='stable')
+    scans, counts = np.unique(parents[order], return_counts=True)
+
+    windows = np.column_stack((centers[order] - 0.5 * width, centers[order] + 0.5 * width))
+
+    return OD(zip(scans, np.split(windows, np.cumsum(counts)[:-1])))
+
+
+def match_isotopes(masses, starts, stops, monoisotopic, charges, ppm=4, isotopes=1, lower_isotopes=1,
+                   lower_mass=1000):
+
+    """
+    Finds the monoisotopic and isotope peaks of many precursors, each in its own sorted segment of masses.
+
+    A peak matches if abs(peak - expected) / peak * 10 ** 6 < ppm, and the closest peak to each expected mass is used.
+    Isotope peaks are looked for at multiples of 1.003355 / charge above the monoisotopic mass, for charges 1 to 8.
+    The n-th isotope peak only matches if the ones before it did. Isotope peaks below the monoisotopic mass are only
+    looked for if monoisotopic mass * charge is over lower_mass, in case the monoisotopic peak was misassigned.
+
+    :param masses: flat array of sorted peak masses
+    :param starts: (n) start of each segment
+    :param stops: (n) stop of each segment
+    :param monoisotopic: (n) monoisotopic m/z of each precursor
+    :param charges: (n) charge of each precursor
+    :param ppm: the mass tolerance
+    :param isotopes: the number of isotope peaks above the monoisotopic peak
+    :param lower_isotopes: the number of isotope peaks below the monoisotopic peak
+    :param lower_mass: see above
+    :return: (n, lower_isotopes + 1 + isotopes) positions of the matched peaks in masses, -1 where nothing matched.
+             The columns are the isotopes from the lowest to the highest mass
+    """
+
+    steps, expected, allowed = isotope_targets(monoisotopic, charges, isotopes, lower_isotopes, lower_mass)
+
+    matched = closest_peaks(masses, starts, stops, expected, np.inf)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        peaks = masses[np.maximum(matched, 0)] if len(masses) > 0 else np.zeros(matched.shape)
+        valid = (matched >= 0) & (np.abs(peaks - expected) / peaks * 10 ** 6 < ppm) & allowed
+
+    return np.where(in_order(valid, steps), matched, -1)
+
+
+def isotope_targets(monoisotopic, charges, isotopes=1, lower_isotopes=1, lower_mass=1000):
+
+    """
+    The expected masses of the monoisotopic and isotope peaks of many precursors (see match_isotopes).
+
+    :return: (steps, expected, allowed): the isotope number of each column, the (n, k) expected masses and whether
+             each one is looked for
+    """
+
+    monoisotopic = np.asarray(monoisotopic, dtype=np.float64)
+    charges = np.asarray(charges, dtype=np.int64)
+
+    steps = np.arange(-lower_isotopes, isotopes + 1)
+
+    charged = (charges >= 1) & (charges <= MAX_CHARGE)
+    spacing = np.where(charged, ISOTOPE_SPACING / np.where(charged, charges, 1), 0)
+
+    expected = monoisotopic[:, None] + steps[None, :] * spacing[:, None]
+
+    allowed = np.ones(expected.shape, dtype=bool)
+    allowed[:, steps != 0] &= charged[:, None]
+    allowed[:, steps < 0] &= (monoisotopic * charges > lower_mass)[:, None]
+
+    return steps, expected, allowed
+
+
+def in_order(valid, steps):
+
+    """
+    Keeps the isotope peaks which were found in order, outwards from the monoisotopic peak.
+    """
+
+    valid = valid.copy()
+
+    above, below = steps > 0, steps < 0
+    valid[:, above] = np.cumprod(valid[:, above], axis=1).astype(bool)
+    valid[:, below] = np.cumprod(valid[:, below][:, ::-1], axis=1)[:, ::-1].astype(bool)
+
+    return valid
+
+
+def centroid_interference(spectra, scans, parents, monoisotopic, charges, width, ppm=4, isotopes=1,
+                          lower_isotopes=1):
+
+    """
+    Calculates the MS1 interference of many MS2 scans from centroid MS1 spectra: the percentage of the intensity in
+    the isolation window of each MS2 scan which is not from the monoisotopic or isotope peaks of its precursor.
+
+    :param spectra: PeakStore or mapping of str(scan) to (n, fields) arrays of the MS1 scans, masses and intensities
+                    first
+    :param scans: (n) MS2 scan numbers
+    :param parents: (n) precursor MS1 scan of each MS2 scan
+    :param monoisotopic: (n) precursor m/z of each MS2 scan
+    :param charges: (n) precursor charge of each MS2 scan
+    :param width: the isolation width
+    :param ppm: the tolerance of the precursor and isotope peaks
+    :param isotopes: the number of isotope peaks above the monoisotopic peak (see match_isotopes)
+    :param lower_isotopes: the number of isotope peaks below the monoisotopic peak
+    :return: (interference, window peaks, precursor ions, interfering ions). The interference is an (n) array, NaN
+             where the window holds no peaks. The others are PeakStores of the masses and intensities of each MS2 scan
+    """
+
+    scans = np.asarray(scans, dtype=np.int64)
+    parents = np.asarray(parents, dtype=np.int64)
+    monoisotopic = np.asarray(monoisotopic, dtype=np.float64)
+
+    # each MS1 scan is read once, however many MS2 scans it was the precursor of
+    unique, inverse = np.unique(parents, return_inverse=True)
+
+    masses, intensities, starts, stops = sorted_spectra(spectra, unique)
+    starts, stops = starts[inverse.ravel()], stops[inverse.ravel()]
+
+    lower, upper = isolation_windows(masses, starts, stops, monoisotopic, width)
+
+    matched = match_isotopes(masses, lower, upper, monoisotopic, charges, ppm, isotopes, lower_isotopes)
+
+    cumulative = np.concatenate([[0], np.cumsum(intensities)])
+    total = cumulative[upper] - cumulative[lower]
+    precursor = np.where(matched >= 0, intensities[np.maximum(matched, 0)] if len(masses) else 0, 0).sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        interference = (total - precursor) / total * 100
+
+    interference[upper == lower] = np.nan
+
+    # the numerical noise around 0 is cleaned up, as for the profile calculation
+    interference[np.abs(interference) < 10 ** -6] = 0
+
+    # every peak in each window, one window after the other
+    lengths = upper - lower
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    rows = np.repeat(np.arange(len(scans)), lengths)
+    peaks = np.repeat(lower - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+    keys = rows * (len(masses) + 1) + peaks
+    matched_keys = (np.arange(len(scans))[:, None] * (len(masses) + 1) + matched)[matched >= 0]
+    precursor_ion = np.isin(keys, matched_keys)
+
+    def store(mask):
+
+        counts = np.bincount(rows[mask], minlength=len(scans))
+
+        return PeakStore(scans, np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                         np.vstack([masses[peaks[mask]], intensities[peaks[mask]]]), ['Masses', 'Intensities'])
+
+    return interference, store(np.ones(len(peaks), dtype=bool)), store(precursor_ion), store(~precursor_ion)
+
+
+def window_segments(masses, intensities, lower, upper):
+
+    """
+    Copies the peaks masses[lower[i]:upper[i]] of every window one after the other, so windows which overlap in a
+    scan can be treated separately.
+
+    :return: (masses, intensities, offsets) of the windows, the i-th in [offsets[i]:offsets[i + 1]]
+    """
+
+    lengths = upper - lower
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    peaks = np.repeat(lower - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+    return masses[peaks], intensities[peaks], offsets
+
+
+def segment_gradient(x, y, offsets):
+
+    """
+    np.gradient(y[a:b], x[a:b]) of every segment [a:b] given by offsets, all at once: second order central
+    differences inside each segment and first order differences at its ends. Segments of one point have a gradient
+    of 0.
+    """
+
+    gradient = np.zeros(len(y))
+
+    if len(y) < 2:
+        return gradient
+
+    first = np.zeros(len(y), dtype=bool)
+    first[offsets[:-1][np.diff(offsets) > 0]] = True
+    last = np.zeros(len(y), dtype=bool)
+    last[offsets[1:][np.diff(offsets) > 0] - 1] = True
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        # inside: the points on both sides, with uneven spacing
+        inner = np.flatnonzero(~first & ~last)
+        hs = x[inner] - x[inner - 1]
+        hd = x[inner + 1] - x[inner]
+        gradient[inner] = (hs ** 2 * y[inner + 1] + (hd ** 2 - hs ** 2) * y[inner] - hd ** 2 * y[inner - 1]) / (
+            hs * hd * (hd + hs))
+
+        # the ends: one sided differences
+        forward = np.flatnonzero(first & ~last)
+        gradient[forward] = (y[forward + 1] - y[forward]) / (x[forward + 1] - x[forward])
+
+        backward = np.flatnonzero(last & ~first)
+        gradient[backward] = (y[backward] - y[backward - 1]) / (x[backward] - x[backward - 1])
+
+    return gradient
+
+
+def profile_peaks(masses, intensities, offsets, gradient, rows, targets, half_widths):
+
+    """
+    Finds the profile peak of each target mass in its segment, and the boundaries of the peak.
+
+    The apex is the most intense point strictly within half_width of the target. The peak runs down from the apex on
+    both sides for as long as the gradient does: the lower boundary is the last point before the apex where the
+    gradient is not positive, and the upper boundary is the first point after the apex where it is not negative. If
+    the segment ends first, the peak is truncated at that end.
+
+    :param masses: flat array of sorted profile masses
+    :param intensities: flat array of intensities
+    :param offsets: segment offsets (see window_segments)
+    :param gradient: the gradient of the intensities in each segment (see segment_gradient)
+    :param rows: (m) segment of each target
+    :param targets: (m) target masses
+    :param half_widths: (m) the distance from each target in which the apex is looked for
+    :return: OrderedDict of (m) arrays: 'Apex' position (-1 if there is no point near the target), 'Lower' position
+             (inclusive), 'Upper' position (exclusive), and the 'LowerTruncated' and 'UpperTruncated' flags
+    """
+
+    starts, stops = offsets[rows], offsets[rows + 1]
+
+    low = bisect_left(masses, np.nextafter(targets - half_widths, np.inf), starts, stops)
+    high = np.maximum(bisect_left(masses, targets + half_widths, starts, stops), low)
+
+    found = high > low
+
+    # the first most intense point of each range
+    lengths = np.where(found, high - low, 0)
+    points = np.repeat(low - np.cumsum(np.concatenate([[0], lengths[:-1]])), lengths) + np.arange(lengths.sum())
+    owner = np.repeat(np.arange(len(targets)), lengths)
+
+    maximum = np.full(len(targets), -np.inf)
+    np.maximum.at(maximum, owner, intensities[points])
+
+    top = points[intensities[points] == maximum[owner]]
+    _, first = np.unique(owner[intensities[points] == maximum[owner]], return_index=True)
+
+    apex = np.full(len(targets), -1, dtype=np.int64)
+    apex[found] = top[first]
+
+    # the points where the peak stops falling, on each side
+    not_falling = np.flatnonzero(gradient >= 0)
+    not_rising = np.flatnonzero(gradient <= 0)
+
+    # a boundary outside the segment (or none at all) means the peak runs into the end of the segment
+    i = np.searchsorted(not_falling, apex + 1, 'left')
+    upper = not_falling[np.minimum(i, len(not_falling) - 1)] if len(not_falling) > 0 else stops
+    upper_truncated = (i >= len(not_falling)) | (upper >= stops)
+    upper = np.where(upper_truncated, stops, upper)
+
+    i = np.searchsorted(not_rising, apex - 1, 'right') - 1
+    lower = not_rising[np.maximum(i, 0)] if len(not_rising) > 0 else starts
+    lower_truncated = (i < 0) | (lower < starts)
+    lower = np.where(lower_truncated, starts, lower)
+
+    out = OD()
+    out['Apex'] = apex
+    out['Lower'] = np.where(found, lower, -1)
+    out['Upper'] = np.where(found, upper, -1)
+    out['LowerTruncated'] = found & lower_truncated
+    out['UpperTruncated'] = found & upper_truncated
+
+    return out
+
+
+def profile_interference(profiles, centroids, scans, parents, monoisotopic, charges, width, isotopes=1,
+                         lower_isotopes=1):
+
+    """
+    Calculates the MS1 interference of many MS2 scans from profile MS1 spectra: the percentage of the area of the
+    isolation window of each MS2 scan which is not under the monoisotopic or isotope peaks of its precursor.
+
+    The peaks are looked for within mass / resolution of their expected masses, using the resolution of the centroid
+    closest to the precursor mass, and integrated between their boundaries (see profile_peaks). Isotope peaks are
+    found as for centroid data (see match_isotopes).
+
+    :param profiles: PeakStore or mapping of str(scan) to (n, 2) arrays of the profile MS1 spectra
+    :param centroids: PeakStore or mapping of str(scan) to (n, fields) arrays of the centroid MS1 spectra, with the
+                      masses, intensities and resolutions
+    :param scans: (n) MS2 scan numbers
+    :param parents: (n) precursor MS1 scan of each MS2 scan
+    :param monoisotopic: (n) precursor m/z of each MS2 scan
+    :param charges: (n) precursor charge of each MS2 scan
+    :param width: the isolation width
+    :param isotopes: the number of isotope peaks above the monoisotopic peak
+    :param lower_isotopes: the number of isotope peaks below the monoisotopic peak
+    :return: (interference, window points, truncated). The interference is an (n) array, NaN where the window, the
+             centroids or the monoisotopic peak are missing. The window points are a PeakStore of the masses and
+             intensities of each MS2 scan. truncated is an (n, 2) array flagging the scans whose precursor peaks were
+             cut off by the low or high end of the window
+    """
+
+    scans = np.asarray(scans, dtype=np.int64)
+    parents = np.asarray(parents, dtype=np.int64)
+    monoisotopic = np.asarray(monoisotopic, dtype=np.float64)
+
+    unique, inverse = np.unique(parents, return_inverse=True)
+    inverse = inverse.ravel()
+
+    # the resolution of the centroid closest to each precursor
+    columns, starts, stops = spectra_segments(centroids, unique)
+    closest = closest_peaks(columns[0], starts[inverse], stops[inverse], monoisotopic[:, None], np.inf)[:, 0]
+    resolutions = np.where(closest >= 0, columns[2][np.maximum(closest, 0)] if len(columns[0]) else 0, np.nan)
+
+    # the profile points of each isolation window
+    masses, intensities, starts, stops = sorted_spectra(profiles, unique)
+    lower, upper = isolation_windows(masses, starts[inverse], stops[inverse], monoisotopic, width)
+
+    masses, intensities, offsets = window_segments(masses, intensities, lower, upper)
+    gradient = segment_gradient(masses, intensities, offsets)
+
+    steps, expected, allowed = isotope_targets(monoisotopic, charges, isotopes, lower_isotopes)
+
+    rows = np.repeat(np.arange(len(scans)), len(steps))
+    peaks = profile_peaks(masses, intensities, offsets, gradient, rows, expected.ravel(),
+                          (expected / resolutions[:, None]).ravel())
+
+    valid = in_order((peaks['Apex'] >= 0).reshape(expected.shape) & allowed, steps)
+
+    # the areas are integrated from the cumulative trapezoids. the peaks are in order of mass, so a peak which
+    # overlaps the one before it starts where that one ended
+    trapezoids = np.concatenate([[0], np.cumsum((intensities[1:] + intensities[:-1]) / 2 * np.diff(masses))]) \
+        if len(masses) > 1 else np.zeros(2)
+
+    def area(a, b):
+
+        # np.trapz(intensities[a:b], masses[a:b])
+        a, b = np.minimum(a, len(trapezoids) - 1), np.maximum(b - 1, 0)
+
+        return np.where(b > a, trapezoids[b] - trapezoids[a], 0)
+
+    lows = np.where(valid, peaks['Lower'].reshape(expected.shape), 0)
+    highs = np.where(valid, peaks['Upper'].reshape(expected.shape), 0)
+    lows = np.maximum(lows, np.maximum.accumulate(np.concatenate([np.zeros((len(scans), 1), dtype=np.int64),
+                                                                  highs[:, :-1]], axis=1), axis=1))
+    highs = np.maximum(highs, lows)
+
+    precursor = np.where(valid, area(lows, highs), 0).sum(axis=1)
+    total = area(offsets[:-1], offsets[1:])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        interference = (total - precursor) / total * 100
+
+    interference[~valid[:, steps == 0][:, 0] | np.isnan(resolutions) | (offsets[1:] == offsets[:-1])] = np.nan
+    interference[np.abs(interference) < 10 ** -6] = 0
+
+    truncated = np.column_stack([(valid & peaks['LowerTruncated'].reshape(expected.shape)).any(axis=1),
+                                 (valid & peaks['UpperTruncated'].reshape(expected.shape)).any(axis=1)])
+
+    windows = PeakStore(scans, offsets, np.vstack([masses, intensities]), ['Masses', 'Intensities'])
+
+    return interference, windows, truncated
+
+
+def correlate_interferences(ions, scans, monoisotopic, charges, retention_times, ppm=4, rt_window=5, isotopes=2,
+                            lower_isotopes=1):
+
+    """
+    Matches the interfering ions of many MS2 scans to the precursors of other MS2 scans eluting nearby.
+
+    The monoisotopic and isotope masses of all precursors (see isotope_targets) are sorted into one index. The
+    precursors an interfering ion could come from are found in it with a binary search, and kept if they are within
+    rt_window percent of the retention time of the MS2 scan the ion interferes with.
+
+    :param ions: PeakStore or mapping of str(scan) to (n, 2) arrays of the interfering ions of each MS2 scan
+    :param scans: (n) MS2 scan numbers
+    :param monoisotopic: (n) precursor m/z of each MS2 scan
+    :param charges: (n) precursor charge of each MS2 scan
+    :param retention_times: (n) retention time of each MS2 scan
+    :param ppm: the tolerance between an ion and a precursor isotope, abs(isotope - ion) / ion * 10 ** 6 < ppm
+    :param rt_window: the retention time tolerance, in percent
+    :param isotopes: the number of isotope peaks above the monoisotopic peak in the index
+    :param lower_isotopes: the number of isotope peaks below the monoisotopic peak in the index
+    :return: (rows, masses, correlated): one entry per (MS2 scan, interfering ion, correlated MS2 scan), with the
+             scans given as positions in scans
+    """
+
+    scans = np.asarray(scans, dtype=np.int64)
+    retention_times = np.asarray(retention_times, dtype=np.float64)
+
+    _, expected, allowed = isotope_targets(monoisotopic, charges, isotopes, lower_isotopes, lower_mass=0)
+
+    owners = np.broadcast_to(np.arange(len(scans))[:, None], expected.shape)[allowed]
+    index = expected[allowed]
+    order = np.argsort(index, kind='stable')
+    index, owners = index[order], owners[order]
+
+    # every interfering ion, with the MS2 scan it interferes with
+    columns, starts, stops = spectra_segments(ions, scans)
+    lengths = stops - starts
+    rows = np.repeat(np.arange(len(scans)), lengths)
+    masses = columns[0][np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())] \
+        if len(rows) > 0 else np.zeros(0)
+
+    tolerance = masses * ppm * 10 ** -6
+    first = np.searchsorted(index, masses - tolerance, 'right')
+    last = np.searchsorted(index, masses + tolerance, 'left')
+
+    counts = np.maximum(last - first, 0)
+    ion = np.repeat(np.arange(len(masses)), counts)
+    candidates = owners[np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())] \
+        if len(ion) > 0 else np.zeros(0, dtype=np.int64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nearby = np.abs(retention_times[candidates] - retention_times[rows[ion]]) / retention_times[rows[ion]] * 100 \
+            < rt_window
+
+    keep = nearby & (candidates != rows[ion])
+    ion, candidates = ion[keep], candidates[keep]
+
+    # an ion may match more than one isotope of the same precursor
+    unique = np.unique(ion * len(scans) + candidates)
+    ion, candidates = unique // max(len(scans), 1), unique % max(len(scans), 1)
+
+    return rows[ion], masses[ion], candidates
+
+
+def ion_misses(spectra, ms1_scans, first, last, masses, ppm=4, chunk_size=2 ** 22):
+
+    """
+    Counts the MS1 scans from first to last (or last to first) in which an ion was not seen, for many ions at once.
+
+    :param spectra: PeakStore or mapping of str(scan) to (n, 2) arrays of the MS1 scans, masses and intensities first
+    :param ms1_scans: the MS1 scan numbers, sorted
+    :param first: (n) scan number at one end of the range of each ion
+    :param last: (n) scan number at the other end
+    :param masses: (n) m/z of each ion
+    :param ppm: an ion is seen if an MS1 peak is within abs(peak - ion) / ion * 10 ** 6 < ppm of it
+    :param chunk_size: the number of (ion, MS1 scan) pairs checked together
+    :return: (n) the number of MS1 scans in the range of each ion without a peak of it
+    """
+
+    ms1_scans = np.asarray(ms1_scans, dtype=np.int64)
+    masses = np.asarray(masses, dtype=np.float64)
+
+    begin = np.searchsorted(ms1_scans, np.minimum(first, last), 'left')
+    end = np.searchsorted(ms1_scans, np.maximum(first, last), 'right')
+    counts = end - begin
+
+    # only the MS1 scans in at least one range are read
+    covered = np.zeros(len(ms1_scans) + 1, dtype=np.int64)
+    np.add.at(covered, begin, 1)
+    np.add.at(covered, end, -1)
+    needed = np.flatnonzero(np.cumsum(covered)[:-1] > 0)
+
+    peaks, intensities, starts, stops = sorted_spectra(spectra, ms1_scans[needed])
+
+    misses = np.zeros(len(masses), dtype=np.int64)
+
+    # the (ion, MS1 scan) pairs are checked a chunk of ions at a time
+    cumulative = np.cumsum(counts)
+    i = 0
+
+    while i < len(masses):
+
+        j = max(int(np.searchsorted(cumulative, (cumulative[i - 1] if i > 0 else 0) + chunk_size, 'right')), i + 1)
+
+        lengths = counts[i:j]
+        ion = np.repeat(np.arange(i, j), lengths)
+        scan = np.searchsorted(needed, np.repeat(begin[i:j] - np.cumsum(lengths) + lengths, lengths) +
+                               np.arange(lengths.sum()))
+
+        matched = closest_peaks(peaks, starts[scan], stops[scan], masses[ion][:, None],
+                                masses[ion][:, None] * ppm * 10 ** -6)[:, 0]
+
+        misses += np.bincount(ion[matched < 0], minlength=len(masses))
+
+        i = j
+
+    return misses
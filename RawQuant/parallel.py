@@ -0,0 +1,359 @@
+from collections import OrderedDict as OD
+from concurrent.futures import ProcessPoolExecutor
+from RawQuant.RawFileReader.peakstore import LazyPeakStore, PeakStore
+from RawQuant.precursors import XICIndex, cluster_masses, precursor_peaks
+import multiprocessing
+import numpy as np
+import pandas as pd
+import sys
+
+'''
+Process pool for the calculations which run on extracted data (interference, precursor peaks, reporter ions), and the
+splitting of a file into shards of scans which are extracted and quantified by separate processes.
+
+The large inputs, e.g. the MS1 PeakStore, are published once in shared memory and attached by the worker processes
+without being copied or pickled. The per scan inputs are split into consecutive chunks, each chunk is calculated in
+a worker, and the results are gathered into preallocated arrays in scan order.
+
+The workers are spawned rather than forked: the parent holds the .NET runtime loaded by pythonnet and its threads,
+which do not survive a fork. multiprocessing.shared_memory needs Python 3.8, so it is only imported when a pool is
+used, and RawQuant itself still imports on older versions.
+'''
+
+# the shared memory blocks attached in this process, by name. they stay open while the process lives
+_attached = OD()
+
+
+class SharedData:
+
+    '''
+    Publishes numpy arrays, and objects holding them (PeakStore, XICIndex...), in shared memory. share() returns a
+    picklable description from which attach() rebuilds the value in another process. The blocks are freed by close().
+    '''
+
+    def __init__(self):
+
+        self.blocks = []
+
+    def share(self, value):
+
+        if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+
+            from multiprocessing import shared_memory
+
+            block = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+            self.blocks.append(block)
+
+            np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)[...] = value
+
+            return 'array', block.name, value.shape, value.dtype
+
+        if isinstance(value, list) and all(isinstance(x, np.ndarray) for x in value):
+            return 'list', [self.share(x) for x in value]
+
+        if isinstance(value, (PeakStore, XICIndex)):
+            return 'object', type(value), OD((x, self.share(y)) for x, y in vars(value).items())
+
+        return 'value', value
+
+    def close(self):
+
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+        self.blocks = []
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+def attach(description):
+
+    '''
+    Rebuilds a value published with SharedData.share().
+    '''
+
+    kind = description[0]
+
+    if kind == 'array':
+
+        _, name, shape, dtype = description
+
+        if name not in _attached:
+
+            from multiprocessing import resource_tracker, shared_memory
+
+            # the block belongs to the process which published it, and is unlinked there by SharedData.close(), so
+            # it is not registered with the resource tracker here. otherwise a tracker of this process would unlink it
+            # as leaked, and a tracker shared with the publishing process would lose its entry when it is unregistered
+            if sys.version_info >= (3, 13):
+                _attached[name] = shared_memory.SharedMemory(name=name, track=False)
+            else:
+                register = resource_tracker.register
+                resource_tracker.register = lambda *args: None
+
+                try:
+                    _attached[name] = shared_memory.SharedMemory(name=name)
+                finally:
+                    resource_tracker.register = register
+
+        return np.ndarray(shape, dtype=dtype, buffer=_attached[name].buf)
+
+    if kind == 'list':
+        return [attach(x) for x in description[1]]
+
+    if kind == 'object':
+
+        value = description[1].__new__(description[1])
+        value.__dict__.update((x, attach(y)) for x, y in description[2].items())
+
+        return value
+
+    return description[1]
+
+
+def shareable(value):
+
+    '''
+    Whether a value can be published in shared memory. Lazy stores read from the raw file, so they can not.
+    '''
+
+    return not isinstance(value, LazyPeakStore)
+
+
+def process_pool(processes):
+
+    '''
+    A pool of processes processes, started with the spawn method (see above).
+    '''
+
+    if sys.version_info < (3, 8):
+        raise RuntimeError('calculations in several processes need Python 3.8 or newer')
+
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+
+
+def chunk_bounds(n, processes, breaks=None):
+
+    '''
+    Splits n items into about 4 chunks per process. If breaks is given, the chunks only start at those positions.
+
+    :return: (chunks + 1) array of the chunk boundaries
+    '''
+
+    targets = np.linspace(0, n, max(1, min(n, 4 * processes)) + 1).astype(np.int64)
+
+    if breaks is None:
+        return np.unique(targets)
+
+    breaks = np.union1d(np.asarray(breaks, dtype=np.int64), [0, n])
+
+    return np.unique(breaks[np.searchsorted(breaks, targets, 'left')])
+
+
+def _run(function, shared, sliced, fixed):
+
+    kwargs = OD((x, attach(y)) for x, y in shared.items())
+    kwargs.update(sliced)
+    kwargs.update(fixed)
+
+    return function(**kwargs)
+
+
+def map_chunks(function, shared, sliced, fixed, bounds, processes):
+
+    '''
+    Calls function(**shared, **sliced, **fixed) for every chunk of the sliced arguments in a pool of processes.
+
+    :param function: a module level function
+    :param shared: dict of the arguments published in shared memory, given whole to every chunk
+    :param sliced: dict of the per item arguments, arrays which are split into chunks
+    :param fixed: dict of the other arguments, given to every chunk
+    :param bounds: the chunk boundaries (see chunk_bounds)
+    :param processes: the number of processes
+    :return: list of the result of each chunk, in order
+    '''
+
+    with SharedData() as data:
+
+        published = OD((x, data.share(y)) for x, y in shared.items())
+
+        with process_pool(min(processes, max(len(bounds) - 1, 1))) as pool:
+
+            futures = [pool.submit(_run, function, published, OD((x, y[a:b]) for x, y in sliced.items()), fixed)
+                       for a, b in zip(bounds[:-1], bounds[1:])]
+
+            return [x.result() for x in futures]
+
+
+def gather(results, bounds):
+
+    '''
+    Joins the results of the chunks into the result of all items. Arrays with one row per item are copied into a
+    preallocated array in order, PeakStores are concatenated, and tuples and dicts are gathered item by item.
+    '''
+
+    first = results[0]
+    n = bounds[-1]
+
+    if isinstance(first, tuple):
+        return tuple(gather([x[i] for x in results], bounds) for i in range(len(first)))
+
+    if isinstance(first, dict):
+        return type(first)((x, gather([y[x] for y in results], bounds)) for x in first)
+
+    if isinstance(first, PeakStore):
+        return PeakStore.concatenate(results)
+
+    out = np.empty((n,) + first.shape[1:], dtype=first.dtype)
+
+    for result, a, b in zip(results, bounds[:-1], bounds[1:]):
+        out[a:b] = result
+
+    return out
+
+
+def compute(function, shared, sliced, fixed, processes=1, bounds=None):
+
+    '''
+    Calls function(**shared, **sliced, **fixed) over chunks of the sliced arguments in processes processes and
+    gathers the results (see map_chunks and gather). Runs in this process if processes is 1, there are too few items
+    to split, or a shared argument can not be published.
+    '''
+
+    n = len(next(iter(sliced.values())))
+
+    if bounds is None:
+        bounds = chunk_bounds(n, processes)
+
+    if (processes < 2) | (len(bounds) < 3) | (not all(shareable(x) for x in shared.values())):
+
+        kwargs = OD(shared)
+        kwargs.update(sliced)
+        kwargs.update(fixed)
+
+        return function(**kwargs)
+
+    return gather(map_chunks(function, shared, sliced, fixed, bounds, processes), bounds)
+
+
+def compute_precursor_peaks(index, starts, masses, retention_times, ppm=4, share=True, processes=1):
+
+    '''
+    precursors.precursor_peaks over chunks of the precursors. If share is True, the groups of masses from
+    precursors.cluster_masses are kept whole in one chunk, and the chunks are in order of mass, so the results are the
+    same as from one call.
+    '''
+
+    starts = np.asarray(starts, dtype=np.int64)
+    masses = np.asarray(masses, dtype=np.float64)
+
+    if share:
+        groups, _ = cluster_masses(masses, ppm)
+    else:
+        groups = np.arange(len(masses))
+
+    order = np.argsort(groups, kind='stable')
+
+    bounds = chunk_bounds(len(masses), processes, np.flatnonzero(np.diff(groups[order])) + 1)
+
+    if (processes < 2) | (len(bounds) < 3) | (not shareable(index)):
+        return precursor_peaks(index, starts, masses, retention_times, ppm, share)
+
+    results = map_chunks(precursor_peaks, OD([('index', index)]),
+                         OD([('starts', starts[order]), ('masses', masses[order])]),
+                         OD([('retention_times', retention_times), ('ppm', ppm), ('share', share)]), bounds,
+                         processes)
+
+    out = OD()
+
+    # the chromatograms of each chunk follow those of the chunks before it
+    counts = np.cumsum([0] + [len(x['Offsets']) - 1 for x in results])
+    lengths = np.cumsum([0] + [x['Offsets'][-1] for x in results])
+
+    for key in results[0]:
+
+        if key == 'Offsets':
+            out[key] = np.concatenate([[0]] + [x[key][1:] + y for x, y in zip(results, lengths)]).astype(np.int64)
+
+        elif key == 'Profiles':
+            out[key] = np.concatenate([x[key] for x in results])
+
+        else:
+            out[key] = np.empty((len(masses),) + results[0][key].shape[1:], dtype=results[0][key].dtype)
+
+            for x, y, a, b in zip(results, counts, bounds[:-1], bounds[1:]):
+                out[key][order[a:b]] = x[key] + y if key == 'Chromatogram' else x[key]
+
+    return out
+
+
+def shard_ranges(scans, orders, retention_times, shards, halo=2.0):
+
+    '''
+    Splits the scans of a file into contiguous shards (see RawQuant.ShardQuant). The shards start at MS1 scans and
+    hold about the same number of scans. Each shard owns the scans from first to last, and also reads the scans within
+    halo minutes either side of them, so that the precursor scans and the precursor elution peaks of the scans it owns
+    are available. The scans read before the shard start at an MS1 scan too.
+
+    :param scans: the scan numbers of the file, sorted
+    :param orders: the MS order of each scan
+    :param retention_times: the retention time of each scan
+    :param shards: the number of shards
+    :param halo: the retention time in minutes read either side of each shard
+    :return: (shards, 4) array of the (low, first, last, high) scan numbers of each shard
+    '''
+
+    scans = np.asarray(scans, dtype=np.int64)
+    retention_times = np.asarray(retention_times, dtype=np.float64)
+    ms1 = np.flatnonzero(np.asarray(orders) == 1)
+
+    targets = np.arange(shards) * len(scans) // shards
+    starts = np.union1d([0], ms1[np.minimum(np.searchsorted(ms1, targets, 'left'), len(ms1) - 1)])
+    stops = np.append(starts[1:], len(scans))
+
+    before = np.searchsorted(retention_times[ms1], retention_times[starts] - halo, 'right') - 1
+    low = np.minimum(np.where(before >= 0, ms1[np.maximum(before, 0)], 0), starts)
+
+    high = np.maximum(np.searchsorted(retention_times, retention_times[stops - 1] + halo, 'right') - 1, stops - 1)
+
+    return np.column_stack([scans[low], scans[starts], scans[stops - 1], scans[high]])
+
+
+def merge_shards(frames, fill_times=None):
+
+    '''
+    Joins the QuantMatrix rows of the shards of a file, in order. A shard only has the SPS columns it used, so the
+    others are filled with zeros and the SPS columns are put back in order.
+
+    :param frames: the QuantMatrix rows of each shard
+    :param fill_times: optional names of the boxcar mass range fill time columns of the whole file, in order (see
+                       RawQuant.MassRangeKeys). They end the QuantMatrix, and are NaN where a shard did not have them
+    '''
+
+    df = pd.concat([x for x in frames if len(x) > 0] or frames[:1], sort=False)
+
+    if fill_times is not None:
+        df = df.reindex(columns=[x for x in df.columns if x not in fill_times] + list(fill_times))
+
+    numbers = sorted(int(x[len('SPSMass'):]) for x in df.columns if x.startswith('SPSMass'))
+
+    if len(numbers) == 0:
+        return df
+
+    sps = ['SPSMass' + str(x) for x in numbers] + ['SPSIntensity' + str(x) for x in numbers]
+    others = [x for x in df.columns if x not in sps]
+
+    # the SPS columns follow the same columns in every shard
+    first = next(x for x in frames if any(y in x.columns for y in sps))
+    position = list(first.columns).index(next(x for x in first.columns if x in sps))
+
+    df[sps] = df[sps].fillna(0)
+
+    return df[others[:position] + sps + others[position:]]
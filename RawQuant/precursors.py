@@ -0,0 +1,478 @@
+from collections import OrderedDict as OD
+from RawQuant.quant import closest_peaks, spectra_segments, unsorted_segments
+import numpy as np
+
+'''
+Linking MSn scans to the scans they were triggered from.
+
+When the trailer extra data has no Master Scan Number, the precursor scan of an MSn scan is taken to be the nearest
+MS(n-1) scan before it. The scan numbers of each order are sorted, so all scans of an order are linked with one
+binary search over the scan numbers of the order below, at any MSn depth.
+
+The elution peak of each precursor is found from its extracted ion chromatogram (XIC). XICIndex sorts the peaks of all
+MS1 scans by mass once, so the traces of every trigger mass are found together with binary searches, and the edges,
+apex and area of the peaks are then computed on the traces with array operations. The same peak calculations can run
+on mass range chromatograms read from the raw file instead (chromatogram_peaks), so the MS1 spectra are not needed.
+'''
+
+
+def link_precursors(scans, parents, masses=None, parent_masses=None, tolerance=0.01):
+
+    """
+    Finds the precursor scan of each scan: the nearest preceding parent scan.
+
+    If the precursor masses of the scans and the trigger masses of the parents are given, each link is checked against
+    them, and a scan whose nearest preceding parent was triggered on a different mass (e.g. when the MS3 scans of
+    several MS2 scans are interleaved) is linked to the nearest preceding parent triggered on its precursor mass, if
+    there is one.
+
+    :param scans: sorted array of the scan numbers to link, e.g. all MS3 scans
+    :param parents: sorted array of the scan numbers of the order below, e.g. all MS2 scans
+    :param masses: optional array of the precursor mass of each scan (the first reaction of its scan event)
+    :param parent_masses: optional array of the trigger mass of each parent scan
+    :param tolerance: mass tolerance in Da of the check
+    :return: integer array of the precursor scan number of each scan
+    """
+
+    scans = np.asarray(scans, dtype=np.int64)
+    parents = np.asarray(parents, dtype=np.int64)
+
+    index = np.searchsorted(parents, scans, 'left') - 1
+
+    if np.any(index < 0):
+        raise ValueError('scan ' + str(scans[index < 0][0]) + ' has no preceding scan of the order below')
+
+    if (masses is None) or (parent_masses is None):
+        return parents[index]
+
+    masses = np.asarray(masses, dtype=np.float64)
+    parent_masses = np.asarray(parent_masses, dtype=np.float64)
+
+    wrong = np.flatnonzero(np.abs(parent_masses[index] - masses) > tolerance)
+
+    if len(wrong) > 0:
+
+        # the parents sorted by trigger mass, so the parents triggered on a mass are one contiguous slice
+        by_mass = np.argsort(parent_masses, kind='stable')
+        sorted_masses = parent_masses[by_mass]
+
+        lower = np.searchsorted(sorted_masses, masses[wrong] - tolerance, 'left')
+        upper = np.searchsorted(sorted_masses, masses[wrong] + tolerance, 'right')
+
+        for i, start, stop in zip(wrong, lower, upper):
+
+            candidates = by_mass[start:stop]
+            candidates = candidates[candidates < index[i] + 1]
+
+            # if no parent was triggered on the mass, the nearest preceding parent is kept
+            if len(candidates) > 0:
+                index[i] = candidates.max()
+
+    return parents[index]
+
+
+class XICIndex:
+
+    '''
+    An m/z sorted index over all peaks of a set of MS1 scans, for extracting the ion chromatograms of many masses at
+    once. The traces of all masses are found with two binary searches per mass instead of a pass over every spectrum.
+
+    :param spectra: PeakStore or mapping of str(scan) to (n, fields) arrays with the masses and intensities first
+    :param scans: array of the scan numbers to index, in chromatographic order. A trace position is a position in it
+    '''
+
+    def __init__(self, spectra, scans):
+
+        self.scans = np.asarray(scans, dtype=np.int64)
+
+        columns, self.starts, self.stops = spectra_segments(spectra, self.scans)
+
+        self.masses, self.intensities = columns[0], columns[1]
+
+        # the scan position of every indexed peak, then all peaks sorted by mass
+        lengths = self.stops - self.starts
+        peaks = np.repeat(self.starts - np.cumsum(np.concatenate([[0], lengths[:-1]])), lengths) + np.arange(
+            lengths.sum())
+
+        by_mass = np.argsort(self.masses[peaks], kind='stable')
+
+        self.peak_positions = np.repeat(np.arange(len(self.scans)), lengths)[by_mass]
+        self.sorted_masses = self.masses[peaks[by_mass]]
+
+        self.unsorted = unsorted_segments(self.masses, self.starts, self.stops)
+
+    def traces(self, masses, ppm=4):
+
+        '''
+        Finds the scans holding a peak within the ppm tolerance of each mass.
+
+        :param masses: (n) array of masses
+        :param ppm: the tolerance; a peak matches if abs(peak - mass) / mass * 10 ** 6 < ppm
+        :return: (rows, positions): the sorted, unique (mass, scan position) pairs which have a matching peak
+        '''
+
+        masses = np.asarray(masses, dtype=np.float64)
+
+        # a slightly wide window, so no peak is lost to rounding. the exact tolerance is applied afterwards
+        width = np.abs(masses) * ppm * 1.01 / 10 ** 6
+
+        lower = np.searchsorted(self.sorted_masses, masses - width, 'left')
+        upper = np.searchsorted(self.sorted_masses, masses + width, 'right')
+
+        counts = upper - lower
+        rows = np.repeat(np.arange(len(masses)), counts)
+        peaks = np.repeat(lower - np.cumsum(np.concatenate([[0], counts[:-1]])), counts) + np.arange(counts.sum())
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            within = np.abs(self.sorted_masses[peaks] - masses[rows]) / masses[rows] * 10 ** 6 < ppm
+
+        keys = np.unique(rows[within] * len(self.scans) + self.peak_positions[peaks[within]])
+
+        return keys // len(self.scans), keys % len(self.scans)
+
+    def closest(self, positions, masses):
+
+        '''
+        Returns the intensity of the peak closest to each mass in the scan at each position, or 0 if the scan has no
+        peaks. There is no tolerance, as with np.argmin over the spectrum.
+        '''
+
+        positions = np.asarray(positions, dtype=np.int64)
+        masses = np.asarray(masses, dtype=np.float64)
+
+        peaks = closest_peaks(self.masses, self.starts[positions], self.stops[positions], masses[:, None],
+                              np.inf)[:, 0]
+
+        # unsorted spectra are searched one at a time
+        for i in np.flatnonzero(self.unsorted[positions]):
+            spectrum = self.masses[self.starts[positions[i]]:self.stops[positions[i]]]
+            peaks[i] = self.starts[positions[i]] + np.argmin(np.abs(spectrum - masses[i])) if len(spectrum) else -1
+
+        return np.where(peaks >= 0, self.intensities[np.maximum(peaks, 0)], 0.0)
+
+
+def peak_runs(rows, positions, starts, traced=None):
+
+    """
+    Finds, for each start, the run of consecutive scan positions around it in which its mass was seen.
+
+    :param rows: sorted mass of each (mass, scan position) pair, as returned by XICIndex.traces
+    :param positions: scan position of each pair
+    :param starts: (n) start positions, e.g. the position of the scan each precursor was triggered from
+    :param traced: (n) the row of the mass of each start. By default, the i-th start belongs to the i-th mass
+    :return: (first, last) positions of each run, -1 for the starts whose mass was not seen at the start position
+    """
+
+    starts = np.asarray(starts, dtype=np.int64)
+    traced = np.arange(len(starts)) if traced is None else np.asarray(traced, dtype=np.int64)
+
+    first = np.full(len(starts), -1, dtype=np.int64)
+    last = np.full(len(starts), -1, dtype=np.int64)
+
+    if len(rows) == 0:
+        return first, last
+
+    # pairs of different masses are never consecutive, since the positions of a row are separated by the number of
+    # positions (plus one) from those of the next row
+    span = int(max(positions.max(), starts.max())) + 2
+    keys = rows * span + positions
+
+    breaks = np.concatenate([[True], np.diff(keys) != 1])
+    run = np.cumsum(breaks) - 1
+    run_first = positions[breaks]
+    run_last = positions[np.concatenate([breaks[1:], [True]])]
+
+    target = traced * span + starts
+    found = np.minimum(np.searchsorted(keys, target), len(keys) - 1)
+    seen = keys[found] == target
+
+    first[seen] = run_first[run[found[seen]]]
+    last[seen] = run_last[run[found[seen]]]
+
+    return first, last
+
+
+def peak_windows(first, last, starts, length):
+
+    """
+    Returns the (leading, trailing) scan positions of the peak window of each mass: its run of scans plus the first
+    scan either side of it in which the mass was not seen, as long as there is one. A mass which was not seen at its
+    start position has a window of only that position.
+
+    :param first: first position of the run of each mass, -1 if there is no run (see peak_runs)
+    :param last: last position of the run of each mass
+    :param starts: start position of each mass
+    :param length: the number of scan positions
+    """
+
+    seen = first >= 0
+
+    leading = np.where(seen, np.maximum(first - 1, 0), starts)
+    trailing = np.where(seen, np.minimum(last + 1, length - 1), starts)
+
+    return leading, trailing
+
+
+def window_statistics(intensities, times, offsets):
+
+    """
+    The apex and area of peaks whose traces are stored one after the other.
+
+    :param intensities: the intensities of all traces
+    :param times: the retention time of each intensity
+    :param offsets: (n + 1) the i-th trace is intensities[offsets[i]:offsets[i + 1]]. Traces can not be empty
+    :return: (maximum intensity, position of the first maximum in its trace, trapezoidal area) of each trace
+    """
+
+    starts = offsets[:-1]
+    rows = np.repeat(np.arange(len(starts)), np.diff(offsets))
+
+    maximum = np.maximum.reduceat(intensities, starts) if len(starts) > 0 else np.zeros(0)
+
+    apex = np.flatnonzero(intensities == maximum[rows])
+    _, first = np.unique(rows[apex], return_index=True)
+    apex = apex[first] - starts
+
+    # the trapezoids between each point and the next one of the same trace
+    trapezoids = np.zeros(len(intensities))
+    trapezoids[:-1] = (intensities[1:] + intensities[:-1]) / 2 * np.diff(times)
+    trapezoids[offsets[1:] - 1] = 0
+
+    area = np.add.reduceat(trapezoids, starts) if len(starts) > 0 else np.zeros(0)
+
+    return maximum, apex, area
+
+
+def cluster_masses(masses, ppm=4):
+
+    """
+    Groups masses sorted by mass without chaining: a group starts at the lowest mass not yet grouped and holds the
+    masses within the ppm tolerance above it, so every mass of a group is within the tolerance of its representative.
+
+    :return: (group of each mass, representative mass of each group). The representative is the median mass of the
+             group, or the lower of the two middle masses. Groups are numbered in order of mass
+    """
+
+    masses = np.asarray(masses, dtype=np.float64)
+
+    by_mass = np.argsort(masses, kind='stable')
+    sorted_masses = masses[by_mass]
+
+    # the end of the group starting at each mass
+    limits = np.searchsorted(sorted_masses, sorted_masses * (1 + ppm / 10 ** 6), 'left')
+
+    starts = []
+    start = 0
+
+    while start < len(masses):
+        starts.append(start)
+        start = max(limits[start], start + 1)
+
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.concatenate([starts[1:], [len(masses)]]).astype(np.int64)
+
+    groups = np.empty(len(masses), dtype=np.int64)
+    groups[by_mass] = np.repeat(np.arange(len(starts)), stops - starts)
+
+    return groups, sorted_masses[(starts + stops - 1) // 2]
+
+
+def trace_masses(masses, ppm=4, share=True):
+
+    """
+    The masses to trace for a set of precursors (see precursor_peaks). If share is True, each group of masses from
+    cluster_masses is traced at its representative, and the members of groups of more than one mass are also traced at
+    their own mass, so it can be checked that they are in the same run. The traces are ordered by group, the
+    representative first, so the traces of a set of whole groups are in the same order on their own.
+
+    :return: (masses to trace, trace of the group of each precursor, trace of the precursor's own mass)
+    """
+
+    masses = np.asarray(masses, dtype=np.float64)
+
+    if not share:
+        return masses, np.arange(len(masses)), np.arange(len(masses))
+
+    groups, representatives = cluster_masses(masses, ppm)
+
+    sizes = np.bincount(groups, minlength=len(representatives))
+    members = np.flatnonzero(sizes[groups] > 1)
+
+    order = np.lexsort((np.concatenate([np.full(len(representatives), -1), members]),
+                        np.concatenate([np.arange(len(representatives)), groups[members]])))
+
+    rows = np.empty(len(order), dtype=np.int64)
+    rows[order] = np.arange(len(order))
+
+    group_rows = rows[:len(representatives)][groups]
+    own_rows = group_rows.copy()
+    own_rows[members] = rows[len(representatives):]
+
+    return np.concatenate([representatives, masses[members]])[order], group_rows, own_rows
+
+
+def trace_peaks(rows, positions, starts, groups, retention_times, scans, intensities, own=None):
+
+    """
+    Finds the elution peaks of many precursors from their traces: the edges, apex, area and profile of each. Precursors
+    of the same trace whose start scans are in the same run of it share a chromatogram.
+
+    If own is given, a precursor only keeps the trace of its group if its own trace has the same run at its start
+    scan. Otherwise its own trace is used.
+
+    :param rows: sorted trace of each (trace, scan position) pair in which the trace was seen
+    :param positions: scan position of each pair
+    :param starts: (n) scan position each precursor was triggered from
+    :param groups: (n) trace of each precursor
+    :param retention_times: retention time of each scan position
+    :param scans: scan number of each scan position
+    :param intensities: function of (positions, rows) returning the intensity of the traces of rows at positions
+    :param own: optional (n) trace of each precursor's own mass
+    :return: OrderedDict of (n) arrays: 'Max' intensities, 'Elution' (n, 2) start and end retention times, 'Area',
+             'MaxScan', 'EdgeScans' (n, 2) and 'Chromatogram', the chromatogram of each precursor. The profile of the
+             i-th chromatogram is 'Profiles'[Offsets[i]:Offsets[i + 1]]
+    """
+
+    first, last = peak_runs(rows, positions, starts, groups)
+
+    if own is not None:
+
+        own_first, own_last = peak_runs(rows, positions, starts, own)
+        shared = (first >= 0) & (first == own_first) & (last == own_last)
+
+        groups = np.where(shared, groups, own)
+        first = np.where(shared, first, own_first)
+        last = np.where(shared, last, own_last)
+
+    leading, trailing = peak_windows(first, last, starts, len(scans))
+
+    # precursors of the same group with the same peak share a chromatogram
+    _, unique, chromatograms = np.unique(np.column_stack([groups, first, last, leading, trailing]), axis=0,
+                                         return_index=True, return_inverse=True)
+    chromatograms = chromatograms.ravel()
+
+    # the profile of every chromatogram, one after the other
+    lengths = trailing[unique] - leading[unique] + 1
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    rows = np.repeat(groups[unique], lengths)
+    positions = np.repeat(leading[unique] - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+    profiles = intensities(positions, rows)
+
+    maximum, apex, area = window_statistics(profiles, retention_times[positions], offsets)
+
+    out = OD()
+    out['Max'] = maximum[chromatograms]
+    out['Elution'] = np.column_stack([retention_times[np.where(first >= 0, first, starts)],
+                                      retention_times[np.where(last >= 0, last, starts)]])
+    out['Area'] = area[chromatograms]
+    out['MaxScan'] = scans[leading + apex[chromatograms]]
+    out['EdgeScans'] = np.column_stack([scans[leading], scans[trailing]])
+    out['Chromatogram'] = chromatograms
+    out['Offsets'] = offsets
+    out['Profiles'] = profiles
+
+    return out
+
+
+def precursor_peaks(index, starts, masses, retention_times, ppm=4, share=True):
+
+    """
+    Finds the elution peak of many precursors from an XICIndex.
+
+    The peak of a precursor is the run of consecutive scans around the scan it was triggered from which hold a peak
+    within the ppm tolerance of its trigger mass. Its profile is the intensity of the peak closest to the trigger mass
+    in each scan of the run, and in the scan either side of it.
+
+    Precursors fragmented several times (or re-targeted for MS3 scans) share one chromatogram: the trigger masses
+    within the ppm tolerance of the median mass of their group are traced once, at that mass, and precursors whose
+    start scans are in the same run of that trace, and of the trace of their own mass, share its peak. The others are
+    traced at their own mass. The picked intensity is still found for each precursor.
+
+    :param index: XICIndex of the MS1 scans
+    :param starts: (n) position in index.scans of the scan each precursor was triggered from
+    :param masses: (n) trigger masses
+    :param retention_times: retention time of each scan in index.scans
+    :param ppm: the tolerance of the traces
+    :param share: share the chromatograms of repeated precursors. If False, every precursor is traced at its own mass
+    :return: OrderedDict of (n) arrays: 'Picked' intensities, and those returned by trace_peaks
+    """
+
+    starts = np.asarray(starts, dtype=np.int64)
+    masses = np.asarray(masses, dtype=np.float64)
+    retention_times = np.asarray(retention_times, dtype=np.float64)
+
+    traced, groups, own = trace_masses(masses, ppm, share)
+
+    rows, positions = index.traces(traced, ppm)
+
+    out = OD()
+    out['Picked'] = index.closest(starts, masses)
+    out.update(trace_peaks(rows, positions, starts, groups, retention_times, index.scans,
+                           lambda x, y: index.closest(x, traced[y]), own))
+
+    return out
+
+
+def chromatogram_peaks(traces, scans, starts, groups, retention_times, own=None):
+
+    """
+    Finds the elution peak of many precursors from mass range chromatograms, e.g. those read from the raw file by
+    RawFileReader.extract_chromatograms. A scan is part of the peak while the chromatogram intensity is above 0, and
+    the profile and picked intensity are the chromatogram intensities.
+
+    :param traces: iterable of the (scan numbers, retention times, intensities) of each chromatogram, in order
+    :param scans: array of the scan numbers of the MS1 scans to use. Chromatogram points of other scans are ignored
+    :param starts: (n) position in scans of the scan each precursor was triggered from
+    :param groups: (n) chromatogram of each precursor
+    :param retention_times: retention time of each scan in scans
+    :param own: optional (n) chromatogram of each precursor's own mass (see trace_masses and trace_peaks)
+    :return: OrderedDict of (n) arrays: 'Picked' intensities, and those returned by trace_peaks
+    """
+
+    scans = np.asarray(scans, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    groups = np.asarray(groups, dtype=np.int64)
+    retention_times = np.asarray(retention_times, dtype=np.float64)
+
+    lookup = np.full(int(scans.max()) + 2 if len(scans) > 0 else 1, -1, dtype=np.int64)
+    lookup[scans] = np.arange(len(scans))
+
+    # only the points above 0 are kept; everything else in a chromatogram is 0
+    rows, positions, values = [], [], []
+
+    for row, (trace_scans, _, intensities) in enumerate(traces):
+
+        trace_scans = np.minimum(np.asarray(trace_scans, dtype=np.int64), len(lookup) - 1)
+        trace_positions = lookup[trace_scans]
+        kept = (trace_positions >= 0) & (intensities > 0)
+
+        rows.append(np.full(kept.sum(), row, dtype=np.int64))
+        positions.append(trace_positions[kept])
+        values.append(np.asarray(intensities, dtype=np.float64)[kept])
+
+    rows = np.concatenate(rows) if len(rows) > 0 else np.zeros(0, dtype=np.int64)
+    positions = np.concatenate(positions) if len(positions) > 0 else np.zeros(0, dtype=np.int64)
+    values = np.concatenate(values) if len(values) > 0 else np.zeros(0)
+
+    span = len(scans) + 1
+    keys = rows * span + positions
+    order = np.argsort(keys, kind='stable')
+    keys, rows, positions, values = keys[order], rows[order], positions[order], values[order]
+
+    def intensities(x, y):
+
+        if len(keys) == 0:
+            return np.zeros(len(x))
+
+        target = y * span + x
+        found = np.minimum(np.searchsorted(keys, target), len(keys) - 1)
+
+        return np.where(keys[found] == target, values[found], 0.0)
+
+    out = OD()
+    out['Picked'] = intensities(starts, groups if own is None else own)
+    out.update(trace_peaks(rows, positions, starts, groups, retention_times, scans, intensities, own))
+
+    return out
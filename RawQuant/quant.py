@@ -0,0 +1,426 @@
+from collections import OrderedDict as OD
+from RawQuant.RawFileReader.peakstore import PeakStore, ScanMapping
+import numpy as np
+
+'''
+Reporter ion quantification over many scans at once.
+
+The spectra of all quant scans are searched together: for every (scan, reporter ion) pair the position of the reporter
+mass in the scan's sorted masses is found with a vectorized binary search, and the closest of its two neighbouring
+peaks is taken if it is within the mass tolerance. The results are kept in dense (scans, labels) arrays, one per
+value (mass, ppm, intensity, res, bl, noise).
+
+ReporterTable behaves like the OrderedDict of OrderedDicts keyed by str(scan) which RawQuant used previously, so code
+such as self.data['Quant'][str(scan)]['tmt126']['intensity'] keeps working.
+'''
+
+REPORTER_DATA = ['mass', 'ppm', 'intensity', 'res', 'bl', 'noise']
+
+# the values taken from the peak columns, in the order of the centroid fields
+PEAK_DATA = ['mass', 'intensity', 'res', 'bl', 'noise']
+
+
+def match_reporters(spectrum, labels, analyzer):
+
+    """
+    Finds the peak of each reporter ion in a spectrum. If several peaks are within 0.003 of a reporter mass, the one
+    closest to it is used.
+
+    :param spectrum: (n, fields) array of a centroid spectrum (mass, intensity, resolution, baseline, noise) or a
+                     mass list (mass, intensity)
+    :param labels: list of reporter ion dicts with 'ReporterMass' and 'Label' keys
+    :param analyzer: 'FTMS' or 'ITMS'
+    :return: OrderedDict of the reporter ion dicts keyed by label, with the matched mass, intensity, res, bl, noise
+             and ppm added
+    """
+
+    out = OD()
+    for x in labels:
+        label = x.copy()
+        matched = spectrum[(spectrum[:, 0] > label['ReporterMass'] - 0.003) & (
+                    spectrum[:, 0] < label['ReporterMass'] + 0.003), :5]
+
+        if len(matched) == 0:
+            label['mass'], label['intensity'], label['res'], label['bl'], label['noise'] = \
+                np.nan, np.nan, np.nan, np.nan, np.nan  # 0.0,0.0,0.0,0.0,0.0
+
+        elif np.ndim(matched) == 1:
+            if analyzer == 'FTMS':
+                label['mass'], label['intensity'], label['res'], label['bl'], label['noise'] = matched
+            elif analyzer == 'ITMS':
+                label['mass'], label['intensity'], label['res'], label['bl'], label['noise'] = \
+                    matched[0], matched[1], np.nan, np.nan, np.nan
+
+        elif np.ndim(matched) > 1:
+            # print('Interference found for ' + tmt['Label'] + ' label in scan '+str(scan)+
+            #                '. Ion closest to label mass selected.')
+            masses = matched[:, 0]
+            idx = np.argmin(np.abs(masses - label['ReporterMass']))
+            if analyzer == 'FTMS':
+                label['mass'], label['intensity'], label['res'], label['bl'], label['noise'] = matched[idx, :]
+            elif analyzer == 'ITMS':
+                label['mass'], label['intensity'], label['res'], label['bl'], label['noise'] = \
+                    matched[idx, 0], matched[idx, 1], np.nan, np.nan, np.nan
+
+        if label['intensity'] == 0:
+            label['ppm'] = np.nan
+        else:
+            label['ppm'] = (label['mass'] - label['ReporterMass']) / label['ReporterMass'] * 10 ** 6
+
+        out[label['Label']] = label
+
+    return out
+
+
+def reporter_band(labels, tolerance=0.003):
+
+    """
+    Returns the (low, high) m/z band holding every peak which can be matched to one of the reporter ions.
+    """
+
+    masses = [x['ReporterMass'] for x in labels]
+
+    return min(masses) - tolerance, max(masses) + tolerance
+
+
+def bisect_left(values, targets, starts, stops):
+
+    """
+    Vectorized bisect.bisect_left: for each target, the first position in values[start:stop] whose value is not less
+    than the target. Each slice of values must be sorted.
+
+    :return: array of positions in values (stop if all values of the slice are less than the target)
+    """
+
+    lo = np.array(starts, dtype=np.int64)
+    hi = np.array(stops, dtype=np.int64)
+
+    active = lo < hi
+
+    while np.any(active):
+
+        mid = (lo + hi) // 2
+        below = values[np.where(active, mid, 0)] < targets
+
+        lo = np.where(active & below, mid + 1, lo)
+        hi = np.where(active & ~below, mid, hi)
+
+        active = lo < hi
+
+    return lo
+
+
+def closest_peaks(masses, starts, stops, targets, tolerance=0.003):
+
+    """
+    Finds the peak closest to each target mass among the peaks of a scan which are strictly within the tolerance of
+    it. Ties go to the first peak, as in match_reporters.
+
+    :param masses: flat array of sorted peak masses of many scans
+    :param starts: (n) start of each scan in masses
+    :param stops: (n) stop of each scan in masses
+    :param targets: (n, k) target masses in each scan
+    :param tolerance: the tolerance in Da, either one value or one per target
+    :return: (n, k) positions of the matched peaks in masses, -1 where nothing matched
+    """
+
+    targets = np.asarray(targets, dtype=np.float64)
+    shape = targets.shape
+
+    if len(masses) == 0:
+        return np.full(shape, -1, dtype=np.int64)
+
+    targets = targets.ravel()
+    tolerance = np.broadcast_to(np.asarray(tolerance, dtype=np.float64), shape).ravel()
+    starts = np.repeat(np.asarray(starts, dtype=np.int64), shape[1])
+    stops = np.repeat(np.asarray(stops, dtype=np.int64), shape[1])
+
+    right = bisect_left(masses, targets, starts, stops)
+    left = right - 1
+
+    low, high = targets - tolerance, targets + tolerance
+
+    left_mass = masses[np.maximum(left, 0)]
+    right_mass = masses[np.minimum(right, len(masses) - 1)]
+
+    left_valid = (left >= starts) & (left_mass > low) & (left_mass < high)
+    right_valid = (right < stops) & (right_mass > low) & (right_mass < high)
+
+    take_left = left_valid & (~right_valid | (np.abs(left_mass - targets) <= np.abs(right_mass - targets)))
+
+    matched = np.where(take_left, left, np.where(right_valid, right, -1))
+
+    # the left neighbour is the last of any peaks with the same mass, but the first one is used
+    duplicated = take_left & (left > starts) & (masses[np.maximum(left - 1, 0)] == left_mass)
+
+    if np.any(duplicated):
+        matched[duplicated] = bisect_left(masses, left_mass[duplicated], starts[duplicated], left[duplicated])
+
+    return matched.reshape(shape)
+
+
+def unsorted_segments(masses, starts, stops):
+
+    """
+    Returns a boolean mask of the segments masses[start:stop] which are not sorted.
+    """
+
+    descending = np.flatnonzero(np.diff(masses) < 0) + 1
+
+    return np.searchsorted(descending, stops, 'left') > np.searchsorted(descending, starts, 'right')
+
+
+def spectra_segments(spectra, scans):
+
+    """
+    Locates the peaks of some scans: returns the columns of the peaks (masses first) and the start and stop of each
+    scan in them. A PeakStore is used in place; the spectra of other mappings are stacked.
+    """
+
+    if isinstance(spectra, PeakStore):
+
+        positions = spectra.positions(scans)
+
+        return [spectra.buffer[i] for i in range(len(spectra.fields))], spectra.offsets[positions], \
+            spectra.offsets[positions + 1]
+
+    peaks = [np.asarray(spectra[str(x)]) for x in scans]
+    offsets = np.concatenate([[0], np.cumsum([len(x) for x in peaks])]).astype(np.int64)
+
+    stacked = np.concatenate(peaks) if len(peaks) > 0 else np.empty((0, 2))
+
+    return [stacked[:, i] for i in range(stacked.shape[1])], offsets[:-1], offsets[1:]
+
+
+def quantify_reporters(spectra, scans, labels, analyzer, tolerance=0.003):
+
+    """
+    Finds the reporter ion peaks in the spectra of many scans.
+
+    :param spectra: PeakStore or mapping of str(scan) to (n, fields) arrays, with the masses in the first field and
+                    intensities in the second, followed by the resolutions, baselines and noises for FTMS data
+    :param scans: the scan numbers to quantify
+    :param labels: list of reporter ion dicts with 'ReporterMass' and 'Label' keys
+    :param analyzer: 'FTMS' or 'ITMS'. Resolutions, baselines and noises are NaN for ITMS data.
+    :return: OrderedDict of (scans, labels) arrays keyed by REPORTER_DATA
+    """
+
+    scans = np.asarray(scans, dtype=np.int64)
+    reporters = np.array([x['ReporterMass'] for x in labels], dtype=np.float64)
+
+    columns, starts, stops = spectra_segments(spectra, scans)
+
+    masses = np.asarray(columns[0])
+
+    matched = closest_peaks(masses, starts, stops, np.broadcast_to(reporters, (len(scans), len(reporters))),
+                            tolerance)
+
+    found = matched >= 0
+    index = np.where(found, matched, 0)
+
+    out = OD((x, np.full(matched.shape, np.nan)) for x in REPORTER_DATA)
+
+    used = PEAK_DATA if analyzer == 'FTMS' else PEAK_DATA[:2]
+
+    for i, datum in enumerate(used[:len(columns)]):
+        out[datum][found] = columns[i][index[found]]
+
+    # spectra with the masses out of order are searched one at a time
+    for i in np.flatnonzero(unsorted_segments(masses, starts, stops)):
+
+        spectrum = np.column_stack([x[starts[i]:stops[i]] for x in columns])
+
+        for j, label in enumerate(match_reporters(spectrum, labels, analyzer).values()):
+            for datum in PEAK_DATA:
+                out[datum][i, j] = label[datum]
+
+    with np.errstate(invalid='ignore'):
+        out['ppm'] = np.where(out['intensity'] == 0, np.nan, (out['mass'] - reporters) / reporters * 10 ** 6)
+
+    return out
+
+
+def match_sps_ions(spectra, parents, sps_masses, tolerance=0.01, units='Da'):
+
+    """
+    Finds the intensities of the SPS ions of MS3 scans in their parent MS2 scans: the peak closest to each SPS mass
+    within the tolerance. Many MS3 scans can share a parent, so each distinct (parent, SPS mass) pair is only
+    searched once.
+
+    :param spectra: PeakStore or mapping of str(scan) to (n, 2) MS2 mass lists
+    :param parents: (n) the parent MS2 scan of each MS3 scan
+    :param sps_masses: (n, k) the SPS masses of each MS3 scan, zero padded
+    :param tolerance: the mass tolerance
+    :param units: 'ppm' or 'Da'
+    :return: (n, k) array of intensities, 0.0 where no peak matched
+    """
+
+    if units not in ['ppm', 'Da']:
+        raise ValueError("units must be 'ppm' or 'Da'")
+
+    parents = np.asarray(parents, dtype=np.int64)
+    sps_masses = np.asarray(sps_masses, dtype=np.float64)
+
+    out = np.zeros(sps_masses.shape)
+
+    # the padding is not searched
+    rows, cols = np.nonzero(sps_masses > 0)
+
+    if len(rows) == 0:
+        return out
+
+    pairs, pair = np.unique(np.column_stack((parents[rows], sps_masses[rows, cols])), axis=0, return_inverse=True)
+    pair = pair.ravel()
+
+    scans, segment = np.unique(pairs[:, 0].astype(np.int64), return_inverse=True)
+    segment = segment.ravel()
+
+    columns, starts, stops = spectra_segments(spectra, scans)
+    masses, intensities = columns[0], columns[1]
+
+    targets = pairs[:, 1]
+    limits = targets * tolerance * 10 ** -6 if units == 'ppm' else np.full(len(targets), float(tolerance))
+
+    matched = closest_peaks(masses, starts[segment], stops[segment], targets[:, np.newaxis],
+                            limits[:, np.newaxis])[:, 0]
+
+    # mass lists with the masses out of order are searched one at a time
+    for i in np.flatnonzero(unsorted_segments(masses, starts, stops)[segment]):
+
+        window = masses[starts[segment[i]]:stops[segment[i]]]
+        distance = np.abs(window - targets[i])
+        inside = np.flatnonzero((window > targets[i] - limits[i]) & (window < targets[i] + limits[i]))
+
+        matched[i] = starts[segment[i]] + inside[np.argmin(distance[inside])] if len(inside) > 0 else -1
+
+    found = np.where(matched >= 0, intensities[np.maximum(matched, 0)], 0.0) if len(masses) > 0 else \
+        np.zeros(len(matched))
+
+    out[rows, cols] = found[pair]
+
+    return out
+
+
+class ReporterTable(ScanMapping):
+
+    def __init__(self, scans, labels, values):
+
+        super().__init__(scans)
+
+        # reporter ion dicts, with 'Label' and 'ReporterMass' keys
+        self.labels = [dict(x) for x in labels]
+        self.names = [str(x['Label']) for x in self.labels]
+
+        # (scans, labels) arrays keyed by REPORTER_DATA
+        self.arrays = values
+
+    @classmethod
+    def empty(cls, scans, labels):
+
+        """
+        Makes a table with all values NaN, to be filled in with fill().
+        """
+
+        shape = (len(scans), len(labels))
+
+        return cls(scans, labels, OD((x, np.full(shape, np.nan)) for x in REPORTER_DATA))
+
+    @classmethod
+    def from_spectra(cls, spectra, scans, labels, analyzer, tolerance=0.003):
+
+        return cls(scans, labels, quantify_reporters(spectra, scans, labels, analyzer, tolerance))
+
+    def fill(self, scans, values):
+
+        """
+        Sets the rows of some scans from the output of quantify_reporters.
+        """
+
+        positions = self.positions(scans)
+
+        for x in REPORTER_DATA:
+            self.arrays[x][positions] = values[x]
+
+    def column(self, label, datum, scans=None):
+
+        """
+        Returns one value (e.g. 'intensity') of one label for all scans, or for the given scans.
+        """
+
+        values = self.arrays[datum][:, self.names.index(label)]
+
+        if scans is None:
+            return values
+
+        return values[self.positions(scans)]
+
+    @property
+    def nbytes(self):
+
+        return sum(x.nbytes for x in self.arrays.values()) + self.scans.nbytes
+
+    def __getitem__(self, scan):
+
+        i = self.position(scan)
+
+        out = OD()
+        for j, label in enumerate(self.labels):
+            out[self.names[j]] = dict(label, **OD((x, self.arrays[x][i, j]) for x in REPORTER_DATA))
+
+        return out
+
+
+def correct_impurities(intensities, matrix):
+
+    """
+    Corrects reporter ion intensities for isotopic impurities by solving matrix . corrected = measured for each scan,
+    using only the reporters which were found in the scan. Scans are grouped by which reporters are missing, so each
+    distinct sub-matrix is factorised once and all scans of the group are solved together.
+
+    :param intensities: (n, labels) array of measured intensities, NaN where a reporter was not found
+    :param matrix: (labels, labels) correction matrix
+    :return: (n, labels) array of corrected intensities, NaN where the measured intensity is NaN
+    """
+
+    intensities = np.asarray(intensities, dtype=np.float64)
+    matrix = np.asarray(matrix, dtype=np.float64)
+
+    corrected = np.full(intensities.shape, np.nan)
+
+    if len(intensities) == 0:
+        return corrected
+
+    found = ~np.isnan(intensities)
+
+    patterns, group = np.unique(found, axis=0, return_inverse=True)
+    group = group.ravel()
+
+    order = np.argsort(group, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(group, minlength=len(patterns)))])
+
+    for i, pattern in enumerate(patterns):
+
+        if not pattern.any():
+            continue
+
+        rows = order[bounds[i]:bounds[i + 1]]
+        sub = matrix[np.ix_(pattern, pattern)]
+        measured = intensities[np.ix_(rows, pattern)].T
+
+        try:
+            solved = np.linalg.solve(sub, measured)
+
+        except np.linalg.LinAlgError:
+            # singular sub-matrix, Cramer's rule gives inf or NaN as the row-by-row correction did
+            solved = np.empty(measured.shape)
+            replaced = np.repeat(sub[np.newaxis], measured.shape[1], axis=0)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for y in range(len(sub)):
+                    top = replaced.copy()
+                    top[:, :, y] = measured.T
+                    solved[y] = np.linalg.det(top) / np.linalg.det(sub)
+
+        corrected[np.ix_(rows, pattern)] = solved.T
+
+    return corrected
@@ -0,0 +1,116 @@
+from collections import OrderedDict as OD
+import numpy as np
+import pandas as pd
+import time
+import sys
+
+from RawQuant import RawQuant
+from RawQuant.quant import ReporterTable
+from RawQuant.RawFileReader.peakstore import PeakStore, ScanArray
+from RawQuant.RawFileReader.trailer import TrailerTable
+
+'''
+Times RawQuant.ToDataFrame for synthetic MS3 TMT10 experiments of increasing size, to check that building the
+QuantMatrix scales linearly with the number of scans. No raw file is needed; the extracted data is generated.
+
+Usage: python benchmarks/todataframe.py [largest number of MS3 scans]
+'''
+
+LABELS = [('tmt126', 126.127726), ('tmt127N', 127.124761), ('tmt127C', 127.131081), ('tmt128N', 128.128116),
+          ('tmt128C', 128.134436), ('tmt129N', 129.131471), ('tmt129C', 129.137790), ('tmt130N', 130.134825),
+          ('tmt130C', 130.141145), ('tmt131', 131.138180)]
+
+
+def synthetic(n_ms3, topN=10, peaks=200, seed=0):
+
+    """
+    Makes a RawQuant object holding extracted data for n_ms3 MS3 scans, each with its own MS2 scan, in cycles of one
+    MS1 scan followed by topN MS2/MS3 pairs.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    cycles = int(np.ceil(n_ms3 / topN))
+    orders = np.tile(np.concatenate([[1], np.tile([2, 3], topN)]), cycles)
+    scans = np.arange(1, len(orders) + 1)
+
+    MS1scans, MS2scans, MS3scans = scans[orders == 1], scans[orders == 2], scans[orders == 3]
+
+    data = RawQuant.__new__(RawQuant)
+    data.RawFile = 'synthetic.raw'
+    data.disable_bar = True
+    data.open = False
+    data._raw = None
+
+    data.info = pd.DataFrame({'ScanNum': scans, 'MSOrder': orders, 'RetentionTime': scans / 1000}, index=scans)
+    data.MetaData = {'AnalysisOrder': 3}
+    data.flags = dict((x, True) for x in ['MS1RetentionTime', 'MS2RetentionTime', 'MS3RetentionTime', 'PrecursorMass',
+                                          'PrecursorCharge', 'PrecursorPeaks', 'MS2PrecursorScan', 'MS3PrecursorScan',
+                                          'MS1TrailerExtra', 'MS2TrailerExtra', 'MS3TrailerExtra', 'MS2MassLists',
+                                          'Quantified', 'MS1Interference'])
+    data.flags.update({'BoxCar': False, 'Streamed': False, 'QuantMatrix': False})
+    data.data = {}
+
+    for order, x in [(1, MS1scans), (2, MS2scans), (3, MS3scans)]:
+
+        data.data['MS' + str(order) + 'RetentionTime'] = ScanArray(x, x / 1000)
+
+        labels = ['Ion Injection Time (ms):']
+        values = [rng.uniform(1, 100, len(x)).round(3).astype(str)]
+
+        if order == 3:
+            labels += ['SPS Masses:']
+            values += [[','.join(y) for y in rng.uniform(400, 1200, (len(x), 10)).round(4).astype(str)]]
+
+        values = np.column_stack(values).astype(object)
+
+        data.data['MS' + str(order) + 'TrailerExtra'] = TrailerTable.from_strings(x, labels, values)
+
+    data.data['MS2PrecursorScan'] = ScanArray(MS2scans, MS1scans[np.searchsorted(MS1scans, MS2scans) - 1])
+    data.data['MS3PrecursorScan'] = ScanArray(MS3scans, MS3scans - 1)
+
+    data.data['PrecursorMass'] = ScanArray(MS2scans, rng.uniform(400, 1200, len(MS2scans)))
+    data.data['PrecursorCharge'] = ScanArray(MS2scans, rng.integers(2, 5, len(MS2scans)))
+    precursors = data.data['MS2PrecursorScan'].array
+
+    intensities = np.zeros(len(MS2scans), dtype=[('Picked', np.float64), ('Max', np.float64)])
+    intensities['Picked'], intensities['Max'] = rng.uniform(0, 1e7, (2, len(MS2scans)))
+
+    data.data['PrecursorMaxScan'] = ScanArray(MS2scans, precursors)
+    data.data['PrecursorElution'] = ScanArray(MS2scans, np.sort(rng.uniform(0, 1, (len(MS2scans), 2)), axis=1))
+    data.data['PrecursorEdgeScans'] = ScanArray(MS2scans, np.column_stack([precursors, precursors]))
+    data.data['PrecursorArea'] = ScanArray(MS2scans, rng.uniform(0, 1e7, len(MS2scans)))
+    data.data['PrecursorIntensities'] = ScanArray(MS2scans, intensities)
+    data.data['MS1Interference'] = ScanArray(MS2scans, rng.uniform(0, 1, len(MS2scans)))
+
+    masses = np.sort(rng.uniform(100, 1500, (len(MS2scans), peaks)), axis=1).ravel()
+    data.data['MS2MassLists'] = PeakStore(MS2scans, np.arange(len(MS2scans) + 1) * peaks,
+                                          np.vstack([masses, rng.uniform(0, 1e6, len(masses))]),
+                                          ['Positions', 'Intensities'])
+
+    labels = [{'Label': x, 'ReporterMass': y} for x, y in LABELS]
+    data.data['Labels'] = OD((x['Label'], x) for x in labels)
+    data.data['Quant'] = ReporterTable(MS3scans, labels,
+                                       OD((x, rng.uniform(0, 1e5, (len(MS3scans), len(labels))))
+                                          for x in ['mass', 'ppm', 'intensity', 'res', 'bl', 'noise']))
+
+    return data
+
+
+if __name__ == '__main__':
+
+    largest = int(sys.argv[1]) if len(sys.argv) > 1 else 80000
+
+    sizes = [largest // 8, largest // 4, largest // 2, largest]
+
+    print('{:>10} {:>10} {:>14}'.format('MS3 scans', 'seconds', 'us per scan'))
+
+    for n in sizes:
+
+        data = synthetic(n)
+
+        start = time.perf_counter()
+        data.ToDataFrame()
+        elapsed = time.perf_counter() - start
+
+        print('{:>10} {:>10.3f} {:>14.2f}'.format(n, elapsed, elapsed / n * 10 ** 6))
@@ -0,0 +1,77 @@
+from collections import OrderedDict as OD
+import numpy as np
+import pytest
+
+# RawQuant loads the Thermo RawFileReader assemblies through pythonnet when it is imported
+pytest.importorskip('clr')
+
+from RawQuant.RawFileReader.peakstore import PeakStore
+from RawQuant.parallel import compute, compute_precursor_peaks
+from RawQuant.precursors import XICIndex
+from RawQuant.quant import quantify_reporters
+
+'''
+Checks that the calculations split over a pool of processes give the same results as in one process, on random data.
+'''
+
+TMT6 = [{'ReporterMass': x, 'Label': y} for x, y in
+        zip([126.127726, 127.124761, 128.134436, 129.131471, 130.141145, 131.138180],
+            ['tmt126', 'tmt127', 'tmt128', 'tmt129', 'tmt130', 'tmt131'])]
+
+
+def random_store(rng, n, low, high, around=None):
+
+    """
+    A PeakStore of n random scans, with peaks between low and high plus some within a few ppm of the masses in around,
+    so that they are found.
+    """
+
+    spectra = []
+
+    for scan in range(n):
+
+        masses = rng.uniform(low, high, 40)
+
+        if around is not None:
+            masses = np.concatenate([masses, around[rng.random(len(around)) > 0.25] * (1 + rng.normal(0, 1.5e-6))])
+
+        spectra.append(np.stack([np.sort(masses), rng.uniform(1, 1000, len(masses))]))
+
+    offsets = np.concatenate([[0], np.cumsum([x.shape[1] for x in spectra])])
+
+    return PeakStore(np.arange(1, n + 1), offsets, np.concatenate(spectra, axis=1), ['Masses', 'Intensities'])
+
+
+def test_compute_matches_one_process():
+
+    rng = np.random.default_rng(24)
+    spectra = random_store(rng, 120, 125, 132, np.array([x['ReporterMass'] for x in TMT6]))
+
+    values = [compute(quantify_reporters, OD([('spectra', spectra)]), OD([('scans', spectra.scans)]),
+                      OD([('labels', TMT6), ('analyzer', 'FTMS')]), processes=x) for x in [1, 3]]
+
+    assert list(values[0]) == list(values[1])
+
+    for key in values[0]:
+        np.testing.assert_equal(values[1][key], values[0][key])
+
+
+@pytest.mark.parametrize('share', [True, False])
+def test_compute_precursor_peaks_matches_one_process(share):
+
+    rng = np.random.default_rng(24)
+    masses = rng.uniform(400, 1200, 30)
+    spectra = random_store(rng, 80, 400, 1200, masses)
+
+    retention_times = np.cumsum(rng.uniform(0.01, 0.05, 80))
+    starts = rng.integers(0, 80, 300)
+    targets = rng.choice(masses, 300) * (1 + rng.uniform(-3e-6, 3e-6, 300))
+
+    index = XICIndex(spectra, spectra.scans)
+
+    out = [compute_precursor_peaks(index, starts, targets, retention_times, share=share, processes=x) for x in [1, 3]]
+
+    assert list(out[0]) == list(out[1])
+
+    for key in out[0]:
+        np.testing.assert_equal(out[1][key], out[0][key])
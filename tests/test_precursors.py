@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+# RawQuant loads the Thermo RawFileReader assemblies through pythonnet when it is imported
+pytest.importorskip('clr')
+
+from RawQuant.precursors import XICIndex, precursor_peaks
+
+'''
+Checks the precursor elution peaks found from an XICIndex against the edge walk they replaced, on random MS1 scans.
+'''
+
+
+def random_ms1(rng, n, peptides=30):
+
+    """
+    Random MS1 spectra of a set of peptides, each seen in most scans within a few ppm of its mass, plus noise peaks.
+    """
+
+    masses = rng.uniform(400, 1200, peptides)
+    spectra = {}
+
+    for scan in range(1, n + 1):
+
+        seen = masses[rng.random(peptides) > 0.25] * (1 + rng.normal(0, 1.5e-6))
+        peaks = np.sort(np.concatenate([seen, rng.uniform(400, 1200, 50)]))
+
+        spectra[str(scan)] = np.column_stack([peaks, rng.uniform(1, 1000, len(peaks))])
+
+    return masses, spectra
+
+
+def edge_walk(spectra, scans, retention_times, start, mass):
+
+    """
+    The per precursor search MS2PrecursorPeaks replaced: walks away from the start scan while the mass is within 4
+    ppm, and keeps the first scan either side in which it is not.
+    """
+
+    def seen(i):
+        masses = spectra[str(scans[i])][:, 0]
+        return np.sum(np.abs(masses - mass) / mass * 10 ** 6 < 4) > 0
+
+    def closest(i):
+        spectrum = spectra[str(scans[i])]
+        return spectrum[np.argmin(np.abs(spectrum[:, 0] - mass)), 1]
+
+    # the retention time of the start scan if the mass is not seen in it
+    leading, leading_rt = start, retention_times[start]
+
+    while seen(leading):
+        leading_rt = retention_times[leading]
+        if leading == 0:
+            break
+        leading -= 1
+
+    trailing, trailing_rt = start, retention_times[start]
+
+    while seen(trailing):
+        trailing_rt = retention_times[trailing]
+        if trailing == len(scans) - 1:
+            break
+        trailing += 1
+
+    profile = np.array([closest(i) for i in range(leading, trailing + 1)])
+    times = retention_times[leading:trailing + 1]
+
+    return {'Picked': closest(start), 'Max': profile.max(), 'MaxScan': scans[leading + np.argmax(profile)],
+            'Area': np.sum((profile[1:] + profile[:-1]) / 2 * np.diff(times)), 'Elution': (leading_rt, trailing_rt),
+            'EdgeScans': (scans[leading], scans[trailing]), 'Profile': profile}
+
+
+def test_precursor_peaks_matches_edge_walk():
+
+    rng = np.random.default_rng(18)
+    masses, spectra = random_ms1(rng, 80)
+
+    scans = np.arange(1, 81)
+    retention_times = np.cumsum(rng.uniform(0.01, 0.05, 80))
+
+    starts = rng.integers(0, 80, 300)
+    targets = rng.choice(masses, 300) * (1 + rng.uniform(-3e-6, 3e-6, 300))
+
+    out = precursor_peaks(XICIndex(spectra, scans), starts, targets, retention_times, share=False)
+
+    for i in range(300):
+
+        expected = edge_walk(spectra, scans, retention_times, starts[i], targets[i])
+        chromatogram = out['Chromatogram'][i]
+
+        for key in ['Picked', 'Max', 'MaxScan', 'Elution', 'EdgeScans']:
+            np.testing.assert_equal(out[key][i], expected[key])
+
+        np.testing.assert_allclose(out['Area'][i], expected['Area'], rtol=1e-9)
+        np.testing.assert_equal(out['Profiles'][out['Offsets'][chromatogram]:out['Offsets'][chromatogram + 1]],
+                                expected['Profile'])
@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+# RawQuant loads the Thermo RawFileReader assemblies through pythonnet when it is imported
+pytest.importorskip('clr')
+
+from RawQuant.quant import correct_impurities, match_reporters, quantify_reporters, REPORTER_DATA
+
+'''
+Checks the vectorized reporter ion calculations against the per scan loops they replaced, on random data.
+'''
+
+TMT10 = [{'ReporterMass': x, 'Label': y} for x, y in
+         zip([126.127726, 127.124761, 127.131081, 128.128116, 128.134436, 129.131471, 129.137790, 130.134825,
+              130.141145, 131.138180],
+             ['tmt126', 'tmt127N', 'tmt127C', 'tmt128N', 'tmt128C', 'tmt129N', 'tmt129C', 'tmt130N', 'tmt130C',
+              'tmt131'])]
+
+
+def random_spectra(rng, n, fields):
+
+    """
+    Random spectra with peaks near the reporter masses, some of them several within the tolerance, some spectra
+    empty and some with the masses out of order.
+    """
+
+    reporters = np.array([x['ReporterMass'] for x in TMT10])
+    spectra = {}
+
+    for scan in range(1, n + 1):
+
+        near = rng.choice(reporters, rng.integers(0, 15))
+        masses = np.concatenate([near + rng.uniform(-0.004, 0.004, len(near)), rng.uniform(100, 140, 20)])
+
+        if scan % 7 == 0:
+            masses = masses[:0]
+
+        if scan % 5 != 0:
+            masses = np.sort(masses)
+
+        peaks = rng.uniform(1, 1000, (len(masses), fields))
+        peaks[:, 0] = masses
+
+        # a few zero intensities, which have no ppm error
+        peaks[rng.random(len(masses)) < 0.05, 1] = 0
+
+        spectra[str(scan)] = peaks
+
+    return spectra
+
+
+@pytest.mark.parametrize('analyzer, fields', [('FTMS', 5), ('ITMS', 2)])
+def test_quantify_reporters_matches_loop(analyzer, fields):
+
+    rng = np.random.default_rng(11)
+    spectra = random_spectra(rng, 200, fields)
+    scans = np.arange(1, 201)
+
+    out = quantify_reporters(spectra, scans, TMT10, analyzer)
+
+    for i, scan in enumerate(scans):
+
+        expected = match_reporters(spectra[str(scan)], TMT10, analyzer)
+
+        for j, label in enumerate(expected.values()):
+            for datum in REPORTER_DATA:
+                np.testing.assert_equal(out[datum][i, j], label[datum])
+
+
+def cramer(x, matrix):
+
+    """
+    The row by row impurity correction correct_impurities replaced: Cramer's rule on the found reporters.
+    """
+
+    x = x.copy()
+    good = ~np.isnan(x)
+    x2 = x[good]
+    CM = matrix[good][:, good]
+
+    if np.sum(good) > 1:
+
+        CMdet = np.linalg.det(CM)
+        new_x = np.zeros(len(x2))
+
+        for y in range(len(x2)):
+            top = CM.copy()
+            top[:, y] = x2
+            new_x[y] = np.linalg.det(top) / CMdet
+
+        x[good] = new_x
+
+    elif np.sum(good) == 1:
+        x[good] = x2 / CM[0, 0]
+
+    return x
+
+
+def test_correct_impurities_matches_cramer():
+
+    rng = np.random.default_rng(13)
+
+    # a TMT10 style correction matrix: mostly diagonal, with impurities two labels either side
+    matrix = np.diag(rng.uniform(0.85, 0.95, 10))
+
+    for shift in [-2, 2]:
+        matrix += np.diag(rng.uniform(0, 0.05, 10 - abs(shift)), shift)
+
+    intensities = rng.uniform(0, 1000, (300, 10))
+    intensities[rng.random(intensities.shape) < 0.2] = np.nan
+    intensities[:5] = np.nan
+
+    corrected = correct_impurities(intensities, matrix)
+
+    np.testing.assert_allclose(corrected, np.array([cramer(x, matrix) for x in intensities]), rtol=1e-9)